@@ -0,0 +1,188 @@
+"""
+Test the 'check_links' extension.
+"""
+
+import os
+import time
+import tempfile
+import threading
+from cStringIO import StringIO
+
+import twill
+from twill import commands
+from twill.errors import TwillAssertionError
+from twill.linkcache import LinkCache
+
+_lock = threading.Lock()
+_running = [0, 0]                       # checks running now; most at once.
+_requests = []
+
+page = """\
+<html><body>
+<a href="/ok">ok</a> <a href="/ok#top">ok again</a> <a href="ok">ok 3</a>
+<a href="/slow/1">1</a> <a href="/slow/2">2</a> <a href="/slow/3">3</a>
+<a href="/slow/4">4</a> <a href="/slow/5">5</a> <a href="/slow/6">6</a>
+<a href="/no-head">no HEAD</a> <a href="/etag">etag</a>
+<a href="/missing">missing</a>
+<a href="mailto:nobody@example.com">mail</a>
+<a name="anchor">no href</a>
+</body></html>
+"""
+
+def link_app(environ, start_response):
+    method, path = environ['REQUEST_METHOD'], environ['PATH_INFO']
+    _requests.append((method, path))
+
+    if path == '/':
+        start_response('200 OK', [('Content-type', 'text/html')])
+        return [page]
+    if path == '/with-bad':
+        start_response('200 OK', [('Content-type', 'text/html')])
+        return ['<a href="/bad">bad</a> <a href="/ok">ok</a>'
+                '<a href="/slow/1">1</a>']
+
+    if path.startswith('/slow/'):
+        _lock.acquire()
+        _running[0] += 1
+        _running[1] = max(_running)
+        _lock.release()
+        time.sleep(0.2)
+        _lock.acquire()
+        _running[0] -= 1
+        _lock.release()
+
+    if path == '/etag':
+        if environ.get('HTTP_IF_NONE_MATCH') == '"v1"':
+            start_response('304 Not Modified', [])
+            return []
+        start_response('200 OK', [('Content-type', 'text/plain'),
+                                  ('ETag', '"v1"')])
+    elif path == '/bad':
+        raise ValueError("broken app")
+    elif path == '/missing':
+        start_response('404 Not Found', [('Content-type', 'text/plain')])
+    elif path == '/no-head' and method == 'HEAD':
+        start_response('405 Method Not Allowed',
+                       [('Content-type', 'text/plain')])
+    else:
+        start_response('200 OK', [('Content-type', 'text/plain')])
+    return ['body\n']
+
+def setup_module():
+    global check_links
+    twill.add_wsgi_intercept('linkhost', 80, lambda: link_app)
+    commands.extend_with('check_links')
+    import check_links
+
+def teardown_module():
+    twill.remove_wsgi_intercept('linkhost', 80)
+    commands.reset_browser()
+
+def test_check_links():
+    commands.reset_browser()
+    commands.go('http://linkhost/')
+
+    del _requests[:]
+    _running[:] = [0, 0]
+    commands.config('check_links.per_host', '3')
+
+    try:
+        check_links.check_links()
+        assert 0, "should have failed on /missing"
+    except TwillAssertionError:
+        pass
+
+    # each link is checked once, with HEAD; GET only after a failure.
+    assert _requests.count(('HEAD', '/ok')) == 1
+    assert ('GET', '/ok') not in _requests
+    assert ('GET', '/no-head') in _requests
+    assert ('GET', '/missing') in _requests
+    assert len([ r for r in _requests if r[1].startswith('/slow/') ]) == 6
+
+    # concurrently, but no more than 3 at once on the one host.
+    assert _running[1] == 3, _running
+
+    # only the links that match the pattern, skipping those known to
+    # be good.
+    del _requests[:]
+    visited = { 'http://linkhost/slow/1' : 1 }
+    check_links.check_links('/slow/|/no-head', visited)
+    assert len(_requests) == 7         # /no-head takes two.
+    assert ('HEAD', '/slow/1') not in _requests
+    assert len(visited) == 7
+
+def test_collect_bad_links():
+    commands.go('http://linkhost/')
+    commands.config('check_links.only_collect_bad_links', '1')
+    check_links.check_links()
+    assert check_links.bad_links_dict == \
+           { 'http://linkhost/missing' : ['http://linkhost/'] }
+
+    try:
+        check_links.report_bad_links()
+        assert 0, "should have failed"
+    except TwillAssertionError:
+        pass
+    assert not check_links.bad_links_dict
+
+def test_cache():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'links.db')
+    try:
+        commands.go('http://linkhost/')
+        commands.config('check_links.cache', filename)
+
+        del _requests[:]
+        check_links.check_links('/ok|/etag|/slow/1')
+        assert len(_requests) == 3
+
+        # anyone else opening the cache sees them.
+        cache = LinkCache(filename)
+        entry = cache.get(['http://linkhost/etag'])['http://linkhost/etag']
+        assert entry[0] == 200 and entry[2] == '"v1"'
+        assert cache.is_fresh(entry)
+        cache.close()
+
+        # fresh links aren't checked again...
+        del _requests[:]
+        check_links.check_links('/ok|/etag|/slow/1')
+        assert not _requests
+
+        # ...and stale ones are revalidated.
+        commands.config('check_links.cache_ttl', '0')
+        del _requests[:]
+        check_links.check_links('/etag')
+        assert _requests == [('HEAD', '/etag')]
+
+        # bad links aren't cached.
+        commands.config('check_links.cache_ttl', '3600')
+        commands.config('check_links.only_collect_bad_links', '1')
+        del _requests[:]
+        check_links.check_links('/missing')
+        check_links.check_links('/missing')
+        assert len(_requests) == 4
+        check_links.bad_links_dict.clear()
+    finally:
+        commands.reset_browser()
+        for name in os.listdir(dirname):
+            os.unlink(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
+def test_app_error():
+    commands.go('http://linkhost/with-bad')
+    out = StringIO()
+    twill.set_output(out)
+    try:
+        # a check that blows up is a bad link, like any other, and the
+        # other links on that host still get checked.
+        commands.config('check_links.per_host', '1')
+        try:
+            check_links.check_links()
+            assert 0, "should have failed on /bad"
+        except TwillAssertionError:
+            pass
+        assert 'http://linkhost/bad (ValueError: broken app)' in \
+               out.getvalue()
+    finally:
+        twill.set_output(None)
+        commands.reset_browser()
@@ -0,0 +1,91 @@
+"""
+Test multi-node twill-fork, with a coordinator & workers on localhost.
+"""
+
+import os
+import select
+import tempfile
+
+import twilltestlib
+from twill import cluster
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_split():
+    assert cluster._split(10, [2, 1]) == [7, 3]
+    assert cluster._split(1, [1, 1, 1]) == [1, 0, 0]
+
+# the number of times each worker in the last _run waited in select().
+_worker_wakeups = []
+
+def _run(filename, **kw):
+    pids = []
+    del _worker_wakeups[:]
+    def listening(address):
+        # start the workers, now that we know where to find the coordinator.
+        for processes in (2, 1):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    os.close(r)
+                    calls = []
+                    real_select = select.select
+                    def counting_select(*args):
+                        calls.append(1)
+                        return real_select(*args)
+                    select.select = counting_select
+
+                    cluster.run_worker(address, processes)
+                    os.write(w, str(len(calls)))
+                    status = 0
+                finally:
+                    os._exit(status)
+            os.close(w)
+            pids.append((pid, r))
+
+    try:
+        return cluster.run_coordinator(('localhost', 0), 2, [filename],
+                                       initial_url=url, report_interval=0.2,
+                                       listening=listening, **kw)
+    finally:
+        for pid, r in pids:
+            _, status = os.waitpid(pid, 0)
+            assert status == 0
+            _worker_wakeups.append(int(os.read(r, 100)))
+            os.close(r)
+
+def test_cluster():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        fp = open(filename, 'w')
+        fp.write("go /\ncode 200\n")
+        fp.close()
+
+        request_stats, elapsed, total_time, total_exec, n_processes, failed = \
+                       _run(filename, number=9)
+        assert not failed
+        assert n_processes == 3
+        assert total_exec == 9
+        assert len(request_stats) == 18     # initial URL + go.
+        assert request_stats.n_errors() == 0
+
+        # rate mode: iterations are reported under the coordinator's names.
+        request_stats, elapsed, total_time, total_exec, n_processes, failed = \
+                       _run(filename, profile=[('step', 1., 6., 6.)])
+        assert total_exec == 6
+        assert request_stats.histograms[('<iteration>', filename)].count == 6
+
+        # the workers ran side by side, so the total is the run's time.
+        assert total_time == elapsed
+
+        # ...and the workers wait for work, rather than spinning: about
+        # one wakeup per arrival, result and report.
+        assert max(_worker_wakeups) < 50, _worker_wakeups
+    finally:
+        os.unlink(filename)
+        os.rmdir(dirname)
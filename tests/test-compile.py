@@ -0,0 +1,120 @@
+"""
+Test the compiled-script cache.
+"""
+
+import os
+import time
+import tempfile
+
+import twill
+from twill import parse
+from twill.errors import TwillAssertionError
+
+def _write(filename, text):
+    fp = open(filename, 'w')
+    fp.write(text)
+    fp.close()
+
+def test_compile_script():
+    from cStringIO import StringIO
+    script = parse.compile_script(StringIO("""\
+# a comment
+setlocal a 'b c'
+
+echo $a # trailing comment
+"""))
+    assert script == [ (1, 'setlocal', parse.compile_args(['a', 'b c']),
+                        "setlocal a 'b c'\n"),
+                       (3, 'echo', parse.compile_args(['$a']),
+                        "echo $a # trailing comment\n") ]
+
+def test_argument_templates():
+    g = { 'a' : 'A', '__l' : ['x', 'y'], 'n' : 'two\\nlines' }
+    l = {}
+
+    def ev(*args):
+        return parse.evaluate_args(parse.compile_args(args), g, l)
+
+    assert ev('plain', 'new\\nline') == ['plain', 'new\nline']
+    assert ev('$a', '$missing') == ['A', '$missing']
+    assert ev('__l', '__missing') == ['x', 'y', '__missing']
+    assert ev('<${a}|${missing}|${a + a}>') == ['<A|${missing}|AA>']
+    assert ev('$n') == ['two\nlines']
+
+    # templates are evaluated freshly each time.
+    template = parse.compile_args(['${a}'])
+    assert parse.evaluate_args(template, g, l) == ['A']
+    assert parse.evaluate_args(template, { 'a' : 'B' }, l) == ['B']
+
+    # ...and match process_args on raw arguments.
+    raw = ['$a', '${a}b', 'c', '__l']
+    assert parse.process_args(raw, g, l) == ev(*raw)
+
+    # syntax errors are raised on evaluation, not on compilation.
+    template = parse.compile_args(['${a b}'])
+    try:
+        parse.evaluate_args(template, g, l)
+        assert 0, "should not get here"
+    except SyntaxError:
+        pass
+
+def test_file_cache():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        _write(filename, "setglobal compiled 1\n")
+
+        script = parse.compile_file(filename)
+        assert script is parse.compile_file(filename)
+
+        twill.execute_file(filename)
+
+        # changes to the file are picked up.
+        _write(filename, "setglobal compiled 2\nsetglobal other 3\n")
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        script2 = parse.compile_file(filename)
+        assert script2 is not script
+        assert len(script2) == 2
+
+        # on-disk cache, in a directory of its own.
+        cachedir = os.path.join(dirname, 'cache')
+        old_cachedir = parse._disk_cache_dir
+        parse.cache_scripts_on_disk(True, cachedir)
+        try:
+            parse._script_cache.clear()
+            parse.compile_file(filename)
+            assert len(os.listdir(cachedir)) == 1
+            assert not os.stat(cachedir).st_mode & 077
+
+            parse._script_cache.clear()
+            assert parse.compile_file(filename) == script2
+
+            # ...which isn't trusted if others can write to it.
+            path = os.path.abspath(filename)
+            st = os.stat(path)
+            key = (st.st_mtime, st.st_size)
+            assert parse._load_disk_cache(path, key) == script2
+            os.chmod(cachedir, 0777)
+            assert parse._load_disk_cache(path, key) is None
+        finally:
+            parse.cache_scripts_on_disk(False, old_cachedir)
+            for name in os.listdir(cachedir):
+                os.unlink(os.path.join(cachedir, name))
+            os.rmdir(cachedir)
+
+        # parse errors are only raised when the line is reached.
+        _write(filename, "setglobal reached 1\n!!! not a command\n")
+        os.utime(filename, (time.time() + 20, time.time() + 20))
+        try:
+            twill.execute_file(filename)
+            assert 0, "should not get here"
+        except parse.ParseException:
+            pass
+
+        from twill.namespaces import get_twill_glocals
+        global_dict, _ = get_twill_glocals()
+        assert global_dict['reached'] == '1'
+    finally:
+        for name in os.listdir(dirname):
+            os.unlink(os.path.join(dirname, name))
+        os.rmdir(dirname)
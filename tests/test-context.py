@@ -0,0 +1,137 @@
+"""
+Test twill execution contexts, and running scripts in threads.
+"""
+
+import os
+import tempfile
+import threading
+from cStringIO import StringIO
+
+import twill
+import twilltestlib
+from twill import commands
+from twill.context import TwillContext, get_context, set_context
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_contexts():
+    commands.reset_browser()
+    default = get_context()
+    seen = {}
+
+    def user(n):
+        context = TwillContext()
+        set_context(context)
+        commands.config('download_threshold', str(n))
+        commands.setglobal('who', str(n))
+        commands.go(url + 'multisubmitform')
+        seen[n] = (get_context() is context,
+                   commands.get_browser() is context.browser,
+                   context.options['download_threshold'],
+                   context.global_dict['who'],
+                   context.browser.get_url(),
+                   commands.browser is default.browser)
+
+    threads = [ threading.Thread(target=user, args=(n,))
+                for n in range(1, 4) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for n in range(1, 4):
+        assert seen[n][:4] == (True, True, n, str(n))
+        assert seen[n][4].endswith('/multisubmitform')
+        assert seen[n][5]         # (module-level names: the default's.)
+
+    # ...and none of it touched the default context.
+    assert get_context() is default
+    assert commands._options['download_threshold'] == 0
+    assert 'who' not in default.global_dict
+    assert commands.get_browser().get_url() is None
+
+def test_default_context():
+    # the module-level names are the default context's own objects.
+    commands.reset_browser()
+    default = get_context()
+    assert commands.browser is default.browser is twill.get_browser()
+    assert commands._options is default.options
+
+    browser = commands.browser
+    commands.reset_browser()
+    assert commands.browser is not browser
+    assert commands.browser is twill.get_browser()
+    assert commands._options is default.options
+
+    # ...and commands act on the current context's.
+    context = TwillContext()
+    old = set_context(context)
+    try:
+        assert twill.get_browser() is context.browser
+        assert commands.browser is default.browser
+        commands.reset_browser()
+        assert commands.browser is default.browser
+    finally:
+        set_context(old)
+
+def test_execute_in_context():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        fp = open(filename, 'w')
+        fp.write("go /multisubmitform\ncode 200\nshowforms\n"
+                 "echo done $who\n")
+        fp.close()
+
+        commands.reset_browser()
+        default = get_context()
+        contexts = [ TwillContext(out=StringIO()) for i in range(0, 5) ]
+        errors = []
+
+        def run(n, context):
+            try:
+                context.global_dict['who'] = str(n)
+                twill.execute_file(filename, initial_url=url,
+                                   context=context)
+                assert get_context() is default
+            except Exception, e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target=run, args=(n, context))
+                    for (n, context) in enumerate(contexts) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors, errors
+        for n, context in enumerate(contexts):
+            output = context.out.getvalue()
+            assert 'Form #1' in output
+            assert output.strip().endswith('done %d' % (n,))
+            assert context.browser.get_url().endswith('/multisubmitform')
+            assert not context.local_dict_stack
+
+        assert commands.get_browser().get_url() is None
+    finally:
+        os.unlink(filename)
+        os.rmdir(dirname)
+
+def test_output():
+    context = TwillContext(out=StringIO(), err=StringIO())
+    old = set_context(context)
+    try:
+        twill.set_output(None)
+        assert context.out is None
+        fp = StringIO()
+        twill.set_output(fp)
+        twill.set_errout(fp)
+        print>>commands.OUT, 'to out'
+        print>>commands.ERR, 'to err'
+        assert fp.getvalue() == 'to out\nto err\n'
+    finally:
+        set_context(old)
+
+    assert get_context().out is None
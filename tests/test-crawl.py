@@ -0,0 +1,165 @@
+"""
+Test the 'crawl' extension.
+"""
+
+import threading
+from cStringIO import StringIO
+
+import twill
+from twill import commands
+from twill.errors import TwillAssertionError
+
+_requests = []
+
+pages = {
+    '/' : '<a href="/a">a</a> <a href="b#top">b</a> <a href="/missing">x</a>'
+          '<a href="http://elsewhere/">elsewhere</a> <img src="/logo.png">',
+    '/a' : '<a href="/c">c</a> <a href="/">home</a>',
+    '/b' : '<frameset><frame src="/a"></frameset>',
+    '/c' : '<a href="/d">d</a>',
+    '/d' : '<a href="/">home</a>',
+    '/broken' : '<a href="/gzip">gzip</a> <a href="/error">error</a>'
+                '<a href="/a">a</a>',
+    '/redirects' : '<a href="/moved">moved</a> <a href="/away">away</a>',
+    }
+
+redirects = { '/moved' : '/c',
+              '/away' : 'http://elsewhere/' }
+
+def site_app(environ, start_response):
+    path = environ['PATH_INFO']
+    _requests.append((path, environ.get('HTTP_REFERER')))
+
+    if path == '/gzip':                 # says it's gzipped, but isn't.
+        start_response('200 OK', [('Content-type', 'text/html'),
+                                  ('Content-Encoding', 'gzip')])
+        return ['<html><body>not gzipped</body></html>']
+    if path == '/error':
+        raise ValueError("broken app")
+    if path in redirects:
+        start_response('302 Found', [('Location', redirects[path])])
+        return ['']
+    if path == '/logo.png':
+        start_response('200 OK', [('Content-type', 'image/png')])
+        return ['\x89PNG' + '.' * 1000]
+    if path not in pages:
+        start_response('404 Not Found', [('Content-type', 'text/plain')])
+        return ['not found\n']
+
+    start_response('200 OK', [('Content-type', 'text/html')])
+    return ['<html><body>%s</body></html>' % (pages[path],)]
+
+def setup_module():
+    global crawl
+    twill.add_wsgi_intercept('crawlhost', 80, lambda: site_app)
+    commands.extend_with('crawl')
+    import crawl
+
+def teardown_module():
+    twill.remove_wsgi_intercept('crawlhost', 80)
+    commands.reset_browser()
+    twill.set_output(None)
+
+def test_crawl():
+    commands.reset_browser()
+    out = StringIO()
+    twill.set_output(out)
+
+    del _requests[:]
+    try:
+        crawl.crawl('http://crawlhost/')
+        assert 0, "should have failed on /missing"
+    except TwillAssertionError:
+        pass
+
+    # breadth-first, two levels down, on this site only, each URL once.
+    paths = [ path for (path, referrer) in _requests ]
+    assert paths[0] == '/'
+    assert sorted(paths) == ['/', '/a', '/b', '/c', '/missing']
+    assert ('/c', 'http://crawlhost/a') in _requests
+
+    output = out.getvalue()
+    assert 'http://crawlhost/missing (404) (linked from http://crawlhost/)' \
+           in output
+    assert 'crawled 5 URLs' in output
+
+    # a pattern, resources, and a limit on the number of pages.
+    commands.config('crawl.resources', '1')
+    commands.config('crawl.max_pages', '3')
+    del _requests[:]
+    crawl.crawl('http://crawlhost/', '1',
+                '^http://crawlhost/(a|logo.png)?$')
+    assert sorted([ path for (path, r) in _requests ]) == \
+           ['/', '/a', '/logo.png']
+    assert '      1004' in out.getvalue()     # the image's size.
+
+def test_bad_pages():
+    commands.reset_browser()
+    out = StringIO()
+    twill.set_output(out)
+
+    # pages that can't be read, or that break the app, are reported as
+    # failures rather than stopping the crawl.
+    outcome = []
+    def run():
+        try:
+            crawl.crawl('http://crawlhost/broken', '1')
+        except TwillAssertionError:
+            outcome.append('failed')
+
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    t.join(10)
+    assert not t.isAlive(), "crawl hung"
+    assert outcome == ['failed']
+
+    output = out.getvalue()
+    assert 'Could not fetch 2 URLs' in output
+    assert 'http://crawlhost/error (ValueError: broken app)' in output
+    assert 'http://crawlhost/gzip (' in output
+    assert 'crawled 4 URLs' in output
+
+def test_redirects():
+    commands.reset_browser()
+    out = StringIO()
+    twill.set_output(out)
+
+    # redirects are only followed within the crawl's scope, and don't
+    # count as a level.
+    del _requests[:]
+    crawl.crawl('http://crawlhost/redirects', '1')
+    assert sorted([ path for (path, r) in _requests ]) == \
+           ['/away', '/c', '/moved', '/redirects']
+    assert ('/c', 'http://crawlhost/moved') in _requests
+    assert 'crawled 4 URLs' in out.getvalue()
+
+def test_frontier_limit():
+    commands.reset_browser()
+    out = StringIO()
+    twill.set_output(out)
+
+    # links found while too many URLs are waiting are skipped.
+    commands.config('crawl.max_queued', '1')
+    del _requests[:]
+    crawl.crawl('http://crawlhost/', '1')
+    assert [ path for (path, r) in _requests ] == ['/', '/a']
+    assert 'skipped 2 links' in out.getvalue()
+
+def test_visited_set():
+    visited = crawl.VisitedSet(expected=100)
+
+    # (a new URL is very occasionally taken to be there already.)
+    urls = [ 'http://host/%d' % (i,) for i in range(0, 2000) ]
+    added = len([ url for url in urls if visited.add(url) ])
+    assert added > 1990, added
+    assert len(visited.filters) > 1      # it grew.
+
+    # ...but the URLs that are there are never missed.
+    for url in urls:
+        assert url in visited
+        assert not visited.add(url)
+
+    others = [ 'http://other/%d' % (i,) for i in range(0, 10000) ]
+    false_positives = len([ url for url in others if url in visited ])
+    assert false_positives < 10, false_positives
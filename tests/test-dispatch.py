@@ -0,0 +1,81 @@
+"""
+Test direct command dispatch in twill.parse.
+"""
+
+import traceback
+
+import twill
+from twill import parse, namespaces
+from twill.errors import TwillNameError
+
+def _fail(*args):
+    raise ValueError("failed with %s" % (args,))
+
+def test_dispatch():
+    assert parse.command_table['go'] is twill.commands.go
+    assert 'fv' in parse.command_list
+
+    namespaces.new_local_dict()
+    try:
+        gd, ld = namespaces.get_twill_glocals()
+
+        # local variables don't shadow commands.
+        ld['echo'] = 'not a function'
+        parse.execute_command('echo', ('hello',), gd, ld, 'dispatch:1')
+        assert ld['__cmd__'] == 'echo'
+        assert ld['__args__'] == ('hello',)
+
+        try:
+            parse.execute_command('no_such_cmd', (), gd, ld, 'dispatch:2')
+            assert 0, "should not get here"
+        except TwillNameError:
+            pass
+
+        parse.register_command('always_fail', _fail)
+        try:
+            parse.execute_command('always_fail', ('x',), gd, ld, 'dispatch:3')
+            assert 0, "should not get here"
+        except ValueError:
+            tb = traceback.format_exc()
+            assert 'File "dispatch:3"' in tb, tb
+
+        assert parse._get_trampoline('dispatch:3') is \
+               parse._get_trampoline('dispatch:3')
+    finally:
+        namespaces.pop_local_dict()
+        del parse.command_table['always_fail']
+        parse.command_list.remove('always_fail')
+
+    # the trampolines don't pile up in processes that run many scripts.
+    old_max = parse._max_trampolines
+    parse._max_trampolines = 2
+    try:
+        for i in range(5):
+            parse._get_trampoline('dispatch:%d' % (10 + i,))
+        assert len(parse._trampolines) <= 2
+    finally:
+        parse._max_trampolines = old_max
+
+def test_url():
+    # __url__ is looked up by the arguments that use it, not after every
+    # command.
+    browser = twill.commands.browser
+    calls = []
+    def get_url():
+        calls.append(1)
+        return 'http://example.com/'
+    browser.get_url = get_url
+
+    namespaces.new_local_dict()
+    try:
+        gd, ld = namespaces.get_twill_glocals()
+        parse.execute_command('echo', ('hello',), gd, ld, 'dispatch:1')
+        assert calls == []
+
+        args = parse.process_args(['__url__', '${__url__}x', '$__url__'],
+                                  gd, ld)
+        assert args == ['http://example.com/', 'http://example.com/x',
+                        'http://example.com/']
+    finally:
+        namespaces.pop_local_dict()
+        del browser.get_url
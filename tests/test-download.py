@@ -0,0 +1,80 @@
+"""
+Test streaming downloads & the 'download_threshold' option.
+"""
+
+import os
+import hashlib
+import tempfile
+
+import twill
+from twill import commands, utils
+
+_body = ''.join([ '%08d\n' % (i,) for i in range(20000) ])
+
+def export_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/csv')]
+    if environ['PATH_INFO'] == '/sized':
+        response_headers.append(('Content-length', str(len(_body))))
+    start_response(status, response_headers)
+
+    return [ _body[i:i + 4096] for i in range(0, len(_body), 4096) ]
+
+def setup_module():
+    twill.add_wsgi_intercept('localhost', 80, lambda: export_app)
+
+def test_download():
+    commands.reset_browser()
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        digest = commands.download('http://localhost:80/export', filename)
+        commands.code(200)
+        commands.url('/export')
+        commands.info()
+
+        assert digest == hashlib.sha1(_body).hexdigest()
+        assert open(filename).read() == _body
+
+        result = commands.browser.result
+        assert isinstance(result, utils.DownloadResult)
+        assert result.size == len(_body)
+        assert result.get_page() == ''
+    finally:
+        os.unlink(filename)
+
+def test_threshold():
+    commands.reset_browser()
+    commands.config('download_threshold', '1000')
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for path in ('/sized', '/chunked'):
+            commands.go('http://localhost:80' + path)
+            commands.code(200)
+
+            result = commands.browser.result
+            assert isinstance(result, utils.DownloadResult)
+            assert result.temporary
+            assert result.size == len(_body)
+
+            commands.save_html(filename)
+            assert open(filename).read() == _body
+
+        # small pages are handled as usual.
+        commands.config('download_threshold', str(len(_body) + 1))
+        commands.go('http://localhost:80/chunked')
+        assert not isinstance(commands.browser.result, utils.DownloadResult)
+        commands.find('00019999')
+
+        commands.back()
+        commands.back()
+        commands.url('/sized')
+    finally:
+        os.unlink(filename)
+        commands.config('download_threshold', '0')
+
+def teardown_module():
+    twill.remove_wsgi_intercept('localhost', 80)
+    commands.reset_browser()
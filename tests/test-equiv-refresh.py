@@ -6,3 +6,42 @@ def test():
         
     twilltestlib.execute_twill_script('test-equiv-refresh.twill',
                                       initial_url=url)
+
+def refresh_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/html')]
+    start_response(status, response_headers)
+
+    path = environ['PATH_INFO']
+    if path == '/loop_a':
+        target = '/loop_b'
+    elif path == '/loop_b':
+        target = 'http://localhost:80/loop_a'
+    elif path.startswith('/chain'):
+        target = '/chain%d' % (int(path[6:] or 0) + 1,)
+    else:
+        return ['<html><body>no refresh here</body></html>']
+
+    return ['<html><head><meta http-equiv="Refresh" content="0; url=%s">'
+            '</head><body>at %s</body></html>' % (target, path)]
+
+def test_refresh_loops():
+    from twill import commands
+    import twill
+
+    twill.add_wsgi_intercept('localhost', 80, lambda: refresh_app)
+    try:
+        commands.go('http://localhost:80/loop_a')
+        commands.find('at /loop_b')
+
+        commands.config('equiv_refresh_max_hops', '5')
+        commands.go('http://localhost:80/chain')
+        commands.find('at /chain5')
+        commands.url('/chain5$')
+
+        # pages without a refresh aren't parsed just to look for one.
+        commands.go('http://localhost:80/plain')
+        assert not commands.browser.result._parsed
+    finally:
+        commands.config('equiv_refresh_max_hops', '10')
+        twill.remove_wsgi_intercept('localhost', 80)
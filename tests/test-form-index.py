@@ -0,0 +1,69 @@
+"""
+Test the per-form field index used by formvalue/submit.
+"""
+
+import twill
+from twill import commands
+from twill.errors import TwillException
+
+def form_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/html')]
+    start_response(status, response_headers)
+
+    fields = [ '<input type=text name=field%d id=id%d>' % (i, i)
+               for i in range(200) ]
+    options = [ '<option value=opt%d>option %d</option>' % (i, i)
+                for i in range(50) ]
+
+    return ['<html><body><form name=big method=POST>',
+            "\n".join(fields),
+            '<select name=sel multiple>', "\n".join(options), '</select>',
+            '<input type=checkbox name=cb value=a>',
+            '<input type=checkbox name=cb value=b>',
+            '<input type=submit name=go value=go>',
+            '</form></body></html>']
+
+def test_form_index():
+    twill.add_wsgi_intercept('localhost', 80, lambda: form_app)
+    try:
+        commands.go('http://localhost:80/')
+        browser = commands.browser
+        form = browser.get_form('big')
+
+        index = browser.get_form_index(form)
+        assert index is browser.get_form_index(form)
+        assert len(index.by_name) == 203
+        assert [ c.name for c in index.submits ] == ['go']
+
+        assert browser.get_form_field(form, 'field10').get('id') == 'id10'
+        assert browser.get_form_field(form, 'id11').name == 'field11'
+        assert browser.get_form_field(form, '1').name == 'field0'
+        assert browser.get_form_field(form, 'd199$').name == 'field199'
+        assert 'd199$' in index._regexp_cache
+
+        group = browser.get_form_field(form, 'cb')
+        assert group is browser.get_form_field(form, 'cb')
+
+        try:
+            browser.get_form_field(form, 'field1.*')
+            assert 0, "should be ambiguous"
+        except TwillException:
+            pass
+
+        commands.fv('big', 'field5', 'hello')
+        commands.fv('big', 'sel', 'option 3')
+        commands.fv('big', 'sel', 'opt4')
+        commands.fv('big', 'sel', '-opt4')
+        commands.fv('big', 'cb', 'b')
+        try:
+            commands.fv('big', 'sel', 'no such option')
+            assert 0, "should not be able to set an invalid value"
+        except TwillException:
+            pass
+
+        assert form.fields['field5'] == 'hello'
+        assert list(form.fields['sel']) == ['opt3']
+        assert list(group.value) == ['b']
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
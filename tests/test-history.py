@@ -0,0 +1,67 @@
+"""
+Test the bounded, compressed browser history.
+"""
+
+import twill
+from twill import commands
+from twill.browser import CompressedPage
+
+def page_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/html')]
+    start_response(status, response_headers)
+
+    path = environ['PATH_INFO']
+    return ['<html><head><title>page %s</title></head>' % (path,),
+            '<body><a href="/next">next</a>' + 'x' * 10000 + '</body></html>']
+
+def setup_module():
+    twill.add_wsgi_intercept('localhost', 80, lambda: page_app)
+
+def test_history_compressed():
+    commands.reset_browser()
+    browser = commands.browser
+
+    for i in range(5):
+        commands.go('http://localhost:80/%d' % (i,))
+
+    history = commands.showhistory()
+    assert len(history) == 4
+    pages = list(history)
+    assert isinstance(pages[0], CompressedPage)
+    assert not isinstance(pages[-1], CompressedPage)
+    assert pages[0].get_url() == 'http://localhost:80/0'
+    assert history.get_size() < 4 * 10000
+
+    for i in (3, 2, 1, 0):
+        commands.back()
+        commands.url('/%d$' % (i,))
+        commands.title('page /%d' % (i,))
+        commands.find('xxxx')
+
+    assert len(browser._history) == 0
+
+def test_history_bounded():
+    commands.reset_browser()
+    commands.config('history_max_pages', '3')
+
+    for i in range(10):
+        commands.go('http://localhost:80/%d' % (i,))
+
+    assert len(commands.browser._history) == 3
+    commands.back()
+    commands.back()
+    commands.back()
+    commands.url('/6$')
+    commands.back()
+    commands.url('/6$')
+
+    commands.config('history_max_pages', '0')
+    commands.config('history_max_bytes', '100')
+    for i in range(10):
+        commands.go('http://localhost:80/%d' % (i,))
+    assert len(commands.browser._history) == 1
+
+def teardown_module():
+    twill.remove_wsgi_intercept('localhost', 80)
+    commands.reset_browser()
@@ -0,0 +1,54 @@
+"""
+Test that pages are only parsed on demand, and never if they're not HTML.
+"""
+
+import twill
+from twill import commands
+
+def json_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'application/json')]
+    start_response(status, response_headers)
+
+    return ['{"form": "<form><input name=\'a\'></form>"}']
+
+def html_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/html; charset=utf-8')]
+    start_response(status, response_headers)
+
+    return ['<html><head><title>lazy</title></head><body>',
+            '<a href="/a">a link</a><form><input name="x"></form>',
+            '</body></html>']
+
+def test_not_html():
+    twill.add_wsgi_intercept('localhost', 80, lambda: json_app)
+    try:
+        commands.go('http://localhost:80/')
+        commands.code(200)
+        commands.find('form')
+
+        result = commands.browser.result
+        assert not result.is_html()
+        assert result.get_forms() == []
+        assert result.get_links() == []
+        assert result._lxml is None
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+def test_parse_on_demand():
+    twill.add_wsgi_intercept('localhost', 80, lambda: html_app)
+    try:
+        commands.go('http://localhost:80/')
+        commands.code(200)
+        commands.find('a link')
+
+        result = commands.browser.result
+        assert not result._parsed, "page parsed before anyone asked"
+
+        commands.title('lazy')
+        assert result._parsed
+        assert len(result.get_forms()) == 1
+        assert result.get_forms() is result.get_forms()
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
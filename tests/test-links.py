@@ -0,0 +1,55 @@
+"""
+Test the per-page link index.
+"""
+
+import twill
+from twill import commands
+from twill.utils import normalize_url
+
+def links_app(environ, start_response):
+    status = '200 OK'
+    response_headers = [('Content-type', 'text/html')]
+    start_response(status, response_headers)
+
+    if environ['PATH_INFO'] != '/':
+        return ['<html><body>at %s</body></html>' % (environ['PATH_INFO'],)]
+
+    return ['''<html><head><title>links</title></head><body>
+<a name="top">no href</a>
+<a href="/first#frag"><b>bold</b> text</a>
+<a href="second">second link</a>
+<a href="http://LOCALHOST:80/third">third</a>
+</body></html>''']
+
+def test_normalize_url():
+    assert normalize_url('HTTP://Example.COM') == 'http://example.com/'
+    assert normalize_url('../b?x=1#y', 'http://a/c/d') == 'http://a/b?x=1'
+
+def test_link_index():
+    twill.add_wsgi_intercept('localhost', 80, lambda: links_app)
+    try:
+        commands.go('http://localhost:80/')
+
+        index = commands.browser.result.get_link_index()
+        assert index is commands.browser.result.get_link_index()
+        assert len(index) == 4
+
+        links = commands.browser.get_all_links()
+        assert links[0] == ('no href', None)
+        assert links[1] == ('bold text', '/first#frag')
+
+        assert index.get_by_text('bold text') == 'http://localhost:80/first'
+        assert index.get_by_url('second') == 'http://localhost:80/second'
+        assert index.find('third') == 'http://localhost:80/third'
+        assert index.find('nothing') == ''
+        assert 'third' in index._pattern_cache
+
+        commands.follow('bold')
+        commands.url('/first$')
+        commands.find('at /first')
+        commands.back()
+
+        commands.follow('second link')
+        commands.find('at /second')
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
@@ -0,0 +1,283 @@
+"""
+Test the open-model load generation used by 'twill-fork --rate'.
+"""
+
+import os
+import time
+import select
+import tempfile
+from cStringIO import StringIO
+from cPickle import load, dump
+
+import twilltestlib
+from twill import loadgen, stats, wsgi_intercept
+from twill.browser import TwillBrowser
+from twill.errors import TwillException
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_parse_profile():
+    profile = loadgen.parse_profile("""
+# shape  duration  rate  [end rate]
+step     30        10/s
+ramp     2m        10    50/s   # ramp up
+spike    10s       600/m
+soak     1h        5
+""".splitlines())
+    assert profile == [ ('step', 30., 10., 10.),
+                        ('ramp', 120., 10., 50.),
+                        ('spike', 10., 10., 10.),
+                        ('soak', 3600., 5., 5.) ]
+
+    for bad in ('jump 10 10', 'step 10', 'step 10 10 20', 'step x 10'):
+        try:
+            loadgen.parse_profile([bad])
+            assert 0, "should not get here: %s" % (bad,)
+        except TwillException:
+            pass
+
+def test_arrival_times():
+    times = list(loadgen.arrival_times([('step', 2., 10., 10.)], 100.))
+    assert len(times) == 20
+    assert times[0] == 100. and abs(times[1] - 100.1) < 1e-9
+
+    # ramps: the number of arrivals is the area under the rate.
+    times = list(loadgen.arrival_times([('ramp', 10., 0., 20.)]))
+    assert abs(len(times) - 100) <= 1
+    assert times == sorted(times)
+    gaps = [ b - a for (a, b) in zip(times, times[1:]) ]
+    assert gaps[0] > gaps[-1]           # speeding up.
+
+    times = list(loadgen.arrival_times([('ramp', 10., 20., 0.)]))
+    assert abs(len(times) - 100) <= 1
+    assert max(times) < 10.
+
+    # stages follow each other.
+    times = list(loadgen.arrival_times([('step', 1., 2., 2.),
+                                        ('step', 1., 0., 0.),
+                                        ('step', 1., 1., 1.)]))
+    assert times == [0., 0.5, 2.]
+
+def test_run_profile():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        fp = open(filename, 'w')
+        fp.write("go /\ncode 200\n")
+        fp.close()
+
+        reports = []
+        def report(request_stats, elapsed):
+            reports.append(len(request_stats))
+
+        request_stats, elapsed, n_started = \
+                       loadgen.run_profile([filename],
+                                           [('step', 1., 10., 10.)], 2,
+                                           initial_url=url,
+                                           report_interval=0.2,
+                                           report=report)
+        assert n_started == 10
+        assert elapsed >= 0.9
+        assert reports
+
+        iterations = request_stats.histograms[('<iteration>', filename)]
+        assert iterations.count == 10
+        assert request_stats.n_errors() == 0
+        assert len(request_stats) >= 10
+
+        # without a report callback, the parent still just waits: about
+        # one wakeup per arrival, result and report.
+        calls = []
+        real_select = select.select
+        def counting_select(*args):
+            calls.append(1)
+            return real_select(*args)
+
+        select.select = counting_select
+        try:
+            request_stats, elapsed, n_started = \
+                           loadgen.run_profile([filename],
+                                               [('step', 1., 10., 10.)], 2,
+                                               initial_url=url,
+                                               report_interval=0.2)
+        finally:
+            select.select = real_select
+        assert n_started == 10
+        assert len(calls) < 50, len(calls)
+    finally:
+        os.unlink(filename)
+        os.rmdir(dirname)
+
+def test_worker_browser():
+    # workers don't share the parent's browser, or its connections.
+    from twill import commands
+    from twill.utils import start_worker
+
+    commands.go(url)
+    def run_job(job):
+        return job, commands.browser.get_url()
+
+    pid, job_fp, result_fp = start_worker(run_job)
+    try:
+        dump('x', job_fp, 2)
+        job_fp.flush()
+        assert load(result_fp) == ('x', None)
+        assert commands.browser.get_url() == url
+    finally:
+        dump(None, job_fp, 2)
+        job_fp.close()
+        os.waitpid(pid, 0)
+        result_fp.close()
+        commands.reset_browser()
+
+def test_parse_scenarios():
+    scenarios = loadgen.parse_scenarios("""
+# name     weight  script(s)        [options]
+browse     70      browse.twill     think=exp:2
+search     25      search.twill     think=uniform:1:3
+checkout   5       cart.twill pay.twill  users=2 think=0.5
+""".splitlines(), '/scripts')
+
+    assert [ s.name for s in scenarios ] == ['browse', 'search', 'checkout']
+    assert [ s.weight for s in scenarios ] == [70., 25., 5.]
+    assert scenarios[2].filenames == ['/scripts/cart.twill',
+                                      '/scripts/pay.twill']
+    assert scenarios[2].users == 2 and scenarios[0].users is None
+    assert scenarios[2].think_time() == 0.5
+    assert 1 <= scenarios[1].think_time() <= 3
+
+    for bad in ('browse', 'browse 1', 'browse x a.twill',
+                'browse 1 a.twill think=poisson:1',
+                'browse 1 a.twill color=blue'):
+        try:
+            loadgen.parse_scenarios([bad])
+            assert 0, "should not get here: %s" % (bad,)
+        except TwillException:
+            pass
+
+def test_pick_scenario():
+    import random
+    random.seed(1)
+
+    scenarios = [ loadgen.Scenario(name, [name], weight)
+                  for (name, weight) in (('a', 70), ('b', 25), ('c', 5),
+                                         ('never', 0)) ]
+    counts = dict([ (s.name, 0) for s in scenarios ])
+    for i in range(10000):
+        counts[loadgen.pick_scenario(scenarios).name] += 1
+
+    assert counts['never'] == 0
+    assert 6700 < counts['a'] < 7300
+    assert 2200 < counts['b'] < 2800
+    assert 350 < counts['c'] < 650
+
+    # processes for closed-loop runs.
+    scenarios[2].users = 2
+    choices = loadgen.assign_scenarios(scenarios, 3)
+    assert len(choices) == 5
+    assert choices[:2] == [[scenarios[2]], [scenarios[2]]]
+    assert choices[2] == [scenarios[0], scenarios[1], scenarios[3]]
+
+def test_run_scenarios():
+    dirname = tempfile.mkdtemp()
+    try:
+        for name, text in (('a', "go /\n"), ('b', "go /multisubmitform\n")):
+            fp = open(os.path.join(dirname, name), 'w')
+            fp.write(text)
+            fp.close()
+
+        scenarios = loadgen.parse_scenarios(["one 3 a think=0.01",
+                                             "two 1 b users=1"], dirname)
+        request_stats, elapsed, total_time, total_exec, failed = \
+                       loadgen.run_closed(None, 8, 1, initial_url=url,
+                                          scenarios=scenarios)
+        assert not failed
+        assert total_exec == 8
+
+        iterations = [ request_stats.histograms[('<iteration>', name)].count
+                       for name in ('one', 'two') ]
+        assert sum(iterations) == 8
+        assert iterations[1] == 4       # half of the runs, in its own process.
+        assert ('two:go', url.rstrip('/') + '/multisubmitform') in \
+               request_stats.histograms
+    finally:
+        for name in os.listdir(dirname):
+            os.unlink(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
+def slow_app(environ, start_response):
+    time.sleep(0.01)
+    start_response('200 OK', [('Content-type', 'text/html')])
+    yield '<html><body><a href="/page/2">next</a></body></html>'
+    time.sleep(0.01)                    # (the body counts too.)
+
+def test_intercept_app():
+    assert loadgen.load_app('os.path:join') is os.path.join
+    for spec in ('no_such_module:app', 'os.path:no_such_app'):
+        try:
+            loadgen.load_app(spec)
+            assert 0, "should have failed on %s" % (spec,)
+        except TwillException:
+            pass
+
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    loadgen.intercept_app(slow_app, 'benchhost', 80, processes=2)
+    try:
+        fp = open(filename, 'w')
+        fp.write("go http://benchhost/page/1\nfollow next\ncode 200\n")
+        fp.close()
+
+        request_stats, elapsed, total_time, total_exec, failed = \
+                       loadgen.run_closed([filename], 4, 2)
+        assert not failed
+        assert total_exec == 4
+
+        # the app is timed per URL pattern, apart from the requests.
+        h = request_stats.histograms[('<app>', 'http://benchhost/page/:n')]
+        assert h.count == 8
+        assert h.percentile(50) >= 0.02, h.percentile(50)
+        assert len(request_stats) == 8
+
+        app_time = stats.app_time(request_stats)
+        assert 0.16 <= app_time < total_time, (app_time, total_time)
+    finally:
+        wsgi_intercept.remove_wsgi_intercept('benchhost', 80)
+        wsgi_intercept.multiprocess = False
+        os.unlink(filename)
+        os.rmdir(dirname)
+
+def file_app(environ, start_response):
+    data = 'x' * 100000
+    start_response('200 OK', [('Content-type', 'text/plain'),
+                              ('Content-Length', str(len(data)))])
+    return environ['wsgi.file_wrapper'](StringIO(data))
+
+def test_intercept_file_wrapper():
+    made = []
+    def response_file(*args, **kwargs):
+        made.append(kwargs.get('filelike', args[2:3] and args[2]))
+        return wsgi_response_file(*args, **kwargs)
+
+    wsgi_response_file = wsgi_intercept.wsgi_response_file
+    wsgi_intercept.wsgi_response_file = response_file
+    loadgen.intercept_app(file_app, 'benchhost', 80)
+    try:
+        browser = TwillBrowser()
+        request_stats = stats.start_recording()
+        try:
+            browser.go('http://benchhost/export')
+        finally:
+            stats.stop_recording()
+        assert len(browser.get_html()) == 100000
+
+        # the file is read directly, as without the timing, but timed.
+        assert isinstance(made[0], loadgen._TimedFile), made
+        h = request_stats.histograms[('<app>', 'http://benchhost/export')]
+        assert h.count == 1
+    finally:
+        wsgi_intercept.wsgi_response_file = wsgi_response_file
+        wsgi_intercept.remove_wsgi_intercept('benchhost', 80)
+
@@ -0,0 +1,85 @@
+"""
+Test parallel execution of script files ('twill-sh -j N').
+"""
+
+import os
+import time
+import select
+import tempfile
+
+from twill import shell
+
+def _write(filename, text):
+    fp = open(filename, 'w')
+    fp.write(text)
+    fp.close()
+
+def test_schedule_files():
+    durations = { os.path.abspath('a') : 1.0,
+                  os.path.abspath('b') : 5.0 }
+    assert shell.schedule_files(['a', 'b', 'c', 'd'], durations) == \
+           ['c', 'd', 'b', 'a']
+
+def test_execute_files_parallel():
+    dirname = tempfile.mkdtemp()
+    durations_filename = os.path.join(dirname, 'durations')
+
+    good = [ os.path.join(dirname, 'good%d.twill' % (i,)) for i in range(4) ]
+    bad = os.path.join(dirname, 'bad.twill')
+    try:
+        for filename in good:
+            _write(filename, "setlocal x 1\n")
+        _write(bad, "!!! not a command\n")
+
+        success, failure, not_run = \
+                 shell.execute_files_parallel(good + [bad], 2,
+                                     durations_filename=durations_filename)
+        assert sorted(success) == sorted(good)
+        assert failure == [bad]
+        assert not_run == []
+
+        durations = shell.load_durations(durations_filename)
+        for filename in good + [bad]:
+            assert os.path.abspath(filename) in durations
+
+        # fail fast: with one worker and the failing file scheduled first,
+        # nothing else runs.
+        durations[os.path.abspath(bad)] = 100.
+        shell.save_durations(durations, durations_filename)
+
+        success, failure, not_run = \
+                 shell.execute_files_parallel(good + [bad], 1, fail_fast=True,
+                                     durations_filename=durations_filename)
+        assert failure == [bad]
+        assert len(success) + len(not_run) == len(good)
+
+        # ...but files that other workers have finished still count: let
+        # both workers finish, and hand back the failure first.
+        calls = []
+        real_select = select.select
+        def slow_select(rlist, *args):
+            if not calls:
+                calls.append(1)
+                time.sleep(0.5)
+                return [rlist[0]], [], []   # the first job: the bad file.
+            return real_select(rlist, *args)
+
+        shell.save_durations({ os.path.abspath(bad) : 100.,
+                               os.path.abspath(good[0]) : 1. },
+                             durations_filename)
+
+        select.select = slow_select
+        try:
+            success, failure, not_run = \
+                     shell.execute_files_parallel([good[0], bad], 2,
+                                     fail_fast=True,
+                                     durations_filename=durations_filename)
+        finally:
+            select.select = real_select
+        assert failure == [bad]
+        assert success == [good[0]]
+        assert not_run == []
+    finally:
+        for name in os.listdir(dirname):
+            os.unlink(os.path.join(dirname, name))
+        os.rmdir(dirname)
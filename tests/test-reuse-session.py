@@ -0,0 +1,67 @@
+"""
+Test resetting the browser while keeping its HTTP session & connections.
+"""
+
+import os
+import tempfile
+
+import twilltestlib
+import twill
+from twill import commands, browser
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_reuse_session():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        fp = open(filename, 'w')
+        fp.write("go /\ncode 200\nadd_extra_header X-Test 1\n")
+        fp.close()
+
+        twill.execute_file(filename, initial_url=url)
+        b = commands.browser
+        session = b._session
+        adapter = session.get_adapter(url)
+        session.cookies.set('visited', 'yes')
+
+        twill.execute_file(filename, initial_url=url, reuse_session=True)
+        assert commands.browser is b
+        assert b._session is session
+        assert session.get_adapter(url) is adapter
+        assert 'visited' not in session.cookies
+        assert len(b._history) == 0
+
+        # a plain reset throws the session away.
+        twill.execute_file(filename, initial_url=url)
+        assert commands.browser is not b
+    finally:
+        os.unlink(filename)
+        os.rmdir(dirname)
+
+def test_reset():
+    commands.reset_browser()
+    b = commands.browser
+    b.go(url)
+    b._session.headers['X-Test'] = '1'
+    b.reset()
+
+    assert b.get_url() is None
+    assert 'X-Test' not in b._session.headers
+    assert b._session.headers['Accept'] == 'text/html; */*'
+
+def test_pool_size():
+    b = browser.TwillBrowser()
+    b.set_pool_size(3, 'localhost:8080')
+    adapter = b._session.get_adapter('http://localhost:8080/')
+    assert adapter._pool_maxsize == 3
+    assert b._session.get_adapter('http://example.com/') is not adapter
+
+    browser.pool_sizes[None] = 5
+    try:
+        b = browser.TwillBrowser()
+        assert b._session.get_adapter('http://example.com/')._pool_maxsize == 5
+    finally:
+        del browser.pool_sizes[None]
@@ -0,0 +1,90 @@
+"""
+Test the request timing statistics used by twill-fork.
+"""
+
+import time
+import cPickle
+
+import twilltestlib
+import twill
+from twill import stats
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_histogram():
+    h = stats.Histogram()
+    for i in range(1, 1001):
+        h.record(i / 1000.)             # 1ms .. 1s
+
+    assert h.count == 1000
+    assert h.max == 1.
+    for p in (50, 90, 99):
+        assert abs(h.percentile(p) - p / 100.) < 0.01 * p / 100. + 1e-6
+
+    # merging & pickling.
+    other = cPickle.loads(cPickle.dumps(h, 2))
+    assert other.counts == h.counts
+    other.record(5.)
+    h.merge(other)
+    assert h.count == 2001
+    assert h.max == 5.
+    assert abs(h.percentile(50) - 0.5) < 0.01
+
+    # out-of-range values are clamped to ~71 minutes, but max is exact.
+    h.record(10 ** 6)
+    assert h.max == 10 ** 6
+    assert 4200 < h.percentile(100) < 4400
+
+def test_url_pattern():
+    assert stats.url_pattern('http://Example.COM/users/123/edit?x=1#foo') == \
+           'http://example.com/users/:n/edit'
+    assert stats.url_pattern('http://example.com') == 'http://example.com/'
+
+def test_recording():
+    request_stats = stats.start_recording()
+    try:
+        twill.execute_string("""
+go %s
+go /does_not_exist
+""" % (url,), no_reset=False)
+    finally:
+        assert stats.stop_recording() is request_stats
+
+    assert len(request_stats) >= 2
+    commands = set([ command for (command, _) in request_stats.histograms ])
+    assert commands == set(['go'])
+    assert request_stats.n_errors() == 1
+
+    # nothing is recorded when not recording.
+    twill.execute_string("go %s" % (url,))
+    assert stats.recording is None
+
+def slow_body_app(environ, start_response):
+    start_response('200 OK', [('Content-type', 'text/html')])
+    yield '<html><body>'
+    time.sleep(0.2)                     # (after the headers are out.)
+    yield 'slow</body></html>'
+
+def test_body_time():
+    twill.add_wsgi_intercept('slowhost', 80, lambda: slow_body_app)
+    try:
+        # latencies include reading the body, streamed or not.
+        for threshold in ('0', '1000000'):
+            twill.commands.reset_browser()
+            twill.commands.config('download_threshold', threshold)
+            request_stats = stats.start_recording()
+            try:
+                twill.commands.go('http://slowhost/')
+            finally:
+                stats.stop_recording()
+            twill.commands.find('slow')
+
+            h = request_stats.total()
+            assert h.count == 1, threshold
+            assert h.max >= 0.2, (threshold, h.max)
+    finally:
+        twill.remove_wsgi_intercept('slowhost', 80)
+        twill.commands.reset_browser()
+
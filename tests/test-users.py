@@ -0,0 +1,59 @@
+"""
+Test the thread-based virtual users of 'twill-fork --users'.
+"""
+
+import os
+import tempfile
+
+import twilltestlib
+from twill import loadgen, commands, stats
+
+def setup_module():
+    global url
+    url = twilltestlib.get_url()
+
+def test_run_users():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'script')
+    try:
+        fp = open(filename, 'w')
+        fp.write("go /multisubmitform\ncode 200\n")
+        fp.close()
+
+        commands.reset_browser()
+        request_stats, elapsed, total_time, total_exec, failed = \
+                       loadgen.run_users([filename], 5, number=12,
+                                         initial_url=url)
+        assert not failed
+        assert total_exec == 12
+        assert request_stats.n_errors() == 0
+
+        pattern = stats.url_pattern(url + 'multisubmitform')
+        assert request_stats.histograms[('go', pattern)].count == 12
+        assert len(request_stats) == 24     # ...plus the initial URLs.
+
+        assert stats.get_recording() is None
+        assert commands.get_browser().get_url() is None
+
+        # a duration instead of a number of runs.
+        request_stats, elapsed, total_time, total_exec, failed = \
+                       loadgen.run_users([filename], 3, duration=0.5,
+                                         initial_url=url)
+        assert not failed
+        assert total_exec >= 3
+        assert elapsed >= 0.5
+
+        # a run that fails doesn't stop its user.
+        fp = open(filename, 'w')
+        fp.write("go /multisubmitform\ncode 404\n")
+        fp.close()
+
+        request_stats, elapsed, total_time, total_exec, failed = \
+                       loadgen.run_users([filename], 2, number=6,
+                                         initial_url=url)
+        assert failed
+        assert total_exec == 6
+        assert request_stats.errors[('<iteration>', filename)] == 6
+    finally:
+        os.unlink(filename)
+        os.rmdir(dirname)
@@ -7,6 +7,10 @@ try:
 except ImportError:
     wsgi_lint = lambda x: x             # ignore lack of paste.lint ;)
     
+import time
+import threading
+from cStringIO import StringIO
+
 import twill
 
 _app_was_hit = False
@@ -121,3 +125,248 @@ def test_iter_stuff():
     twill.commands.notfind("Hello, worldHello, world")
     print 'remove'
     twill.remove_wsgi_intercept('localhost', 80)
+
+####
+
+_apps_created = []
+
+def counting_app():
+    _apps_created.append(1)
+    return simple_app
+
+def chunked_app(environ, start_response):
+    """Stream the body, without a Content-Length."""
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    yield 'Hello, '
+    yield ''
+    yield 'chunked world'
+
+def _pool(url):
+    browser = twill.get_browser()
+    adapter = browser._session.get_adapter(url)
+    return adapter.poolmanager.connection_from_url(url)
+
+def test_app_cache():
+    del _apps_created[:]
+    twill.add_wsgi_intercept('localhost', 80, counting_app)
+    try:
+        twill.commands.reset_browser()
+        for i in range(0, 3):
+            twill.commands.go('http://localhost:80/')
+            twill.commands.find("WSGI intercept successful")
+
+        # one app, on one persistent connection.
+        assert len(_apps_created) == 1
+        pool = _pool('http://localhost:80/')
+        assert pool.num_connections == 1, pool.num_connections
+
+        # re-adding the intercept replaces the app, & reconnects to it.
+        twill.add_wsgi_intercept('localhost', 80, counting_app)
+        twill.commands.go('http://localhost:80/')
+        twill.commands.find("WSGI intercept successful")
+        assert len(_apps_created) == 2
+
+        # ...and without caching, every request gets a new app.
+        del _apps_created[:]
+        twill.add_wsgi_intercept('localhost', 80, counting_app,
+                                 cache_app=False)
+        twill.commands.go('http://localhost:80/')
+        twill.commands.go('http://localhost:80/')
+        assert len(_apps_created) == 2
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+def test_chunked():
+    twill.add_wsgi_intercept('localhost', 80, lambda: chunked_app)
+    try:
+        twill.commands.reset_browser()
+        twill.commands.go('http://localhost:80/')
+        browser = twill.get_browser()
+        assert browser.get_html() == 'Hello, chunked world'
+        assert browser.result.req.headers['transfer-encoding'] == 'chunked'
+
+        twill.commands.go('http://localhost:80/')
+        assert _pool('http://localhost:80/').num_connections == 1
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+####
+
+_chunks_made = []
+
+def big_app(environ, start_response):
+    """Stream a big body, a piece at a time."""
+    start_response('200 OK', [('Content-type', 'application/octet-stream'),
+                              ('Content-Length', str(100 * 65536))])
+    for i in range(0, 100):
+        _chunks_made.append(i)
+        yield 'x' * 65536
+
+class closing_file(object):
+    def __init__(self, data):
+        self.fp = StringIO(data)
+        self.closed = False
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def close(self):
+        self.closed = True
+
+_files = []
+
+def file_app(environ, start_response):
+    """Send a file, with wsgi.file_wrapper; echo back any POSTed data."""
+    if environ['REQUEST_METHOD'] == 'POST':
+        data = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    else:
+        data = 'file contents\n' * 1000
+    fp = closing_file(data)
+    _files.append(fp)
+
+    start_response('200 OK', [('Content-type', 'text/plain'),
+                              ('Content-Length', str(len(data)))])
+    return environ['wsgi.file_wrapper'](fp)
+
+def test_streaming():
+    twill.add_wsgi_intercept('localhost', 80, lambda: big_app)
+    try:
+        twill.commands.reset_browser()
+        session = twill.get_browser()._session
+
+        # the body is only produced as it's read.
+        del _chunks_made[:]
+        r = session.get('http://localhost:80/', stream=True)
+        data = r.raw.read(65536)
+        assert data == 'x' * 65536
+        assert len(_chunks_made) < 5, len(_chunks_made)
+
+        size = len(data)
+        for data in r.iter_content(65536):
+            size += len(data)
+        assert size == 100 * 65536
+        assert len(_chunks_made) == 100
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+def test_file_wrapper():
+    twill.add_wsgi_intercept('localhost', 80, lambda: file_app)
+    try:
+        twill.commands.reset_browser()
+        session = twill.get_browser()._session
+
+        del _files[:]
+        r = session.get('http://localhost:80/')
+        assert r.content == 'file contents\n' * 1000
+        assert _files[0].closed
+
+        # request bodies reach the app as they were sent.
+        body = ''.join([ chr(i % 256) for i in range(0, 100000) ])
+        r = session.post('http://localhost:80/', data=body)
+        assert r.content == body
+        assert _files[1].closed
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+####
+
+_environs = []
+
+def slow_create_app():
+    time.sleep(0.1)                     # (let other threads catch up.)
+    _apps_created.append(1)
+    return echo_app
+
+def echo_app(environ, start_response):
+    """Echo the path back, slowly, so that requests overlap."""
+    _environs.append(environ)
+    time.sleep(0.01)
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    return [environ['PATH_INFO']]
+
+def test_threads():
+    twill.commands.reset_browser()
+
+    del _apps_created[:]
+    del _environs[:]
+    twill.add_wsgi_intercept('localhost', 80, slow_create_app)
+    try:
+        session = twill.get_browser()._session
+        errors = []
+
+        def get_pages(n):
+            try:
+                for i in range(0, 10):
+                    path = '/%d/%d' % (n, i)
+                    r = session.get('http://localhost:80' + path)
+                    assert r.content == path, (r.content, path)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target=get_pages, args=(n,))
+                    for n in range(0, 8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors, errors
+        assert len(_apps_created) == 1  # ...shared by all the threads.
+        assert len(_environs) == 80
+        assert _environs[0]['wsgi.multithread']
+        assert not _environs[0]['wsgi.multiprocess']
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+def test_adapter():
+    import requests
+    from requests.packages.urllib3 import connectionpool as cpl
+    from twill import wsgi_intercept
+
+    twill.commands.reset_browser()
+    session = twill.get_browser()._session
+    other_session = requests.Session()
+
+    def adapter_for(url, session=session):
+        return isinstance(session.get_adapter(url),
+                          wsgi_intercept.WSGIAdapter)
+
+    # urllib3 itself is never patched.
+    assert cpl.HTTPConnectionPool.ConnectionCls is not \
+           wsgi_intercept.WSGI_HTTPConnection
+
+    twill.add_wsgi_intercept('localhost', 80, lambda: simple_app)
+    twill.add_wsgi_intercept('localhost', 8080, lambda: simple_app)
+    try:
+        # only the intercepted host:ports get the WSGI adapter...
+        assert adapter_for('http://localhost/')
+        assert adapter_for('http://LOCALHOST:80/foo')
+        assert adapter_for('http://localhost:8080/')
+        assert not adapter_for('http://localhost:8081/')
+        assert not adapter_for('http://example.com/')
+        assert not adapter_for('https://localhost/')
+
+        # ...and only in the sessions that asked for it.
+        assert not adapter_for('http://localhost/', other_session)
+
+        twill.commands.go('http://localhost:8080/')
+        twill.commands.find("WSGI intercept successful")
+
+        twill.remove_wsgi_intercept('localhost', 8080)
+        assert not adapter_for('http://localhost:8080/')
+        assert adapter_for('http://localhost/')
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
+
+    # once the last intercept is gone, so is the adapter.
+    assert not [ a for a in session.adapters.values()
+                 if isinstance(a, wsgi_intercept.WSGIAdapter) ]
+
+    # ...'til there's another.
+    twill.add_wsgi_intercept('localhost', 80, lambda: simple_app)
+    try:
+        assert adapter_for('http://localhost/')
+        twill.commands.go('http://localhost/')
+        twill.commands.find("WSGI intercept successful")
+    finally:
+        twill.remove_wsgi_intercept('localhost', 80)
@@ -28,7 +28,9 @@ __all__ = [ "TwillCommandLoop",
             "add_wsgi_intercept",
             "remove_wsgi_intercept",
             "set_output",
-            "set_errout"]
+            "set_errout",
+            "TwillContext",
+            "get_context"]
 
 #
 # add extensions (twill/extensions) and the the wwwsearch & pyparsing
@@ -54,6 +56,7 @@ from parse import execute_file, execute_string
 
 # convenience function or two...
 from commands import get_browser
+from context import TwillContext, get_context
 
 def get_browser_state():
     import warnings
@@ -71,18 +74,14 @@ from wsgi_intercept import add_wsgi_intercept, remove_wsgi_intercept
 def set_output(fp):
     """
     Have standard output from twill go to the given fp instead of
-    stdout.  fp=None will reset to stdout.
+    stdout.  fp=None will reset to stdout.  (This applies to the current
+    context; see twill.context.)
     """
-    import commands, browser
-    commands.OUT = browser.OUT = fp
+    get_context().out = fp
 
 def set_errout(fp):
     """
     Have error output from twill go to the given fp instead of stderr.
     fp=None will reset to stderr.
     """
-    import commands
-    if fp:
-        commands.ERR = fp
-    else:
-        commands.ERR = sys.stderr
+    get_context().err = fp
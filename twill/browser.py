@@ -2,20 +2,184 @@
 Implements TwillBrowser
 """
 
-OUT=None
-
 # Python imports
+import hashlib
+import os
 import pickle
 import re
+import tempfile
+import time
 import urlparse
+import zlib
 
 # Dependencies
 import requests
 from lxml import html
-from requests.exceptions import InvalidSchema, ConnectionError
-from utils import print_form, unique_match, _follow_equiv_refresh, ResultWrapper
+from requests.exceptions import InvalidSchema, ConnectionError, Timeout, \
+     RequestException
+import utils
+import stats
+import wsgi_intercept
+from context import OUT
+from utils import print_form, unique_match, normalize_url, \
+     _follow_equiv_refresh, _equiv_refresh_options, _history_limits, \
+     _download_threshold, ResultWrapper, DownloadResult, FormIndex
 from errors import TwillException
 
+# size of the chunks read from streamed responses.
+_chunk_size = 64 * 1024
+
+class CompressedPage(object):
+    """
+    A page in the browser history, stored as its compressed body plus
+    the URL, status code and headers needed to rebuild it.
+    """
+    def __init__(self, result):
+        req = result.req
+        self.url = req.url
+        self.status_code = req.status_code
+        self.headers = dict(req.headers)
+        self.encoding = req.encoding
+        self.body = zlib.compress(req.content, 1)
+
+    def get_url(self):
+        return self.url
+
+    def get_size(self):
+        return len(self.body) + len(self.url)
+
+    def restore(self):
+        """
+        Rebuild a ResultWrapper for this page; it is parsed lazily, as usual.
+        """
+        r = requests.Response()
+        r._content = zlib.decompress(self.body)
+        r.status_code = self.status_code
+        r.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        r.encoding = self.encoding
+        r.url = self.url
+        return ResultWrapper(r)
+
+class BrowserHistory(object):
+    """
+    The pages visited so far, oldest first.
+
+    The most recent page is kept as-is; older ones are kept as
+    CompressedPage objects and only re-parsed if 'back' lands on them.
+    Once there are more than 'history_max_pages' pages, or they take up
+    more than 'history_max_bytes', the oldest pages are dropped.
+    """
+    live_pages = 1
+
+    def __init__(self):
+        self._pages = []
+        self._size = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __iter__(self):
+        return iter(self._pages)
+
+    def _page_size(self, page):
+        if isinstance(page, CompressedPage):
+            return page.get_size()
+        elif isinstance(page, DownloadResult):
+            return 0                    # body was never held in memory
+        return len(page.req.content)
+
+    def append(self, result):
+        if result is None:
+            return
+
+        self._pages.append(result)
+        self._size += self._page_size(result)
+
+        # compress everything but the most recent pages.
+        n = len(self._pages) - self.live_pages - 1
+        if n >= 0 and isinstance(self._pages[n], ResultWrapper) and \
+               not isinstance(self._pages[n], DownloadResult):
+            page = self._pages[n]
+            self._size -= self._page_size(page)
+            self._pages[n] = page = CompressedPage(page)
+            self._size += self._page_size(page)
+
+        # evict the oldest pages, but always keep the most recent one.
+        max_pages, max_bytes = _history_limits()
+        while len(self._pages) > 1 and \
+                  ((max_pages and len(self._pages) > max_pages) or
+                   (max_bytes and self._size > max_bytes)):
+            self._size -= self._page_size(self._pages.pop(0))
+
+    def pop(self):
+        """
+        Remove the most recent page & return it as a ResultWrapper.
+        """
+        page = self._pages.pop()
+        self._size -= self._page_size(page)
+        if isinstance(page, CompressedPage):
+            page = page.restore()
+        return page
+
+    def get_size(self):
+        return self._size
+
+def _record_response(r, *args, **kwargs):
+    # called for each response, including each hop of a redirect, as soon
+    # as its headers are in.  the latency recorded includes reading the
+    # body: here, for normal responses (requests would read it right after
+    # anyway), or by whoever reads it, for streamed ones (see
+    # _record_streamed).
+    if stats.get_recording() is None:
+        return
+
+    if kwargs.get('stream') and not r.is_redirect:
+        r._twill_record = True
+        return
+
+    start_time = time.time()
+    try:
+        r.content
+    except RequestException, e:
+        if not isinstance(e, (ConnectionError, Timeout)):  # (see below.)
+            stats.record_request(r.url, r.elapsed.total_seconds() +
+                                 time.time() - start_time, True)
+        raise
+    stats.record_request(r.url, r.elapsed.total_seconds() +
+                         time.time() - start_time, r.status_code >= 400)
+
+def _record_streamed(r, seconds):
+    """
+    Record the streamed response 'r', whose body took 'seconds' to read.
+    """
+    if getattr(r, '_twill_record', False):
+        stats.record_request(r.url, r.elapsed.total_seconds() + seconds,
+                             r.status_code >= 400)
+
+class _Session(requests.Session):
+    """
+    A requests Session that times every request into twill.stats while
+    it is recording.
+    """
+    def __init__(self):
+        requests.Session.__init__(self)
+        self.hooks['response'].append(_record_response)
+
+    def request(self, method, url, *args, **kwargs):
+        if stats.get_recording() is None:
+            return requests.Session.request(self, method, url, *args, **kwargs)
+
+        start_time = time.time()
+        try:
+            return requests.Session.request(self, method, url, *args, **kwargs)
+        except (ConnectionError, Timeout):
+            stats.record_request(url, time.time() - start_time, True)
+            raise
+
+# connection pool sizes for new browsers: host (or None, for every host)
+# => number of connections to keep open.  See TwillBrowser.set_pool_size.
+pool_sizes = {}
+
 class TwillBrowser(object):
     """A simple, stateful browser"""
     def __init__(self):
@@ -23,21 +187,27 @@ class TwillBrowser(object):
         # create special link/forms parsing code to run tidy on HTML first.
         #
 
-        # WSGI Intercept
-        # Taken from
-        # https://code.google.com/p/wsgi-intercept/issues/detail?id=23
-        # with slight modification
-        import wsgi_intercept
-        from requests.packages.urllib3 import connectionpool as cpl
-        cpl.HTTPConnectionPool.old_http = cpl.HTTPConnectionPool.ConnectionCls
-        cpl.HTTPConnectionPool.ConnectionCls = wsgi_intercept.WSGI_HTTPConnection
-        wsgi_intercept.wsgi_fake_socket.settimeout = lambda self, timeout: None
+        # Session stores cookies
+        self._session = _Session()
+        for host, maxsize in pool_sizes.items():
+            self.set_pool_size(maxsize, host)
+
+        # send requests to the WSGI intercepts in-process.
+        wsgi_intercept.mount(self._session)
 
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the pages visited, cookies, history, forms, credentials and
+        extra headers, but keep the HTTP session and its pooled keep-alive
+        connections.
+        """
         self.result = None
         self.last_submit_button = None
 
-        # Session stores cookies
-        self._session = requests.Session()
+        self._session.cookies.clear()
+        self._session.headers = requests.utils.default_headers()
         self._session.headers.update({"Accept" : "text/html; */*"})
 
         # An lxml FormElement, none until a form is selected
@@ -51,7 +221,26 @@ class TwillBrowser(object):
         # callables to be called after each page load.
         self._post_load_hooks = []
 
-        self._history = []
+        self._history = BrowserHistory()
+
+    def set_pool_size(self, maxsize, host=None):
+        """
+        Keep up to 'maxsize' connections to 'host' ('name' or 'name:port')
+        open for reuse, or to each host if no host is given.
+        """
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=maxsize)
+        if host is None:
+            prefixes = ['http://', 'https://']
+        else:
+            prefixes = ['http://%s/' % (host,), 'https://%s/' % (host,)]
+
+        for prefix in prefixes:
+            old = self._session.adapters.get(prefix)
+            self._session.mount(prefix, adapter)
+            if old is not None and old not in self._session.adapters.values():
+                old.close()
+
+        wsgi_intercept.mount(self._session)   # (in case that replaced it.)
 
     def _set_creds(self, creds):
         self._auth[creds[0]] = requests.auth.HTTPBasicAuth(*creds[1])
@@ -90,6 +279,16 @@ class TwillBrowser(object):
         else:
             raise TwillException("cannot go to '%s'" % (url,))
 
+    def download(self, url, filename):
+        """
+        Visit the given URL, streaming the response body into 'filename'
+        rather than keeping it in memory.
+        """
+        self._journey('download', url, filename)
+        print>>OUT, "==> downloaded %d bytes to '%s' (sha1 %s, %.3f s)" % \
+              (self.result.size, filename, self.result.digest,
+               self.result.elapsed)
+
     def reload(self):
         """
         Tell the browser to reload the current page.
@@ -139,7 +338,7 @@ class TwillBrowser(object):
     def find_link(self, pattern):
         """
         Find the first link with a URL, link text, or name matching the
-        given pattern.
+        given pattern, and return its absolute URL.
         """
         if self.result is not None:
             return self.result.find_link(pattern)
@@ -215,47 +414,45 @@ class TwillBrowser(object):
         return None
 
 
+    def get_form_index(self, form):
+        """
+        Return the FormIndex for the given form, building it if need be.
+        """
+        if self.result is not None:
+            return self.result.get_form_index(form)
+        return FormIndex(form)
+
     def get_form_field(self, form, fieldname):
         """
         Return the control that matches 'fieldname'.  Must be
         a *unique* regexp/exact string match.
         """
-        if fieldname in form.fields.keys():
-            controls = [f for f in form.inputs if f.get("name") == fieldname \
-                        and hasattr(f, 'type') and f.type == 'checkbox']
-            if len(controls) > 1:
-                return html.CheckboxGroup(controls)
+        index = self.get_form_index(form)
+
+        group = index.checkbox_groups.get(fieldname)
+        if group is not None:
+            return group
 
         fieldname = str(fieldname)
         
         found = None
         found_multiple = False
 
-        matches = [ c for c in form.inputs if c.get("id") == fieldname ]
-
-        # test exact match.
-        if matches:
-            if unique_match(matches):
-                found = matches[0]
-            else:
-                found_multiple = True   # record for error reporting.
-        
-        matches = [ c for c in form.inputs if str(c.name) == fieldname ]
-
-        # test exact match.
-        if matches:
-            if unique_match(matches):
-                found = matches[0]
-            else:
-                found_multiple = True   # record for error reporting.
+        # test exact match to id, then to name.
+        for matches in (index.by_id.get(fieldname),
+                        index.by_name.get(fieldname)):
+            if matches:
+                if unique_match(matches):
+                    found = matches[0]
+                else:
+                    found_multiple = True   # record for error reporting.
 
         # test index.
         if found is None:
             # try num
-            clickies = [c for c in form.inputs]
             try:
                 fieldnum = int(fieldname) - 1
-                found = clickies[fieldnum]
+                found = index.inputs[fieldnum]
             except ValueError:          # int() failed
                 pass
             except IndexError:          # fieldnum was incorrect
@@ -263,10 +460,7 @@ class TwillBrowser(object):
 
         # test regexp match
         if found is None:
-            regexp = re.compile(fieldname)
-
-            matches = [ ctl for ctl in form.inputs \
-                        if regexp.search(str(ctl.get("name"))) ]
+            matches = index.find_by_regexp(fieldname)
 
             if matches:
                 if unique_match(matches):
@@ -275,7 +469,7 @@ class TwillBrowser(object):
                     found_multiple = True # record for error
 
         if found is None:
-            clickies = [ c for c in form.inputs if c.value == fieldname]
+            clickies = [ c for c in index.inputs if c.value == fieldname]
             if clickies:
                 if len(clickies) == 1:
                     found = clickies[0]
@@ -336,9 +530,7 @@ more than one form; you must select one (use 'fv') before submitting\
                 ctl = self.last_submit_button
             else:
                 # get first submit button in form.
-                submits = [ c for c in form.inputs 
-                            if hasattr(c, 'type') and (c.type == 'submit' 
-                            or c.type == 'image')]
+                submits = self.get_form_index(form).submits
                 if len(submits) != 0:
                     ctl = submits[0]             
         else:
@@ -432,48 +624,105 @@ Note: submit is using submit button: name="%s", value="%s"
 
             print>>OUT, ''
 
-    # BRT: Added to test for meta redirection
-    #       Shamelessly stolen from 
-    #       http://stackoverflow.com/questions/2318446/how-to-follow-meta-refreshes-in-python
-    #       Took some modification to get it working, though
-    #       Original post notes that this doesn't check circular redirect
-    #       Is this something we're concerned with?
-    def _test_for_meta_redirections(self, r):
-        """
-        Checks a document for meta redirection
-        """
-        html_tree = html.fromstring(r.text)
-        attr = html_tree.xpath(
-        "//meta[translate(@http-equiv, 'REFSH', 'refsh') = 'refresh']/@content"
-                )
-        if len(attr) > 0:
-            wait, text = attr[0].split(";")
-            # @BRT: Strip surrounding quotes and ws; less brute force method?
-            #       Other chars that need to be dealt with?
-            text = text.strip()
-            text = text.strip('\'"')
-            if text.lower().startswith("url="):
-                url = text[4:]
-                if not url.startswith('http'):
-                    # Relative URL, adapt
-                    url = urlparse.urljoin(r.url, url)
-                    return True, url
-        return False, None
-
-    # BRT: Added to test for meta redirection
-    # Shamelessly stolen from the same link as _test_for_meta_redirections
-    def _follow_redirections(self, r, s):
-        """
-        Recursive function that follows meta refresh redirections if they exist.
-        """
-        redirected, url = self._test_for_meta_redirections(r)
-        if redirected:
-            r = self._follow_redirections(s.get(url), s)
-        return r
+    def _follow_redirections(self, result):
+        """
+        Follow HTTP-EQUIV refresh redirections from the given page, if
+        there are any, and return the page we end up on.
+
+        Stops (staying on the last page) when a refresh leads back to a
+        page already seen, or after 'equiv_refresh_max_hops' refreshes.
+        """
+        max_hops, honor_delay = _equiv_refresh_options()
+
+        seen = set([normalize_url(result.get_url())])
+        hops = 0
+        while 1:
+            delay, url = result.get_meta_refresh()
+            if url is None:
+                break
+
+            if url in seen:
+                print>>OUT, '==> equiv-refresh loop at %s; not following' % \
+                      (url,)
+                break
+
+            if max_hops and hops >= max_hops:
+                print>>OUT, '==> more than %d equiv-refreshes; not following' \
+                      % (max_hops,)
+                break
+
+            if utils._debug_print_refresh:
+                print>>OUT, 'equiv-refresh: %s ==> %s (delay %s)' % \
+                      (result.get_url(), url, delay)
+
+            if honor_delay and delay:
+                time.sleep(delay)
+
+            hops += 1
+            seen.add(url)
+            result = ResultWrapper(self._session.get(url))
+            seen.add(normalize_url(result.get_url()))
+
+        return result
+
+    def _stream_body(self, r, filename, threshold, start_time):
+        """
+        Read the body of the streamed response 'r' chunk by chunk.
+
+        If 'filename' is given, or the body is larger than 'threshold'
+        bytes, the body is written into 'filename' (or a temporary file)
+        as it arrives and a DownloadResult is returned; otherwise 'r' is
+        returned with its body loaded, just like a normal response.
+        """
+        fp = None
+        temporary = False
+
+        length = r.headers.get('content-length', '')
+        if filename is None and length.isdigit() and int(length) > threshold:
+            fd, filename = tempfile.mkstemp('.twill')
+            fp = os.fdopen(fd, 'wb')
+            temporary = True
+        elif filename is not None:
+            fp = open(filename, 'wb')
+
+        chunks = []
+        size = 0
+        digest = hashlib.sha1()
+        body_start_time = time.time()
+        try:
+            for chunk in r.iter_content(_chunk_size):
+                size += len(chunk)
+                digest.update(chunk)
+
+                if fp is not None:
+                    fp.write(chunk)
+                    continue
+
+                chunks.append(chunk)
+                if size > threshold:
+                    # too big after all; spill what we have to disk.
+                    fd, filename = tempfile.mkstemp('.twill')
+                    fp = os.fdopen(fd, 'wb')
+                    temporary = True
+                    fp.write(''.join(chunks))
+                    chunks = []
+        finally:
+            if fp is not None:
+                fp.close()
+            r.close()
+            _record_streamed(r, time.time() - body_start_time)
+
+        if fp is None:
+            r._content = ''.join(chunks)
+            return r
+
+        return DownloadResult(r, filename, size, digest.hexdigest(),
+                              time.time() - start_time, temporary)
 
     def _journey(self, func_name, *args, **kwargs):
         """
-        'func_name' should be one of 'open', 'reload', 'back', or 'follow_link'.
+        'func_name' should be one of 'open', 'reload', 'back', 'follow_link',
+        or 'download'.
 
         journey then runs that function with the given arguments and turns
         the results into a nice friendly standard ResultWrapper object, which
@@ -489,14 +738,22 @@ Note: submit is using submit button: name="%s", value="%s"
             url = args[0]
 
         elif func_name == 'follow_link':
-            # Try to find the link first
-            url = self.find_link(args[0])
-            if url.find('://') == -1:
-                url = urlparse.urljoin(self.get_url(), url)
+            # Try to find the link first; 'find_link' hands back absolute
+            # URLs, so this is usually a straight dictionary hit.
+            link = args[0]
+            url = None
+            if self.result is not None:
+                links = self.result.get_link_index()
+                url = links.get_by_url(link) or links.find(link)
+            if not url:
+                url = urlparse.urljoin(self.get_url(), link)
 
         elif func_name == 'reload':
             url = self.get_url()
 
+        elif func_name == 'download':
+            url = args[0]
+
         elif func_name == 'back':
             try:
                 self.result = self._history.pop()
@@ -509,14 +766,31 @@ Note: submit is using submit button: name="%s", value="%s"
         else:
             auth = None
 
-        r = self._session.get(url, auth = auth)
+        # stream the body if we're downloading, or if the page might be
+        # too big to keep in memory.
+        filename = None
+        if func_name == 'download':
+            filename = args[1]
+        threshold = _download_threshold()
+
+        if filename is not None or threshold:
+            start_time = time.time()
+            r = self._session.get(url, auth = auth, stream = True)
+            r = self._stream_body(r, filename, threshold, start_time)
+        else:
+            r = self._session.get(url, auth = auth)
 
-        if _follow_equiv_refresh():
-            r = self._follow_redirections(r, self._session)
+        if isinstance(r, DownloadResult):
+            result = r
+        else:
+            result = ResultWrapper(r)
+            if _follow_equiv_refresh():
+                result = self._follow_redirections(result)
 
-        if func_name in ['follow_link', 'open']:
+        if func_name in ['follow_link', 'open', 'download']:
             # If we're really reloading and just didn't say so, don't store
-            if self.result is not None and self.result.get_url() != r.url:
+            if self.result is not None and \
+                   self.result.get_url() != result.get_url():
                 self._history.append(self.result)
 
-        self.result = ResultWrapper(r)
+        self.result = result
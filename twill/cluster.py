@@ -0,0 +1,316 @@
+"""
+Multi-node twill-fork.  A coordinator waits for a number of workers to
+connect to it over TCP, sends each of them the scripts and their share of
+the work, starts them all at once, and merges the request statistics that
+they stream back.
+
+Messages are JSON objects, one per line.  Workers run whatever scripts
+the coordinator sends them, so only point workers at coordinators that
+you trust.
+"""
+
+import os
+import time
+import shutil
+import socket
+import select
+import tempfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import stats
+import loadgen
+from errors import TwillException
+
+def parse_address(address):
+    """
+    Parse 'host:port' (or just 'port') into a (host, port) tuple.
+    """
+    host = ''
+    if ':' in address:
+        host, address = address.rsplit(':', 1)
+    return host or 'localhost', int(address)
+
+class _Connection(object):
+    """
+    A socket that sends & receives newline-separated JSON messages.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+        self.messages = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message) + '\n')
+
+    def receive(self):
+        """
+        Read whatever is available on the socket, and return the list of
+        complete messages received.  Raise EOFError when the other end
+        closes the connection.
+        """
+        data = self.sock.recv(64 * 1024)
+        if not data:
+            raise EOFError
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        return [ json.loads(line) for line in lines ]
+
+    def receive_one(self, expected_type):
+        """
+        Wait for the next message, which must be of the given type.
+        """
+        while not self.messages:
+            self.messages.extend(self.receive())
+
+        message = self.messages.pop(0)
+        if message.get('type') != expected_type:
+            raise TwillException("expected a '%s' message, got '%s'" %
+                                 (expected_type, message.get('type'),))
+        return message
+
+    def close(self):
+        self.sock.close()
+
+def _split(number, weights):
+    """
+    Split 'number' into integer shares proportional to 'weights'.
+    """
+    total = float(sum(weights))
+    shares = [ int(number * w / total) for w in weights ]
+    shares[0] += number - sum(shares)
+    return shares
+
+###
+
+def run_coordinator(address, n_workers, filenames, number=1, profile=None,
+                    initial_url=None, reuse_session=False, report_interval=5.,
+                    report=None, listening=None, scenarios=None):
+    """
+    Wait for 'n_workers' workers to connect to 'address' (a (host, port)
+    tuple), then run the scripts across all of them: either 'number' times
+    in all, or on the arrival schedule in 'profile' (see twill.loadgen).
+    Both are split between the workers by their number of processes.
+    'scenarios' (see twill.loadgen) are sent to each worker as they are,
+    so each worker runs their user counts.
+
+    'report' is as for loadgen.run_closed; 'listening', if given, is called
+    with the listening address once the coordinator is accepting workers.
+
+    Return (request statistics, elapsed time, total time spent in the
+    processes that finished -- or for profile runs, the elapsed time --
+    number of runs that finished, number of processes, failed flag).
+    """
+    if scenarios:
+        filenames = []
+        for s in scenarios:
+            filenames.extend([ f for f in s.filenames if f not in filenames ])
+
+    scripts = []
+    for filename in filenames:
+        fp = open(filename)
+        try:
+            # (latin-1 maps bytes to unicode & back unchanged, for JSON.)
+            scripts.append((filename, fp.read().decode('latin-1')))
+        finally:
+            fp.close()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(n_workers)
+    if listening:
+        listening(listener.getsockname())
+
+    workers = []
+    try:
+        while len(workers) < n_workers:
+            sock, _ = listener.accept()
+            conn = _Connection(sock)
+            hello = conn.receive_one('hello')
+            workers.append((conn, int(hello['processes'])))
+    finally:
+        listener.close()
+
+    #
+    # send the workers their share of the work, and wait 'til they're all
+    # ready before starting them, so that they start together.
+    #
+
+    processes = [ p for (conn, p) in workers ]
+    n_processes = sum(processes)
+    shares = _split(number, processes)
+
+    for (conn, p), share in zip(workers, shares):
+        job = dict(type='job', scripts=scripts, number=share,
+                   initial_url=initial_url, reuse_session=reuse_session,
+                   report_interval=report_interval)
+        if scenarios:
+            job['scenarios'] = [ dict(name=s.name, weight=s.weight,
+                                      scripts=[ filenames.index(f)
+                                                for f in s.filenames ],
+                                      think=s.think, users=s.users,
+                                      label=s.label)
+                                 for s in scenarios ]
+        if profile:
+            fraction = float(p) / n_processes
+            job['profile'] = [ (shape, duration, rate * fraction,
+                                end_rate * fraction)
+                               for (shape, duration, rate, end_rate)
+                               in profile ]
+        conn.send(job)
+
+    for conn, p in workers:
+        conn.receive_one('ready')
+    for conn, p in workers:
+        conn.send(dict(type='start'))
+
+    #
+    # merge the statistics streaming in from the workers.
+    #
+
+    request_stats = stats.RequestStats()
+    total_time = 0.
+    total_exec = 0
+    failed = False
+
+    start_time = time.time()
+    next_report = start_time + report_interval
+
+    conns = [ conn for (conn, p) in workers ]
+    done = []
+    while len(done) < len(conns):
+        waiting = [ conn for conn in conns if conn not in done ]
+        timeout = max(0, next_report - time.time())
+        ready, _, _ = select.select(waiting, [], [], timeout)
+        for conn in ready:
+            try:
+                messages = conn.receive()
+            except (EOFError, socket.error):
+                print '[twill-fork coordinator: lost a worker]'
+                failed = True
+                done.append(conn)
+                continue
+
+            for message in messages:
+                if message['type'] == 'stats':
+                    delta = stats.RequestStats()
+                    delta.set_state(message['stats'])
+                    request_stats.merge(delta)
+                elif message['type'] == 'done':
+                    total_time += message['total_time']
+                    total_exec += message['total_exec']
+                    failed = failed or message['failed']
+                    done.append(conn)
+
+        now = time.time()
+        if now >= next_report:
+            if report:
+                report(request_stats, now - start_time)
+            next_report = now + report_interval
+
+    elapsed = time.time() - start_time
+    if profile:
+        # the workers ran at the same time, so the sum of their times is
+        # no use; report the run's time, as loadgen.run_profile does.
+        total_time = elapsed
+
+    for conn in conns:
+        conn.close()
+
+    return (request_stats, elapsed, total_time, total_exec, n_processes,
+            failed)
+
+def run_worker(address, processes=1):
+    """
+    Connect to the coordinator at 'address' (a (host, port) tuple), run
+    the work it hands out across 'processes' forked processes, and stream
+    the request statistics back to it.
+    """
+    from parse import compile_file
+
+    conn = _Connection(socket.create_connection(address))
+    conn.send(dict(type='hello', processes=processes))
+    job = conn.receive_one('job')
+
+    # save the scripts where we can run them.
+    dirname = tempfile.mkdtemp()
+    try:
+        names = [ name for (name, text) in job['scripts'] ]
+        filenames = []
+        for i, (name, text) in enumerate(job['scripts']):
+            filename = os.path.join(dirname, '%d-%s' % (i,
+                                                        os.path.basename(name)))
+            fp = open(filename, 'w')
+            fp.write(text.encode('latin-1'))
+            fp.close()
+
+            compile_file(filename)
+            filenames.append(filename)
+
+        conn.send(dict(type='ready'))
+        conn.receive_one('start')
+
+        #
+        # batch up the statistics from our processes, under the names the
+        # coordinator knows the scripts by.
+        #
+
+        report_interval = job['report_interval']
+        send_interval = min(1., report_interval)
+        renames = { ' '.join(filenames) : ' '.join(names) }
+
+        scenarios = None
+        if job.get('scenarios'):
+            scenarios = [ loadgen.Scenario(s['name'],
+                                           [ filenames[i]
+                                             for i in s['scripts'] ],
+                                           s['weight'], s['think'],
+                                           s['users'], s['label'])
+                          for s in job['scenarios'] ]
+
+        pending = [stats.RequestStats(), time.time()]
+
+        def send_stats():
+            state = [ [command, renames.get(pattern, pattern), h, errors]
+                      for (command, pattern, h, errors)
+                      in pending[0].get_state() ]
+            conn.send(dict(type='stats', stats=state))
+            pending[:] = [stats.RequestStats(), time.time()]
+
+        def on_stats(delta):
+            pending[0].merge(delta)
+            if time.time() - pending[1] >= send_interval:
+                send_stats()
+
+        if job.get('profile'):
+            _, elapsed, n_started = \
+               loadgen.run_profile(filenames, job['profile'], processes,
+                                   initial_url=job['initial_url'],
+                                   reuse_session=job['reuse_session'],
+                                   report_interval=report_interval,
+                                   on_stats=on_stats, scenarios=scenarios)
+            total_time, total_exec, failed = elapsed, n_started, False
+        elif job['number']:
+            _, _, total_time, total_exec, failed = \
+               loadgen.run_closed(filenames, job['number'],
+                                  min(processes, job['number']),
+                                  initial_url=job['initial_url'],
+                                  reuse_session=job['reuse_session'],
+                                  report_interval=report_interval,
+                                  on_stats=on_stats, scenarios=scenarios)
+        else:                           # nothing for us to do.
+            total_time, total_exec, failed = 0., 0, False
+
+        send_stats()
+        conn.send(dict(type='done', total_time=total_time,
+                       total_exec=total_exec, failed=failed))
+    finally:
+        conn.close()
+        shutil.rmtree(dirname, ignore_errors=True)
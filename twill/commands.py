@@ -6,8 +6,7 @@ twill-sh.
 import sys
 from lxml import html
 
-OUT=None
-ERR=sys.stderr
+from context import OUT, ERR
 
 # export:
 __all__ = ['get_browser',
@@ -25,6 +24,7 @@ __all__ = ['get_browser',
            'show',
            'echo',
            'save_html',
+           'download',
            'sleep',
            'agent',
            'showforms',
@@ -63,32 +63,39 @@ __all__ = ['get_browser',
            'info'
            ]
 
-import re, getpass, time
+import re, getpass, time, shutil
 
 from browser import TwillBrowser
 
 from errors import TwillException, TwillAssertionError
 import utils
 from utils import set_form_control_value, run_tidy
+import namespaces
 from namespaces import get_twill_glocals
-        
-browser = TwillBrowser()
+from context import TwillContext, get_context, get_default_context, \
+     set_default_context
 
 def get_browser():
-    return browser
+    return get_context().browser
 
-def reset_browser():
+def reset_browser(reuse_session=False):
     """
     >> reset_browser
 
     Reset the browser completely.
     """
-    global browser
-    browser = TwillBrowser()
+    context = get_context()
+    if reuse_session:                   # keep the pooled connections.
+        context.browser.reset()
+    else:
+        context.browser = TwillBrowser()
+
+    context.options = dict(_orig_options)
 
-    global _options
-    _options = {}
-    _options.update(_orig_options)
+    if context is get_default_context():
+        global browser, _options
+        browser = context.browser
+        _options = context.options
 
 ###
 
@@ -106,6 +113,7 @@ def go(url):
     
     Visit the URL given.
     """
+    browser = get_browser()
     browser.go(url)
     return browser.get_url()
 
@@ -115,6 +123,7 @@ def reload():
     
     Reload the current URL.
     """
+    browser = get_browser()
     browser.reload()
     return browser.get_url()
 
@@ -124,6 +133,7 @@ def code(should_be):
     
     Check to make sure the response code for the last page is as given.
     """
+    browser = get_browser()
     should_be = int(should_be)
     if browser.get_code() != int(should_be):
         raise TwillAssertionError("code is %s != %s" % (browser.get_code(),
@@ -139,13 +149,14 @@ def tidy_ok():
     If 'tidy' cannot be run, will fail silently (unless 'tidy_should_exist'
     option is true; see 'config' command).
     """
+    browser = get_browser()
     page = browser.get_html()
     if page is None:
         raise TwillAssertionError("not viewing HTML!")
         
     (clean_page, errors) = run_tidy(page)
     if clean_page is None:              # tidy doesn't exist...
-        if _options.get('tidy_should_exist'):
+        if get_context().options.get('tidy_should_exist'):
             raise TwillAssertionError("cannot run 'tidy'")
     elif errors:
         raise TwillAssertionError("tidy errors:\n====\n%s\n====\n" % (errors,))
@@ -159,6 +170,7 @@ def url(should_be):
     Check to make sure that the current URL matches the regexp.  The local
     variable __match__ is set to the matching part of the URL.
     """
+    browser = get_browser()
     regexp = re.compile(should_be)
     current_url = browser.get_url()
 
@@ -189,6 +201,7 @@ def follow(what):
     
     Find the first matching link on the page & visit it.
     """
+    browser = get_browser()
     regexp = re.compile(what)
     link = browser.find_link(regexp)
     if link != '':
@@ -227,6 +240,7 @@ def find(what, flags=''):
     For explanations of these, please see the Python re module
     documentation.
     """
+    browser = get_browser()
     regexp = re.compile(what, _parseFindFlags(flags))
     page = browser.get_html()
 
@@ -248,6 +262,7 @@ def notfind(what, flags=''):
     
     Fail if the regular expression is on the page.
     """
+    browser = get_browser()
     regexp = re.compile(what, _parseFindFlags(flags))
     page = browser.get_html()
 
@@ -260,6 +275,7 @@ def back():
     
     Return to the previous page.
     """
+    browser = get_browser()
     browser.back()
     return browser.get_url()
 
@@ -269,6 +285,7 @@ def show():
     
     Show the HTML for the current page.
     """
+    browser = get_browser()
     html = browser.get_html()
     print>>OUT, html
     return html
@@ -290,6 +307,7 @@ def save_html(filename=None):
     Save the HTML for the current page into <filename>.  If no filename
     given, construct the filename from the URL.
     """
+    browser = get_browser()
     html = browser.get_html()
     if html is None:
         print>>OUT, "No page to save."
@@ -304,10 +322,27 @@ def save_html(filename=None):
 
         print>>OUT, "(Using filename '%s')" % (filename,)
 
+    # streamed pages are already on disk; copy them over in chunks.
+    if isinstance(browser.result, utils.DownloadResult):
+        shutil.copyfile(browser.result.filename, filename)
+        return
+
     f = open(filename, 'w')
     f.write(html)
     f.close()
 
+def download(url, filename):
+    """
+    >> download <url> <filename>
+
+    Visit the URL given, streaming the body into <filename> instead of
+    keeping it in memory.  Only the size, SHA-1 digest and download time
+    of the page are recorded; 'code' and 'url' work as usual afterwards.
+    """
+    browser = get_browser()
+    browser.download(url, filename)
+    return browser.result.digest
+
 def sleep(interval=1):
     """
     >> sleep [<interval>]
@@ -336,6 +371,7 @@ def agent(what):
     Some convenient shortcuts:
       ie5, ie55, ie6, moz17, opera7, konq32, saf11, aol9.
     """
+    browser = get_browser()
     what = what.strip()
     agent = _agent_map.get(what, what)
     browser.set_agent_string(agent)
@@ -356,6 +392,7 @@ def submit(submit_button=None):
     submit button clicked on by 'formvalue'.  If none can be found,
     submit submits the form with no submit button clicked.
     """
+    browser = get_browser()
     browser.submit(submit_button)
 
 def showforms():
@@ -364,6 +401,7 @@ def showforms():
     
     Show all of the forms on the current page.
     """
+    browser = get_browser()
     browser.showforms()
     return browser.get_all_forms()
 
@@ -373,6 +411,7 @@ def showlinks():
     
     Show all of the links on the current page.
     """
+    browser = get_browser()
     browser.showlinks()
     return browser.get_all_links()
 
@@ -382,6 +421,7 @@ def showhistory():
 
     Show the browser history (what URLs were visited).
     """
+    browser = get_browser()
     browser.showhistory()
     return browser._history
     
@@ -391,6 +431,7 @@ def formclear(formname):
     
     Run 'clear' on all of the controls in this form.
     """
+    browser = get_browser()
     form = browser.get_form(formname)
     for control in form.inputs:
         if "readonly" in control.attrib.keys() or \
@@ -430,6 +471,7 @@ def formvalue(formname, fieldname, value):
 
     'formvalue' is available as 'fv' as well.
     """
+    browser = get_browser()
     form = browser.get_form(formname)
     if form is None:
         raise TwillAssertionError("no matching forms!")
@@ -441,7 +483,7 @@ def formvalue(formname, fieldname, value):
         pass
 
     elif 'readonly' in control.attrib.keys() and \
-        _options['readonly_controls_writeable']:
+        get_context().options['readonly_controls_writeable']:
         print>>OUT, 'forcing read-only form field to writeable'
         del control.attrib['readonly']
         
@@ -455,7 +497,11 @@ def formvalue(formname, fieldname, value):
                     'form field is for file upload; use "formfile" instead'
                 )
 
-    set_form_control_value(control, value)
+    options = None
+    if isinstance(control, html.SelectElement):
+        options = browser.get_form_index(form).get_select_options(control)
+
+    set_form_control_value(control, value, options)
 
 fv = formvalue
 
@@ -465,6 +511,7 @@ def formaction(formname, action):
 
     Sets action parameter on form to action_url
     """
+    browser = get_browser()
     form = browser.get_form(formname)
     print "Setting action for form ", (form,), "to ", (action,)
     form.action = action
@@ -477,6 +524,7 @@ def formfile(formname, fieldname, filename, content_type=None):
 
     Upload a file via an "upload file" form field.
     """
+    browser = get_browser()
     import os.path
     filename = filename.replace('/', os.path.sep)
 
@@ -520,7 +568,7 @@ def extend_with(module_name):
     for command in fnlist:
         fn = getattr(mod, command)
         twill.shell.add_command(command, fn.__doc__)
-        twill.parse.command_list.append(command)
+        twill.parse.register_command(command, fn)
 
     ###
     
@@ -569,6 +617,7 @@ def save_cookies(filename):
 
     Save all of the current cookies to the given file.
     """
+    browser = get_browser()
     browser.save_cookies(filename)
 
 def load_cookies(filename):
@@ -577,6 +626,7 @@ def load_cookies(filename):
 
     Clear the cookie jar and load cookies from the given file.
     """
+    browser = get_browser()
     browser.load_cookies(filename)
 
 def clear_cookies():
@@ -585,6 +635,7 @@ def clear_cookies():
 
     Clear the cookie jar.
     """
+    browser = get_browser()
     browser.clear_cookies()
 
 def show_cookies():
@@ -593,6 +644,7 @@ def show_cookies():
 
     Show all of the cookies in the cookie jar.
     """
+    browser = get_browser()
     browser.show_cookies()
 
 def add_auth(realm, uri, user, passwd):
@@ -606,7 +658,8 @@ def add_auth(realm, uri, user, passwd):
     # swap around the type of HTTPPasswordMgr and
     # HTTPPasswordMgrWithDefaultRealm depending on if with_default_realm 
     # is on or not.
-    if _options['with_default_realm']:
+    browser = get_browser()
+    if get_context().options['with_default_realm']:
         realm = None
         browser._set_creds((uri,(user,passwd)))
     
@@ -675,7 +728,7 @@ def run(cmd):
 
     # set __url__
     local_dict['__cmd__'] = cmd
-    local_dict['__url__'] = commands.browser.get_url()
+    local_dict['__url__'] = commands.get_browser().get_url()
 
     exec(cmd, global_dict, local_dict)
 
@@ -714,6 +767,7 @@ def title(what):
     
     Succeed if the regular expression is in the page title.
     """
+    browser = get_browser()
     regexp = re.compile(what)
     title = browser.get_title()
 
@@ -777,6 +831,7 @@ def add_extra_header(header_key, header_value):
     Add an HTTP header to each HTTP request.  See 'show_extra_headers' and
     'clear_extra_headers'.
     """
+    browser = get_browser()
     browser._session.headers.update({header_key : header_value})
 
 def show_extra_headers():
@@ -785,6 +840,7 @@ def show_extra_headers():
 
     Show any extra headers being added to each HTTP request.
     """
+    browser = get_browser()
     l = browser._session.headers
     if l:
         print 'The following HTTP headers are added to each request:'
@@ -803,6 +859,7 @@ def clear_extra_headers():
     Remove all user-defined HTTP headers.  See 'add_extra_header' and
     'show_extra_headers'.
     """
+    browser = get_browser()
     browser._session.headers = dict([("Accept", "text/html; */*")])
 
 ### options
@@ -814,11 +871,20 @@ _orig_options = dict(readonly_controls_writeable=False,
                      require_BeautifulSoup=False,
                      allow_parse_errors=True,
                      with_default_realm=False,
-                     acknowledge_equiv_refresh=True
+                     acknowledge_equiv_refresh=True,
+                     history_max_pages=100,
+                     history_max_bytes=16 * 1024 * 1024,
+                     download_threshold=0,
+                     equiv_refresh_max_hops=10,
+                     equiv_refresh_honor_delay=False
                      )
 
-_options = {}
-_options.update(_orig_options)           # make a copy
+# the browser & options of the default context.  (commands act on those of
+# the current context; see get_browser.)
+browser = TwillBrowser()
+_options = dict(_orig_options)           # make a copy
+
+set_default_context(TwillContext(browser, _options, namespaces.global_dict))
 
 def config(key=None, value=None):
     """
@@ -830,6 +896,15 @@ def config(key=None, value=None):
     So far:
 
      * 'acknowledge_equiv_refresh', default 1 -- follow HTTP-EQUIV=REFRESH
+     * 'download_threshold', default 0 -- stream pages larger than this
+       many bytes to disk instead of keeping them in memory (0: never)
+     * 'equiv_refresh_honor_delay', default 0 -- wait for the refresh delay
+       before following an HTTP-EQUIV=REFRESH
+     * 'equiv_refresh_max_hops', default 10 -- follow at most this many
+       HTTP-EQUIV=REFRESHes in a row (0: no limit)
+     * 'history_max_pages', default 100 -- pages kept for 'back' (0: no limit)
+     * 'history_max_bytes', default 16 MB -- memory used by the history
+       (0: no limit)
      * 'readonly_controls_writeable', default 0 -- make ro controls writeable
      * 'require_tidy', default 0 -- *require* that tidy be installed
      * 'use_BeautifulSoup', default 1 -- use the BeautifulSoup parser
@@ -840,28 +915,36 @@ def config(key=None, value=None):
      * 'allow_parse_errors' has been removed.
     """
     import utils
-    
+
+    options = get_context().options
     if key is None:
-        keys = _options.keys()
+        keys = options.keys()
         keys.sort()
 
         print>>OUT, 'current configuration:'
         for k in keys:
-            print>>OUT, '\t%s : %s' % (k, _options[k])
+            print>>OUT, '\t%s : %s' % (k, options[k])
         print>>OUT, ''
     else:
-        v = _options.get(key)
+        v = options.get(key)
         if v is None:
             print>>OUT, '*** no such configuration key', key
-            print>>OUT, 'valid keys are:', ";".join(_options.keys())
+            print>>OUT, 'valid keys are:', ";".join(options.keys())
             raise TwillException('no such configuration key: %s' % (key,))
         elif value is None:
             print>>OUT, ''
             print>>OUT, 'key %s: value %s' % (key, v)
             print>>OUT, ''
         else:
-            value = utils.make_boolean(value)
-            _options[key] = value
+            if isinstance(v, bool):
+                value = utils.make_boolean(value)
+            else:
+                try:
+                    value = type(v)(value)
+                except ValueError:
+                    raise TwillException("invalid value for %s: '%s'" % \
+                                         (key, value))
+            options[key] = value
 
 def info():
     """
@@ -869,16 +952,14 @@ def info():
 
     Report information on current page.
     """
+    browser = get_browser()
     current_url = browser.get_url()
     if current_url is None:
         print "We're not on a page!"
         return
     
-    content_type = browser.result.get_headers()['content-type']
-
-    check_html = False
-    if content_type == 'text/html':
-        check_html = True
+    content_type = browser.result.get_headers().get('content-type')
+    check_html = browser.result.is_html()
 
     code = browser.get_code()
 
@@ -890,6 +971,11 @@ def info():
         print >>OUT, '(HTML)'
     else:
         print ''
+    if isinstance(browser.result, utils.DownloadResult):
+        print >>OUT, '\tDownloaded: %d bytes to %s in %.3f s' % \
+              (browser.result.size, browser.result.filename,
+               browser.result.elapsed)
+        print >>OUT, '\tSHA-1:', browser.result.digest
     if check_html:
         title = browser.get_title()
         print >>OUT, '\tPage title:', title
@@ -0,0 +1,105 @@
+"""
+twill execution contexts.
+
+A context holds the state that twill commands work on: the browser, the
+configuration options, the global & local namespaces, the output streams
+and the request timing state (see twill.stats).  Each thread runs commands
+in its own current context; threads that haven't set one share the default
+context, which is the one that the module-level API (twill.commands.browser,
+twill.get_browser(), twill.set_output(), etc.) has always worked on.
+
+To run a script in a context of its own, pass the context to
+'execute_file' or 'execute_string' ::
+
+   context = TwillContext()
+   twill.execute_file('script.twill', context=context)
+
+Compiled scripts are shared between contexts, so threads running the same
+script only parse it once.
+"""
+
+import sys
+import threading
+
+class TwillContext(object):
+    """
+    The browser, options, namespaces, output streams and timing state of
+    one twill user.
+
+    By default a new context gets a new browser, the default options, a
+    copy of the current global namespace, and writes its output to
+    sys.stdout & sys.stderr.
+    """
+    def __init__(self, browser=None, options=None, global_dict=None,
+                 out=None, err=None):
+        if browser is None:
+            from browser import TwillBrowser
+            browser = TwillBrowser()
+        if options is None:
+            from commands import _orig_options
+            options = dict(_orig_options)
+        if global_dict is None:
+            global_dict = dict(get_context().global_dict)
+
+        self.browser = browser
+        self.options = options
+        self.global_dict = global_dict
+        self.local_dict_stack = []
+
+        # output & error streams; None means sys.stdout/sys.stderr.
+        self.out = out
+        self.err = err
+
+        # request timing; see twill.stats.
+        self.recording = None
+        self.current_command = None
+        self.current_scenario = None
+
+_default = None
+_local = threading.local()
+
+def get_context():
+    """
+    Return the current thread's context.
+    """
+    return getattr(_local, 'context', None) or _default
+
+def set_context(context):
+    """
+    Make 'context' the current thread's context (None: the default
+    context), and return the context that was set before (or None).
+    """
+    old = getattr(_local, 'context', None)
+    _local.context = context
+    return old
+
+def get_default_context():
+    return _default
+
+def set_default_context(context):
+    global _default
+    _default = context
+
+class _Stream(object):
+    """
+    A file-like object that writes to the current context's output (or
+    error) stream.
+    """
+    def __init__(self, name, default):
+        self.__dict__['_name'] = name
+        self.__dict__['_default'] = default
+
+    def _get_stream(self):
+        fp = getattr(get_context(), self._name)
+        if fp is None:
+            fp = getattr(sys, self._default)
+        return fp
+
+    def __getattr__(self, name):
+        return getattr(self._get_stream(), name)
+
+    def __setattr__(self, name, value):   # e.g. 'softspace', for print.
+        setattr(self._get_stream(), name, value)
+
+OUT = _Stream('out', 'stdout')
+ERR = _Stream('err', 'stderr')
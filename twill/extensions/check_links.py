@@ -9,6 +9,20 @@ Make sure that all of the HTTP links on the current page can be visited
 successfully.  If 'pattern' is given, check only URLs that match that
 regular expression.
 
+The links are checked concurrently, with HEAD requests (falling back to
+GET for servers that don't answer HEAD properly); the pages they point
+to are never downloaded or parsed.  Options:
+
+ * 'check_links.workers', default 16 -- check this many links at once;
+ * 'check_links.per_host', default 4 -- ...but at most this many on any
+   one host;
+ * 'check_links.timeout', default 10 -- seconds to wait for each server;
+ * 'check_links.cache', default '' -- keep the good links in this sqlite
+   file (see twill.linkcache), shared between processes & runs;
+ * 'check_links.cache_ttl', default 86400 -- don't check links from the
+   cache again until they're this many seconds old; after that, check
+   them with conditional requests.
+
 If option 'check_links.only_collect_bad_links' is on, then all bad
 links are silently collected across all calls to check_links.  The
 function 'report_bad_links' can then be used to report all of the links,
@@ -20,21 +34,194 @@ __all__ = ['check_links', 'report_bad_links']
 DEBUG=True
 
 import re
-from twill import commands
+import time
+import urlparse
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from twill import commands, wsgi_intercept
+from twill.context import get_context
 from twill.errors import TwillAssertionError
+from twill.linkcache import LinkCache
 
 ### first, set up config options & persistent 'bad links' memory...
 
-if commands._options.get('check_links.only_collection_bad_links') is None:
-    commands._options['check_links.only_collect_bad_links'] = False
+_default_options = { 'check_links.only_collect_bad_links' : False,
+                     'check_links.workers' : 16,
+                     'check_links.per_host' : 4,
+                     'check_links.timeout' : 10.,
+                     'check_links.cache' : '',
+                     'check_links.cache_ttl' : 86400. }
+
+for key, value in _default_options.items():
+    commands._orig_options.setdefault(key, value)  # ...for reset_browser.
+    commands._options.setdefault(key, value)
 
+# bad link => list of pages it occurs on.
 bad_links_dict = {}
 
+def _option(key):
+    return get_context().options.get(key, _default_options[key])
+
+#
+# checking links
+#
+
+def collect_links(link_index, pattern=''):
+    """
+    Return the unique HTTP(S) URLs in 'link_index' (see utils.LinkIndex)
+    that match the regexp 'pattern', in the order they appear on the page.
+    """
+    regexp = None
+    if pattern:
+        regexp = re.compile(pattern)
+
+    urls = []
+    seen = set()
+    for (text, href, absolute_url) in link_index.links:
+        url = absolute_url              # normalized, without the '#...'.
+        if url is None or url in seen:
+            continue
+        seen.add(url)
+
+        if not (url.startswith('http://') or url.startswith('https://')):
+            if DEBUG:
+                print>>commands.OUT, \
+                      "url '%s' is not an HTTP link; ignoring" % (url,)
+            continue
+
+        if regexp and not regexp.search(url):
+            if DEBUG:
+                print>>commands.OUT, "URL %s doesn't match regexp" % (url,)
+            continue
+
+        urls.append(url)
+
+    return urls
+
+def check_url(session, url, timeout, cached=None):
+    """
+    Check 'url' with a HEAD request, falling back to GET if the server
+    doesn't like HEAD; either way, the body is never read.  If 'cached'
+    (status, time checked, ETag, Last-Modified) is given, make the
+    request conditional on the page having changed since.
+
+    Return (final status code (after redirects) or the error message,
+    ETag, Last-Modified).
+    """
+    headers = {}
+    if cached:
+        status, checked, etag, last_modified = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        r = session.head(url, allow_redirects=True, timeout=timeout,
+                         headers=headers)
+        r.close()
+        if r.status_code >= 400:        # e.g. 405 Method Not Allowed.
+            r = session.get(url, allow_redirects=True, timeout=timeout,
+                            headers=headers, stream=True)
+            r.close()
+    except requests.RequestException, e:
+        return (str(e) or e.__class__.__name__, None, None)
+
+    if r.status_code == 304 and cached:  # not modified: still good.
+        return (cached[0], r.headers.get('ETag', cached[2]),
+                r.headers.get('Last-Modified', cached[3]))
+    return (r.status_code, r.headers.get('ETag'),
+            r.headers.get('Last-Modified'))
+
+def check_urls(session, urls, workers, per_host, timeout, cached=None):
+    """
+    Check all of 'urls' (see 'check_url') with 'workers' threads, with at
+    most 'per_host' requests to any one host at a time; 'cached' maps URLs
+    to their cache entries, if any.  Return a dict of URL => result from
+    'check_url'.
+    """
+    if cached is None:
+        cached = {}
+
+    results = {}
+    pending = list(urls)
+    busy = {}                           # host => number of checks running.
+    cond = threading.Condition()
+
+    def next_url():
+        # the first pending URL whose host isn't already busy enough.
+        cond.acquire()
+        try:
+            while pending:
+                for i, url in enumerate(pending):
+                    host = urlparse.urlsplit(url)[1]
+                    if busy.get(host, 0) < per_host:
+                        del pending[i]
+                        busy[host] = busy.get(host, 0) + 1
+                        return url, host
+                cond.wait()
+            return None, None
+        finally:
+            cond.release()
+
+    def worker():
+        while 1:
+            url, host = next_url()
+            if url is None:
+                return
+
+            result = None
+            try:
+                try:
+                    result = check_url(session, url, timeout, cached.get(url))
+                except Exception, e:    # e.g. an intercepted app's error.
+                    result = ('%s: %s' % (e.__class__.__name__, e), None,
+                              None)
+            finally:
+                cond.acquire()
+                try:
+                    results[url] = result
+                    busy[host] -= 1
+                    cond.notifyAll()
+                finally:
+                    cond.release()
+
+    threads = [ threading.Thread(target=worker)
+                for i in range(0, max(1, min(workers, len(urls)))) ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+def _make_session(browser, workers, per_host):
+    """
+    Make a session for checking links that sends the browser's headers &
+    cookies, and refers to the current page.
+    """
+    session = requests.Session()
+    session.headers.update(browser._session.headers)
+    session.cookies.update(browser._session.cookies)
+    if browser.get_url():
+        session.headers['Referer'] = browser.get_url()
+
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    wsgi_intercept.mount(session, pool_connections=workers,
+                         pool_maxsize=per_host)
+    return session
+
 #
 # main function: 'check_links'
 #
 
-def check_links(pattern = '', visited={}):
+def check_links(pattern = '', visited=None):
     """
     >> check_links [ <pattern> ]
 
@@ -45,106 +232,96 @@ def check_links(pattern = '', visited={}):
 
         check_links http://.*\.google\.com
 
-    would check only links to google URLs.  Note that because 'follow'
-    is used to visit the pages, the referrer URL is properly set on the
-    visit.
-    """
-    from twill import commands
+    would check only links to google URLs.  Each unique URL is checked
+    once, concurrently with the others; see 'config check_links.workers'
+    and 'config check_links.per_host'.
 
-    if DEBUG:
-        print 'in check_links'
-    
+    From Python, 'visited' may be a dict of URLs already known to be
+    good; they're skipped, and the good URLs are added to it.
+    """
     OUT = commands.OUT
-    browser = commands.browser
-
-    #
-    # compile the regexp
-    #
-    
-    regexp = None
-    if pattern:
-        regexp = re.compile(pattern)
-
-    #
-    # iterate over all links, collecting those that match.
-    #
-    # note that in the case of duplicate URLs, only one of the
-    # links is actually followed!
-    #
+    browser = commands.get_browser()
 
-    collected_urls = {}
+    if browser.result is None:
+        raise TwillAssertionError("no page to check links on")
 
-    links = list(browser._browser.links())
-    if not links:
+    referrer = browser.get_url()
+    urls = collect_links(browser.result.get_link_index(), pattern)
+    if visited:
+        urls = [ url for url in urls if url not in visited ]
+    if not urls:
         if DEBUG:
             print>>OUT, "no links to check!?"
         return
-        
-    for link in links:
-        url = link.absolute_url
-        url = url.split('#', 1)[0]      # get rid of subpage pointers
 
-        if not (url.startswith('http://') or url.startswith('https://')):
-            if DEBUG:
-               print>>OUT, "url '%s' is not an HTTP link; ignoring" % (url,)
-            continue
+    workers = int(_option('check_links.workers'))
+    per_host = int(_option('check_links.per_host'))
+    timeout = float(_option('check_links.timeout'))
+
+    start_time = time.time()
+
+    # links checked recently enough by anyone sharing the cache are good;
+    # the rest of the cached links only need revalidating.
+    cache = None
+    cached = {}
+    fresh = set()
+    if _option('check_links.cache'):
+        cache = LinkCache(_option('check_links.cache'),
+                          float(_option('check_links.cache_ttl')))
+        cached = cache.get(urls)
+        fresh = set([ url for (url, entry) in cached.items()
+                      if cache.is_fresh(entry, start_time) ])
+
+    try:
+        session = _make_session(browser, workers, per_host)
+        try:
+            results = check_urls(session,
+                                 [ url for url in urls if url not in fresh ],
+                                 workers, per_host, timeout, cached)
+        finally:
+            session.close()
+
+        if cache is not None:
+            cache.put([ (url, status, etag, last_modified)
+                        for (url, (status, etag, last_modified))
+                        in results.items() if status == 200 ])
+    finally:
+        if cache is not None:
+            cache.close()
 
-        if regexp:
-            if regexp.search(url):
-                collected_urls[url] = link
-                if DEBUG:
-                    print>>OUT, "Gathered URL %s -- matched regexp" % (url,)
-            elif DEBUG:
-                print>>OUT, "URL %s doesn't match regexp" % (url,)
+    failed = []
+    for url in urls:
+        if url in fresh:
+            result = 'cached'
         else:
-            collected_urls[url] = link
-            if DEBUG:
-                print>>OUT, "Gathered URL %s." % (url,)
-
-    #
-    # now, for each unique URL, follow the link. Trap ALL exceptions
-    # as failures.
-    #
+            result = results[url][0]
 
-    failed = []
-    for link in collected_urls.values():
-        went = False
-        try:
+        if result in (200, 'cached'):
+            if visited is not None:
+                visited[url] = 1
             if DEBUG:
-                print>>OUT, "Trying %s" % (link.absolute_url,),
-                
-            if not visited.has_key(link.absolute_url):
-                went = True
-                browser.follow_link(link)
-                
-                code = browser.get_code()
-                assert code == 200
-
-                visited[link.absolute_url] = 1
-                
-                if DEBUG:
-                    print>>OUT, '...success!'
-            else:
-                if DEBUG:
-                    print>>OUT, ' (already visited successfully)'
-        except:
-            failed.append(link.absolute_url)
+                print>>OUT, "Checked %s ...success! (%s)" % (url, result)
+        else:
+            failed.append((url, result))
             if DEBUG:
-                print>>OUT, '...failure ;('
+                print>>OUT, "Checked %s ...failure (%s)" % (url, result)
 
-        if went:
-            browser.back()
+    if DEBUG:
+        print>>OUT, 'checked %d links from %s in %.2f s (%d cached)' % \
+              (len(urls), referrer, time.time() - start_time, len(fresh))
 
     if failed:
-        if commands._options['check_links.only_collect_bad_links']:
-            for l in failed:
-                refering_pages = bad_links_dict.get(l, [])
-                print '***', browser.get_url()
-                refering_pages.append(browser.get_url())
-                bad_links_dict[l] = refering_pages
+        if _option('check_links.only_collect_bad_links'):
+            for url, result in failed:
+                referring_pages = bad_links_dict.setdefault(url, [])
+                if referrer not in referring_pages:
+                    referring_pages.append(referrer)
         else:
-            print>>OUT, '\nCould not follow %d links' % (len(failed),)
-            print>>OUT, '\t%s\n' % '\n\t'.join(failed)
+            print>>OUT, '\nCould not follow %d links from %s' % \
+                  (len(failed), referrer)
+            for url, result in failed:
+                print>>OUT, '\t%s (%s)' % (url, result)
+            print>>OUT, ''
             raise TwillAssertionError("broken links on page")
 
 def report_bad_links(fail_if_exist='+', flush_bad_links='+'):
@@ -162,7 +339,7 @@ def report_bad_links(fail_if_exist='+', flush_bad_links='+'):
     bad links will be retained across the function call.
     """
     global bad_links_dict
-    
+
     from twill import utils
     fail_if_exist = utils.make_boolean(fail_if_exist)
     flush_bad_links = utils.make_boolean(flush_bad_links)
@@ -176,7 +353,7 @@ def report_bad_links(fail_if_exist='+', flush_bad_links='+'):
         print>>OUT, '\nCould not follow %d links' % (len(bad_links_dict),)
         for page, referers in bad_links_dict.items():
             err_msg = "\t link '%s' (occurs on: " % (page,)\
-                      + ",".join(referers) + ')' 
+                      + ",".join(referers) + ')'
             print>>OUT, err_msg
 
         if flush_bad_links:
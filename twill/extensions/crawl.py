@@ -0,0 +1,426 @@
+"""
+Extension functions to crawl a Web site.
+
+Usage:
+
+   crawl <start-url> [ <depth> [ <pattern> ] ]
+
+Visit <start-url>, then the pages it links to, and so on breadth-first,
+down to <depth> links away from it (2 by default).  Only URLs matching
+the regexp <pattern> are visited; by default, that's the URLs on the
+same site as <start-url>.  Redirects are treated like links: the URL
+redirected to is only visited if it matches <pattern>.  Each URL is
+reported as it's fetched, with its status, size and latency, and 'crawl'
+fails at the end if any of them couldn't be fetched.
+
+Options:
+
+ * 'crawl.workers', default 8 -- fetch this many URLs at once;
+ * 'crawl.per_host', default 2 -- ...but at most this many on any one host;
+ * 'crawl.delay', default 0 -- wait this many seconds between starting
+   requests to the same host;
+ * 'crawl.timeout', default 10 -- seconds to wait for each server;
+ * 'crawl.max_pages', default 0 -- stop after this many URLs (0: no limit);
+ * 'crawl.max_queued', default 100000 -- keep at most this many URLs
+   waiting to be fetched; links to new URLs found while it's full are
+   skipped, and counted in the report (0: no limit);
+ * 'crawl.resources', default 0 -- follow images, scripts, stylesheets
+   etc. too, and not just links & frames;
+ * 'crawl.expected_urls', default 1000000 -- size the visited-URL set for
+   this many URLs (it grows as needed).
+
+The URLs already seen are kept in a Bloom filter, which takes about 2.5 MB
+per million URLs.  The price is that a new URL is very occasionally (about
+once in 10,000 URLs) mistaken for one already seen, and skipped.
+"""
+
+__all__ = ['crawl']
+
+import re
+import math
+import time
+import Queue
+import struct
+import hashlib
+import urlparse
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from lxml import html
+
+from twill import commands, wsgi_intercept
+from twill.context import get_context
+from twill.utils import normalize_url
+from twill.errors import TwillAssertionError
+
+_default_options = { 'crawl.workers' : 8,
+                     'crawl.per_host' : 2,
+                     'crawl.delay' : 0.,
+                     'crawl.timeout' : 10.,
+                     'crawl.max_pages' : 0,
+                     'crawl.max_queued' : 100000,
+                     'crawl.resources' : False,
+                     'crawl.expected_urls' : 1000000 }
+
+for key, value in _default_options.items():
+    commands._orig_options.setdefault(key, value)  # ...for reset_browser.
+    commands._options.setdefault(key, value)
+
+def _option(key):
+    return get_context().options.get(key, _default_options[key])
+
+# tags whose links lead to other pages, rather than parts of this one.
+_page_tags = set(['a', 'area', 'frame', 'iframe'])
+
+# read at most this much of a page to look for links.
+_max_page_size = 8 * 1024 * 1024
+_chunk_size = 64 * 1024
+
+###
+
+class BloomFilter(object):
+    """
+    A fixed-size set of strings that may report false positives (at about
+    'error_rate', once 'capacity' strings are in it), but never false
+    negatives.
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+
+        n_bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_bits = max(8, n_bits)
+        self.n_hashes = max(1, int(round(self.n_bits / float(capacity) *
+                                         math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _indices(self, key):
+        # 'enhanced double hashing' from two halves of an MD5 digest; plain
+        # h1 + i * h2 gives noticeably more false positives in small filters.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        n_bits = self.n_bits
+        indices = []
+        for i in range(0, self.n_hashes):
+            indices.append(h1 % n_bits)
+            h1 += h2
+            h2 += i
+        return indices
+
+    def __contains__(self, key):
+        bits = self.bits
+        for i in self._indices(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self.bits
+        for i in self._indices(key):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+class VisitedSet(object):
+    """
+    A set of URLs, kept in a chain of Bloom filters that grows as it fills
+    (a 'scalable' Bloom filter), with an overall false positive rate of
+    about 'error_rate'.
+    """
+    def __init__(self, expected=1000000, error_rate=1e-4):
+        self.expected = expected
+        self.error_rate = error_rate
+        self.filters = []
+        self._add_filter()
+
+    def _add_filter(self):
+        # each filter is twice the size of the last, with a tighter error
+        # rate, so that the total stays below 'error_rate'.
+        n = len(self.filters)
+        self.filters.append(BloomFilter(self.expected * 2 ** n,
+                                        self.error_rate * 0.5 ** (n + 1)))
+
+    def __contains__(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        for f in self.filters:
+            if url in f:
+                return True
+        return False
+
+    def add(self, url):
+        """
+        Add 'url' to the set; return False if it was (probably) already
+        there.
+        """
+        if url in self:
+            return False
+
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        f = self.filters[-1]
+        if f.count >= f.capacity:
+            self._add_filter()
+            f = self.filters[-1]
+        f.add(url)
+        return True
+
+    def __len__(self):
+        return sum([ f.count for f in self.filters ])
+
+###
+
+def extract_links(body, url, resources=False):
+    """
+    Return the normalized absolute URLs that the HTML 'body' of the page at
+    'url' links to: links & frames, plus images, scripts etc. if
+    'resources' is set.
+    """
+    try:
+        tree = html.fromstring(body)
+    except Exception:                   # not parseable: no links.
+        return []
+
+    base = tree.xpath('//base/@href')
+    if base:
+        url = urlparse.urljoin(url, base[0].strip())
+
+    links = []
+    for element, attribute, link, pos in tree.iterlinks():
+        if not (resources or element.tag in _page_tags):
+            continue
+        link = normalize_url(link.strip(), url)
+        if link.startswith('http://') or link.startswith('https://'):
+            links.append(link)
+    return links
+
+def fetch(session, url, referrer, timeout, want_links, resources):
+    """
+    Fetch 'url', reading only as much of the body as needed.  Return
+    (status code or error message, size in bytes, latency, links); the
+    links are only looked for if 'want_links' is set and the page is HTML.
+    Redirects aren't followed: the only link of a redirect is the URL it
+    redirects to.
+    """
+    headers = {}
+    if referrer:
+        headers['Referer'] = referrer
+
+    start_time = time.time()
+    try:
+        r = session.get(url, headers=headers, timeout=timeout, stream=True,
+                        allow_redirects=False)
+        try:
+            latency = r.elapsed.total_seconds()
+            is_html = 'html' in r.headers.get('content-type', '')
+
+            # keep as much of the body as is needed to look for links, and
+            # count the rest without keeping it.
+            keep = 0
+            if want_links and is_html and r.status_code == 200:
+                keep = _max_page_size
+
+            pieces = []
+            size = 0
+            for chunk in r.iter_content(_chunk_size):
+                if size < keep:
+                    pieces.append(chunk[:keep - size])
+                size += len(chunk)
+
+            links = []
+            if r.is_redirect:
+                links = [normalize_url(r.headers['location'].strip(), url)]
+            elif pieces:
+                links = extract_links(''.join(pieces), r.url, resources)
+        finally:
+            r.close()
+    except requests.RequestException, e:
+        return (str(e) or e.__class__.__name__, 0,
+                time.time() - start_time, [])
+
+    return (r.status_code, size, latency, links)
+
+def crawl(start_url, depth='2', pattern=''):
+    """
+    >> crawl <start-url> [ <depth> [ <pattern> ] ]
+
+    Crawl the site at <start-url> breadth-first, following links up to
+    <depth> (default 2) levels down, to URLs that match <pattern> (by
+    default, those on the same site).  Report the status, size and
+    latency of each URL as it's fetched, and fail if any URL couldn't be
+    fetched.  See the module documentation for the options.
+    """
+    OUT = commands.OUT
+    browser = commands.get_browser()
+
+    start_url = normalize_url(start_url, browser.get_url())
+    depth = int(depth)
+    if pattern:
+        scope = re.compile(pattern)
+    else:
+        scheme, netloc = urlparse.urlsplit(start_url)[:2]
+        scope = re.compile('^' + re.escape('%s://%s/' % (scheme, netloc)))
+
+    workers = max(1, int(_option('crawl.workers')))
+    per_host = max(1, int(_option('crawl.per_host')))
+    delay = float(_option('crawl.delay'))
+    timeout = float(_option('crawl.timeout'))
+    max_pages = int(_option('crawl.max_pages'))
+    max_queued = int(_option('crawl.max_queued'))
+    resources = bool(_option('crawl.resources'))
+
+    session = requests.Session()
+    session.headers.update(browser._session.headers)
+    session.cookies.update(browser._session.cookies)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    wsgi_intercept.mount(session, pool_connections=workers,
+                         pool_maxsize=per_host)
+
+    #
+    # the frontier is kept per host, so that busy hosts don't hold up the
+    # others; the worker threads just fetch what they're handed.
+    #
+
+    visited = VisitedSet(int(_option('crawl.expected_urls')))
+    visited.add(start_url)
+
+    frontier = {}                       # host => deque of (url, depth, ref)
+    n_queued = 1                        # URLs in the frontier.
+    n_found = 1                         # URLs ever put in the frontier.
+    n_skipped = 0                       # ...or skipped because it was full.
+    busy = {}                           # host => requests in flight.
+    next_start = {}                     # host => earliest next request.
+
+    def enqueue(url, level, referrer):
+        host = urlparse.urlsplit(url)[1]
+        frontier.setdefault(host, deque()).append((url, level, referrer))
+
+    enqueue(start_url, 0, None)
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def worker():
+        while 1:
+            task = tasks.get()
+            if task is None:
+                return
+            url, level, referrer = task
+            start_time = time.time()
+            try:
+                result = fetch(session, url, referrer, timeout, level < depth,
+                               resources)
+            except Exception, e:        # e.g. an intercepted app's error.
+                result = ('%s: %s' % (e.__class__.__name__, e), 0,
+                          time.time() - start_time, [])
+            results.put((task, result))
+
+    threads = [ threading.Thread(target=worker) for i in range(0, workers) ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+
+    print>>OUT, 'crawling %s to depth %d' % (start_url, depth)
+    print>>OUT, '%-6s %10s %9s  %s  %s' % ('status', 'size', 'latency',
+                                         'depth', 'url')
+
+    start_time = time.time()
+    n_started = 0
+    n_fetched = 0
+    failed = []
+
+    try:
+        in_flight = 0
+        while in_flight or frontier:
+            #
+            # start whatever the limits allow.
+            #
+
+            now = time.time()
+            wait = 0.5
+            for host in frontier.keys():
+                queue = frontier[host]
+                while queue and in_flight < workers and \
+                      busy.get(host, 0) < per_host and \
+                      not (max_pages and n_started >= max_pages):
+                    if next_start.get(host, 0) > now:
+                        wait = min(wait, next_start[host] - now)
+                        break
+                    tasks.put(queue.popleft())
+                    n_queued -= 1
+                    busy[host] = busy.get(host, 0) + 1
+                    next_start[host] = now + delay
+                    in_flight += 1
+                    n_started += 1
+                if not queue:
+                    del frontier[host]
+
+            if max_pages and n_started >= max_pages:
+                frontier.clear()        # (let those in flight finish.)
+                n_queued = 0
+
+            if not in_flight:
+                if frontier:
+                    time.sleep(wait)    # politeness delay.
+                continue
+
+            #
+            # report a result, and queue up the new links it found.
+            #
+
+            try:
+                (url, level, referrer), result = results.get(True, wait)
+            except Queue.Empty:
+                continue
+
+            in_flight -= 1
+            n_fetched += 1
+            busy[urlparse.urlsplit(url)[1]] -= 1
+
+            status, size, latency, links = result
+            print>>OUT, '%-6s %10d %7.1fms  %5d  %s' % \
+                  (status, size, latency * 1000, level, url)
+
+            if not isinstance(status, int) or status >= 400:
+                failed.append((url, status, referrer))
+
+            # (a redirect isn't a step further away from the start.)
+            next_level = level + 1
+            if isinstance(status, int) and 300 <= status < 400:
+                next_level = level
+
+            for link in links:
+                if max_pages and n_found >= max_pages:
+                    break               # (no more are needed.)
+                if not scope.search(link) or link in visited:
+                    continue
+                if max_queued and n_queued >= max_queued:
+                    n_skipped += 1
+                    continue
+
+                visited.add(link)
+                enqueue(link, next_level, url)
+                n_queued += 1
+                n_found += 1
+    finally:
+        for t in threads:
+            tasks.put(None)
+        session.close()
+
+    elapsed = time.time() - start_time
+    print>>OUT, '\ncrawled %d URLs in %.2f s (%.1f/s), %d failed' % \
+          (n_fetched, elapsed, n_fetched / max(elapsed, 0.001), len(failed))
+    if n_skipped:
+        print>>OUT, 'skipped %d links: crawl.max_queued URLs were already ' \
+              'waiting' % (n_skipped,)
+
+    if failed:
+        print>>OUT, '\nCould not fetch %d URLs' % (len(failed),)
+        for url, status, referrer in failed:
+            print>>OUT, '\t%s (%s) (linked from %s)' % (url, status,
+                                                      referrer or '-')
+        print>>OUT, ''
+        raise TwillAssertionError("%d URLs could not be fetched" % \
+                                  (len(failed),))
@@ -19,7 +19,6 @@ Commands:
 """
 
 import twill, twill.utils
-import re
 
 __all__ = [ 'fv_match', 'fv_multi_match', 'fv_multi', 'fv_multi_sub' ]
 
@@ -40,9 +39,7 @@ def fv_match(formname, regexp, value):
         print 'no such form', formname
         return
 
-    regexp = re.compile(regexp)
-
-    matches = [ ctl for ctl in form.inputs if regexp.search(str(ctl.get("name"))) ]
+    matches = state.get_form_index(form).find_by_regexp(regexp)
 
     if matches:
         print '-- matches %d' % (len(matches),)
@@ -73,9 +70,7 @@ def fv_multi_match(formname, regexp, *values):
         print 'no such form', formname
         return
 
-    regexp = re.compile(regexp)
-
-    matches = [ ctl for ctl in form.inputs if regexp.search(str(ctl.get("name"))) ]
+    matches = state.get_form_index(form).find_by_regexp(regexp)
 
     if matches:
         print '-- matches %d, values %d' % (len(matches), len(values))
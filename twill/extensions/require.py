@@ -107,10 +107,11 @@ def require(what):
     # install the post-load hook function.
     #
 
-    if _require_post_load_hook not in commands.browser._post_load_hooks:
+    browser = commands.get_browser()
+    if _require_post_load_hook not in browser._post_load_hooks:
         if DEBUG:
             print>>commands.OUT, 'INSTALLING POST-LOAD HOOK'
-        commands.browser._post_load_hooks.append(_require_post_load_hook)
+        browser._post_load_hooks.append(_require_post_load_hook)
 
     #
     # add the requirement.
@@ -129,9 +130,10 @@ def no_require():
     """
     from twill import commands
     
-    l = commands.browser._post_load_hooks
+    browser = commands.get_browser()
+    l = browser._post_load_hooks
     l = [ fn for fn in l if fn != _require_post_load_hook ]
-    commands.browser._post_load_hooks = l
+    browser._post_load_hooks = l
 
     global _requirements
     _requirements = []
@@ -0,0 +1,80 @@
+"""
+A persistent cache of link-check results, for the 'check_links' extension.
+
+Good links are kept in an sqlite database as URL => (status, time checked,
+ETag, Last-Modified).  Links checked less than 'ttl' seconds ago aren't
+checked again; older ones are revalidated with a conditional request
+(If-None-Match / If-Modified-Since), which the server can answer with a
+bodiless 304.
+
+sqlite does its own locking, so any number of processes -- e.g. the
+workers of 'twill-sh -j' or 'twill-fork' -- can share one cache file.
+Each LinkCache object must only be used by the thread that opened it.
+"""
+
+import time
+import sqlite3
+
+# seconds to wait for other processes to finish writing.
+_lock_timeout = 60.
+
+class LinkCache(object):
+    """
+    Link-check results, stored in the sqlite database 'filename'.
+    """
+    def __init__(self, filename, ttl=86400.):
+        self.ttl = ttl
+        self.db = sqlite3.connect(filename, timeout=_lock_timeout)
+        try:
+            # let readers carry on while another process writes.
+            self.db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:   # (e.g. busy: it'll do without.)
+            pass
+        self.db.execute('CREATE TABLE IF NOT EXISTS links '
+                        '(url TEXT PRIMARY KEY, status INTEGER, '
+                        'checked REAL, etag TEXT, last_modified TEXT)')
+        self.db.commit()
+
+    def get(self, urls):
+        """
+        Return a dict of URL => (status, time checked, ETag, Last-Modified)
+        for those of 'urls' that are in the cache.
+        """
+        entries = {}
+        urls = list(urls)
+        for i in range(0, len(urls), 500):  # (sqlite's limit is 999.)
+            batch = urls[i:i + 500]
+            cursor = self.db.execute('SELECT url, status, checked, etag, '
+                                     'last_modified FROM links '
+                                     'WHERE url IN (%s)' % \
+                                     (','.join(['?'] * len(batch)),),
+                                     batch)
+            for row in cursor:
+                entries[row[0]] = tuple(row[1:])
+        return entries
+
+    def is_fresh(self, entry, now=None):
+        """
+        Return True if 'entry' (from 'get') is recent enough not to need
+        revalidating.
+        """
+        if now is None:
+            now = time.time()
+        return now - entry[1] < self.ttl
+
+    def put(self, records):
+        """
+        Store the list of (URL, status, ETag, Last-Modified) 'records', as
+        of now.
+        """
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO links '
+                            '(url, status, checked, etag, last_modified) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            [ (url, status, now, etag, last_modified)
+                              for (url, status, etag, last_modified)
+                              in records ])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,886 @@
+"""
+Load generation for twill-fork.
+
+'run_closed' runs the scripts back-to-back a fixed number of times in
+each of several processes.  'run_profile' is open-model: it starts script
+iterations on a fixed arrival schedule, whether or not earlier iterations
+have finished.
+
+The schedule comes from a load profile, a list of (shape, duration, rate,
+end rate) stages.  In a profile file, each line is one stage ::
+
+   # shape   duration   rate   [end rate]
+   step      30s        10/s
+   ramp      2m         10/s   50/s
+   spike     10s        200/s
+   soak      1h         50/s
+
+'step', 'spike' and 'soak' all run at a constant rate; 'ramp' changes the
+rate linearly from 'rate' to 'end rate'.  Durations are in seconds unless
+suffixed with 's', 'm' or 'h'; rates are per second unless given as
+'/m' (per minute).
+
+Instead of running the same scripts every iteration, both can pick one of
+several weighted scenarios for each iteration; see 'parse_scenarios'.
+
+'run_users' is closed-model too, but runs many virtual users as threads
+of a single process, each in its own twill context (see twill.context).
+
+'intercept_app' benchmarks a WSGI app in-process: the scripts' requests
+to it go through twill.wsgi_intercept instead of sockets, and the time
+spent in the app is recorded under the '<app>' pseudo-command, apart from
+the time twill itself takes.
+"""
+
+import sys
+import os
+import time
+import math
+import random
+import select
+import threading
+import traceback
+import urllib
+import Queue
+from cPickle import load, dump
+
+import stats
+import wsgi_intercept
+from context import TwillContext, set_context
+from errors import TwillException
+from utils import start_worker
+
+shapes = ('step', 'ramp', 'spike', 'soak')
+
+_duration_units = { 's' : 1., 'm' : 60., 'h' : 3600. }
+
+# thread stack size for 'run_users' virtual users.
+_user_stack_size = 512 * 1024
+
+def parse_duration(s):
+    """
+    Parse a duration like '30', '30s', '5m' or '1h' into seconds.
+    """
+    s = s.strip().lower()
+    unit = 1.
+    if s and s[-1] in _duration_units:
+        unit = _duration_units[s[-1]]
+        s = s[:-1]
+    try:
+        return float(s) * unit
+    except ValueError:
+        raise TwillException("invalid duration: '%s'" % (s,))
+
+def parse_rate(s):
+    """
+    Parse a rate like '10', '10/s' or '600/m' into arrivals per second.
+    """
+    s = s.strip().lower()
+    unit = 1.
+    if s.endswith('/s'):
+        s = s[:-2]
+    elif s.endswith('/m'):
+        s = s[:-2]
+        unit = 1 / 60.
+    try:
+        return float(s) * unit
+    except ValueError:
+        raise TwillException("invalid rate: '%s'" % (s,))
+
+def parse_profile(lines):
+    """
+    Parse the lines of a load profile into a list of
+    (shape, duration, rate, end rate) stages.
+    """
+    profile = []
+    for n, line in enumerate(lines):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        words = line.split()
+        shape = words[0].lower()
+        if shape not in shapes or len(words) not in (3, 4) or \
+           (len(words) == 4 and shape != 'ramp'):
+            raise TwillException("invalid load profile stage on line %d: '%s'"
+                                 % (n + 1, line,))
+
+        duration = parse_duration(words[1])
+        rate = end_rate = parse_rate(words[2])
+        if len(words) == 4:
+            end_rate = parse_rate(words[3])
+
+        profile.append((shape, duration, rate, end_rate))
+
+    return profile
+
+def load_profile(filename):
+    """
+    Load a load profile from a file; see 'parse_profile'.
+    """
+    fp = open(filename)
+    try:
+        return parse_profile(fp)
+    finally:
+        fp.close()
+
+def arrival_times(profile, start_time=0.):
+    """
+    Generate the intended start time of each iteration in the profile.
+    """
+    t0 = start_time
+    for (shape, duration, rate, end_rate) in profile:
+        # the number of arrivals by time t into the stage is
+        #    N(t) = rate * t + a * t**2, where a = (end_rate - rate) / 2d,
+        # so the k'th arrival is at the root of a t**2 + rate t - k = 0.
+        if duration <= 0:
+            continue
+
+        a = (end_rate - rate) / (2. * duration)
+        k = 0
+        while 1:
+            if a:
+                disc = rate * rate + 4 * a * k
+                if disc < 0:            # ramped down to nothing.
+                    break
+                t = (-rate + math.sqrt(disc)) / (2 * a)
+            elif rate:
+                t = k / rate
+            else:
+                break
+
+            if t >= duration:
+                break
+            yield t0 + t
+            k += 1
+
+        t0 += duration
+
+###
+#
+# scenarios: weighted mixes of scripts.
+#
+
+def parse_think_time(spec):
+    """
+    Parse a think-time spec into a function returning a think time in
+    seconds: 'S' or 'const:S', 'uniform:A:B', 'exp:MEAN' (exponentially
+    distributed), or 'normal:MEAN:SD' (never less than 0).
+    """
+    words = spec.split(':')
+    try:
+        args = [ float(w) for w in words[1:] ]
+        if len(words) == 1:
+            t = float(words[0])
+            return lambda: t
+        elif words[0] == 'const' and len(args) == 1:
+            return lambda: args[0]
+        elif words[0] == 'uniform' and len(args) == 2:
+            return lambda: random.uniform(args[0], args[1])
+        elif words[0] == 'exp' and len(args) == 1 and args[0] > 0:
+            return lambda: random.expovariate(1. / args[0])
+        elif words[0] == 'normal' and len(args) == 2:
+            return lambda: max(0., random.normalvariate(args[0], args[1]))
+    except ValueError:
+        pass
+
+    raise TwillException("invalid think time: '%s'" % (spec,))
+
+class Scenario(object):
+    """
+    A named list of scripts that are run together as one iteration.
+
+    'weight' is the relative chance of picking the scenario for an
+    iteration, 'think' a think-time spec (see 'parse_think_time') for the
+    pause after each iteration, and 'users' the number of processes that
+    run only this scenario in closed-loop runs (None: share the others).
+    Requests are reported per scenario, by prefixing their command names
+    with the scenario's 'label' (if any).
+    """
+    def __init__(self, name, filenames, weight=1., think=None, users=None,
+                 label=None):
+        self.name = name
+        self.filenames = filenames
+        self.weight = weight
+        self.think = think
+        self.users = users
+        self.label = label
+
+        self.think_time = None
+        if think:
+            self.think_time = parse_think_time(think)
+
+def parse_scenarios(lines, dirname=''):
+    """
+    Parse the lines of a scenario file, one scenario per line ::
+
+       # name     weight  script(s)                [options]
+       browse     70      browse.twill             think=exp:2
+       search     25      search.twill             think=uniform:1:3
+       checkout   5       cart.twill checkout.twill users=2
+
+    The options are 'think=<spec>' (see 'parse_think_time') and
+    'users=<n>'.  Relative script names are relative to 'dirname'.
+    Return a list of Scenario objects.
+    """
+    scenarios = []
+    for n, line in enumerate(lines):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        words = line.split()
+        filenames = []
+        kw = {}
+        try:
+            name, weight = words[0], float(words[1])
+            for word in words[2:]:
+                if '=' in word:
+                    key, value = word.split('=', 1)
+                    if key == 'think':
+                        kw['think'] = value
+                    elif key == 'users':
+                        kw['users'] = int(value)
+                    else:
+                        raise ValueError
+                else:
+                    filenames.append(os.path.join(dirname, word))
+        except (IndexError, ValueError):
+            filenames = None
+
+        if not filenames or weight < 0:
+            raise TwillException("invalid scenario on line %d: '%s'"
+                                 % (n + 1, line,))
+
+        scenarios.append(Scenario(name, filenames, weight, label=name, **kw))
+
+    if not scenarios:
+        raise TwillException("no scenarios given")
+    return scenarios
+
+def load_scenarios(filename):
+    """
+    Load scenarios from a file; see 'parse_scenarios'.
+    """
+    fp = open(filename)
+    try:
+        return parse_scenarios(fp, os.path.dirname(filename))
+    finally:
+        fp.close()
+
+def pick_scenario(scenarios):
+    """
+    Pick one of the scenarios at random, by weight.
+    """
+    total = sum([ s.weight for s in scenarios ])
+    x = random.random() * total
+    for s in scenarios:
+        x -= s.weight
+        if x < 0:
+            return s
+    return scenarios[-1]
+
+def assign_scenarios(scenarios, processes):
+    """
+    Return the list of scenarios that each process of a closed-loop run
+    picks from: one process for each user of the scenarios with a user
+    count, plus 'processes' processes that share the rest.
+    """
+    choices = []
+    for s in scenarios:
+        if s.users:
+            choices.extend([[s]] * s.users)
+    shared = [ s for s in scenarios if not s.users ]
+    if shared:
+        choices.extend([shared] * processes)
+    return choices
+
+def _plain_scenarios(filenames):
+    # without a scenario file, every iteration runs all of the scripts.
+    return [ Scenario(' '.join(filenames), filenames) ]
+
+def _run_scenario(scenario, initial_url, reuse_session):
+    from parse import execute_file
+
+    stats.set_scenario(scenario.label)
+    try:
+        for filename in scenario.filenames:
+            execute_file(filename, initial_url=initial_url,
+                         reuse_session=reuse_session)
+    finally:
+        stats.set_scenario(None)
+
+###
+
+def _iteration_runner(scenarios, initial_url, reuse_session):
+    """
+    Return a worker job function (see twill.utils.start_worker) that runs
+    an iteration of a scenario for each (intended start time, scenario
+    index) job, and returns the request statistics recorded during it.
+    """
+    def run_iteration(job):
+        intended, i = job
+        scenario = scenarios[i]
+
+        request_stats = stats.start_recording()
+        start_time = time.time()
+
+        error = False
+        try:
+            _run_scenario(scenario, initial_url, reuse_session)
+        except Exception, e:
+            print '[twill-fork: pid %d : iteration FAILED: %s]' % \
+                  (os.getpid(), e,)
+            error = True
+
+        # measure from the *intended* start, so that time spent waiting
+        # for a free worker is not hidden.
+        end_time = time.time()
+        request_stats.record('<iteration>', scenario.name,
+                             end_time - intended, error)
+        request_stats.record('<start lag>', scenario.name,
+                             max(0., start_time - intended))
+        stats.stop_recording()
+
+        return request_stats
+
+    return run_iteration
+
+def run_profile(filenames, profile, processes, initial_url=None,
+                reuse_session=False, report_interval=5., report=None,
+                on_stats=None, scenarios=None):
+    """
+    Run iterations of the given scripts on the arrival schedule of the
+    profile, across a pool of 'processes' workers.  Iterations that come
+    due while all of the workers are busy wait for the next free worker.
+    With 'reuse_session', each worker keeps its HTTP connections open
+    from one iteration to the next.
+
+    If 'scenarios' are given, each iteration runs one of them, picked by
+    weight, instead of the scripts.  (Think times and user counts only
+    apply to closed-loop runs.)
+
+    Every 'report_interval' seconds, call 'report(stats, elapsed)' with
+    the statistics so far.  'on_stats(stats)', if given, is called with
+    each batch of new statistics as it comes in from a worker.
+
+    Return (request statistics, elapsed time, number of iterations).
+    """
+    if not scenarios:
+        scenarios = _plain_scenarios(filenames)
+    index = dict([ (s, i) for (i, s) in enumerate(scenarios) ])
+
+    request_stats = stats.RequestStats()
+
+    workers = {}                        # result file => (pid, job file)
+    run_iteration = _iteration_runner(scenarios, initial_url, reuse_session)
+    for i in range(processes):
+        pid, job_fp, result_fp = start_worker(run_iteration)
+        workers[result_fp] = (pid, job_fp)
+    idle = workers.keys()
+
+    start_time = time.time()
+    next_report = start_time + report_interval
+
+    schedule = arrival_times(profile, start_time)
+    next_arrival = next(schedule, None)
+    due = []                            # intended start times, in order.
+    n_started = 0
+
+    try:
+        while 1:
+            now = time.time()
+            while next_arrival is not None and next_arrival <= now:
+                due.append(next_arrival)
+                next_arrival = next(schedule, None)
+
+            while due and idle:
+                job_fp = workers[idle.pop()][1]
+                job = (due.pop(0), index[pick_scenario(scenarios)])
+                dump(job, job_fp, 2)
+                job_fp.flush()
+                n_started += 1
+
+            if next_arrival is None and not due and \
+                   len(idle) == len(workers):
+                break
+
+            if now >= next_report:
+                if report:
+                    report(request_stats, now - start_time)
+                next_report = now + report_interval
+
+            timeout = next_report - now
+            if next_arrival is not None:
+                timeout = min(timeout, next_arrival - now)
+
+            busy = [ fp for fp in workers if fp not in idle ]
+            ready, _, _ = select.select(busy, [], [], max(0, timeout))
+            for result_fp in ready:
+                try:
+                    delta = load(result_fp)
+                    request_stats.merge(delta)
+                    if on_stats:
+                        on_stats(delta)
+                except EOFError:
+                    raise TwillException("twill-fork worker %d died" %
+                                         (workers[result_fp][0],))
+                idle.append(result_fp)
+    finally:
+        for result_fp, (pid, job_fp) in workers.items():
+            try:
+                dump(None, job_fp, 2)
+                job_fp.close()
+            except (IOError, OSError):  # it died.
+                pass
+            os.waitpid(pid, 0)
+            result_fp.close()
+
+    return request_stats, time.time() - start_time, n_started
+
+###
+
+def _run_closed_child(scenarios, repeat, initial_url, reuse_session,
+                      send_interval, status_fp):
+    print '[twill-fork: pid %d : executing %d times]' % (os.getpid(), repeat)
+
+    def send(message):
+        dump(message, status_fp, 2)
+        status_fp.flush()
+
+    random.seed()                       # don't pick what the others pick.
+
+    request_stats = stats.start_recording()
+    start_time = last_sent = time.time()
+
+    try:
+        for i in range(0, repeat):
+            scenario = pick_scenario(scenarios)
+
+            iteration_start = time.time()
+            _run_scenario(scenario, initial_url, reuse_session)
+            if scenario.label:
+                stats.get_recording().record('<iteration>', scenario.name,
+                                             time.time() - iteration_start)
+
+            if scenario.think_time:
+                time.sleep(scenario.think_time())
+
+            # send the requests recorded since the last time.
+            if time.time() - last_sent >= send_interval:
+                send(('stats', request_stats))
+                request_stats = stats.start_recording()
+                last_sent = time.time()
+    finally:
+        send(('stats', stats.stop_recording()))
+
+    end_time = time.time()
+    this_time = end_time - start_time
+
+    # report statistics
+    send(('done', this_time, repeat))
+    status_fp.close()
+
+def run_closed(filenames, number, processes, initial_url=None,
+               reuse_session=False, report_interval=5., report=None,
+               on_stats=None, scenarios=None):
+    """
+    Run the given scripts 'number' times in all, split across 'processes'
+    forked processes that each run them back-to-back.  'report' and
+    'on_stats' are as for 'run_profile'.
+
+    If 'scenarios' are given, each iteration runs one of them instead,
+    picked by weight from those without a user count.  Scenarios with a
+    user count get that many extra processes of their own.
+
+    Return (request statistics, elapsed time, total time spent in the
+    processes that finished, number of runs that finished, failed flag).
+    """
+    if not scenarios:
+        scenarios = _plain_scenarios(filenames)
+
+    choices = assign_scenarios(scenarios, processes)
+    processes = len(choices)
+
+    average_number = int(number / processes)
+    last_number = average_number + number % processes
+
+    # how often the children send their request statistics to the parent.
+    send_interval = min(1., report_interval)
+
+    #
+    # start a bunch of child processes & record their pids in the parent.
+    # each child streams its statistics back to the parent over a pipe.
+    #
+
+    child_pids = []
+    child_pipes = {}                    # read end of pipe => child pid
+
+    for i in range(0, processes):
+        if i == 0:
+            repeat = last_number        # make sure we execute 'em *all*
+        else:
+            repeat = average_number
+
+        pipe_r, pipe_w = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(pipe_r)
+            status = 0
+            try:
+                try:
+                    _run_closed_child(choices[i], repeat, initial_url,
+                                      reuse_session, send_interval,
+                                      os.fdopen(pipe_w, 'wb'))
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        else:
+            os.close(pipe_w)
+            child_pids.append(pid)      # keep track of children
+            child_pipes[os.fdopen(pipe_r, 'rb')] = pid
+
+    total_time = 0.
+    total_exec = 0
+    failed = False
+
+    request_stats = stats.RequestStats()
+    done = {}
+
+    # merge the statistics streaming in from the children 'til they all
+    # close their pipes, reporting on the way.
+
+    start_time = time.time()
+    next_report = start_time + report_interval
+
+    open_pipes = child_pipes.keys()
+    while open_pipes:
+        timeout = max(0, next_report - time.time())
+        ready, _, _ = select.select(open_pipes, [], [], timeout)
+        for fp in ready:
+            try:
+                message = load(fp)
+            except EOFError:
+                open_pipes.remove(fp)
+                fp.close()
+                continue
+
+            if message[0] == 'stats':
+                request_stats.merge(message[1])
+                if on_stats:
+                    on_stats(message[1])
+            else:
+                done[child_pipes[fp]] = message[1:]
+
+        now = time.time()
+        if now >= next_report:
+            if report:
+                report(request_stats, now - start_time)
+            next_report = now + report_interval
+
+    elapsed = time.time() - start_time
+
+    # iterate over all the child pids, wait 'til they finish, and then
+    # sum statistics.
+
+    for child_pid in child_pids:
+        child_pid, status = os.waitpid(child_pid, 0)
+
+        # status != 0 indicates failure:
+
+        if status != 0 or child_pid not in done:
+            print '[twill-fork parent: process %d FAILED: exit status %d]' % (child_pid, status,)
+            print '[twill-fork parent: (not counting stats for this process)]'
+            failed = True
+        else:
+            # record statistics, otherwise
+
+            (this_time, n_executed) = done[child_pid]
+
+            total_time += this_time
+            total_exec += n_executed
+
+    return request_stats, elapsed, total_time, total_exec, failed
+
+###
+
+def _run_user(scenarios, adapter, repeat, deadline, initial_url,
+              send_interval, messages):
+    # one virtual user: a thread with its own twill context, running
+    # scenarios back-to-back over the shared connection pool.
+    context = TwillContext()
+    session = context.browser._session
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    set_context(context)
+
+    request_stats = stats.start_recording()
+    start_time = last_sent = time.time()
+    n_executed = 0
+    status = 0
+
+    try:
+        try:
+            while (repeat is None or n_executed < repeat) and \
+                  (deadline is None or time.time() < deadline):
+                scenario = pick_scenario(scenarios)
+
+                iteration_start = time.time()
+                error = False
+                try:
+                    _run_scenario(scenario, initial_url, True)
+                except Exception, e:
+                    # carry on, so that the load doesn't drop.
+                    print '[twill-fork: %s : iteration FAILED: %s]' % \
+                          (threading.currentThread().getName(), e,)
+                    error = True
+                    status = 1
+
+                n_executed += 1
+                if scenario.label or error:
+                    request_stats.record('<iteration>', scenario.name,
+                                         time.time() - iteration_start, error)
+
+                if scenario.think_time:
+                    time.sleep(scenario.think_time())
+
+                if time.time() - last_sent >= send_interval:
+                    messages.put(('stats', request_stats))
+                    request_stats = stats.start_recording()
+                    last_sent = time.time()
+        except:
+            traceback.print_exc()
+            status = 1
+    finally:
+        messages.put(('stats', stats.stop_recording()))
+        messages.put(('done', status, time.time() - start_time, n_executed))
+
+def run_users(filenames, users, number=None, duration=None,
+              initial_url=None, report_interval=5., report=None,
+              on_stats=None, scenarios=None):
+    """
+    Run 'users' virtual users as threads of this process.  Each user has
+    its own twill context -- browser, cookies, history, options and
+    variables -- but they all share one pool of HTTP connections, so a
+    single process can drive many more concurrent users than it could
+    run processes.
+
+    The users run the scripts (or 'scenarios', as for 'run_closed')
+    back-to-back, 'number' times in all, or until 'duration' seconds have
+    passed; each user's browser is reset between runs, as with
+    'reuse_session'.  A run that fails is recorded as an '<iteration>'
+    error, and the user goes on to the next one.  'report' and 'on_stats'
+    are as for 'run_profile'.
+
+    Return (request statistics, elapsed time, total time spent in the
+    users that finished, number of runs that finished, failed flag).
+    """
+    from requests.adapters import HTTPAdapter
+    import browser
+
+    if not scenarios:
+        scenarios = _plain_scenarios(filenames)
+    choices = assign_scenarios(scenarios, users)
+    users = len(choices)
+
+    repeats = [None] * users
+    if number is not None:
+        repeats = [ int(number / users) ] * users
+        repeats[0] += number % users
+
+    deadline = None
+    if duration is not None:
+        deadline = time.time() + duration
+
+    maxsize = max(users, browser.pool_sizes.get(None, 0))
+    adapter = HTTPAdapter(pool_maxsize=maxsize)
+
+    send_interval = min(1., report_interval)
+    messages = Queue.Queue()
+
+    # the users spend most of their time waiting on the network, so they
+    # don't need much stack.
+    old_stack_size = threading.stack_size(_user_stack_size)
+    try:
+        for i in range(0, users):
+            t = threading.Thread(target=_run_user,
+                                 args=(choices[i], adapter, repeats[i],
+                                       deadline, initial_url, send_interval,
+                                       messages))
+            t.setDaemon(True)
+            t.start()
+    finally:
+        threading.stack_size(old_stack_size)
+
+    total_time = 0.
+    total_exec = 0
+    failed = False
+
+    request_stats = stats.RequestStats()
+    n_done = 0
+
+    start_time = time.time()
+    next_report = start_time + report_interval
+
+    while n_done < users:
+        try:
+            message = messages.get(True,
+                                   max(0.01, next_report - time.time()))
+        except Queue.Empty:
+            message = None
+
+        if message is None:
+            pass
+        elif message[0] == 'stats':
+            request_stats.merge(message[1])
+            if on_stats:
+                on_stats(message[1])
+        else:
+            status, this_time, n_executed = message[1:]
+            n_done += 1
+            total_time += this_time
+            total_exec += n_executed
+            if status:
+                failed = True
+
+        now = time.time()
+        if now >= next_report:
+            if report:
+                report(request_stats, now - start_time)
+            next_report = now + report_interval
+
+    adapter.close()
+
+    return (request_stats, time.time() - start_time, total_time, total_exec,
+            failed)
+
+###
+
+def load_app(spec):
+    """
+    Return the WSGI app named by 'spec', 'module:app' (or 'module', for
+    'module:application').
+    """
+    if ':' in spec:
+        module_name, app_name = spec.split(':', 1)
+    else:
+        module_name, app_name = spec, 'application'
+
+    try:
+        module = __import__(module_name, {}, {}, [app_name])
+    except ImportError, e:
+        raise TwillException("can't import '%s': %s" % (module_name, e))
+
+    try:
+        return getattr(module, app_name)
+    except AttributeError:
+        raise TwillException("module '%s' has no '%s'" % (module_name,
+                                                          app_name))
+
+class _TimedResult(object):
+    """
+    The iterable returned by a _TimedApp: time the app's work on the
+    response body as it's read, and record the total when it's closed.
+    """
+    def __init__(self, result, url, seconds):
+        self.url = url
+        self.seconds = seconds
+
+        start_time = time.time()
+        self.result = result
+        self.iterator = iter(result)
+        self.seconds += time.time() - start_time
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start_time = time.time()
+        try:
+            return self.iterator.next()
+        finally:
+            self.seconds += time.time() - start_time
+
+    def close(self):
+        start_time = time.time()
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.seconds += time.time() - start_time
+            stats.record_app_time(self.url, self.seconds)
+
+class _TimedFile(object):
+    """
+    The file in a wsgi.file_wrapper response from a _TimedApp: time the
+    reads, and record the total when it's closed.  (The file_wrapper is
+    passed on, so that wsgi_intercept can still read the file directly.)
+    """
+    def __init__(self, filelike, url, seconds):
+        self.filelike = filelike
+        self.url = url
+        self.seconds = seconds
+
+    def read(self, *args):
+        start_time = time.time()
+        try:
+            return self.filelike.read(*args)
+        finally:
+            self.seconds += time.time() - start_time
+
+    def readline(self, *args):
+        start_time = time.time()
+        try:
+            return self.filelike.readline(*args)
+        finally:
+            self.seconds += time.time() - start_time
+
+    def close(self):
+        start_time = time.time()
+        try:
+            if hasattr(self.filelike, 'close'):
+                self.filelike.close()
+        finally:
+            self.seconds += time.time() - start_time
+            stats.record_app_time(self.url, self.seconds)
+
+class _TimedApp(object):
+    """
+    WSGI middleware that records how long 'app' takes to respond to each
+    URL; see stats.record_app_time.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        url = 'http://%s%s%s' % (environ.get('HTTP_HOST',
+                                             environ['SERVER_NAME']),
+                                 urllib.quote(environ['SCRIPT_NAME']),
+                                 urllib.quote(environ['PATH_INFO']))
+
+        start_time = time.time()
+        try:
+            result = self.app(environ, start_response)
+        except:
+            stats.record_app_time(url, time.time() - start_time)
+            raise
+        if isinstance(result, wsgi_intercept.FileWrapper):
+            return wsgi_intercept.FileWrapper(
+                _TimedFile(result.filelike, url, time.time() - start_time),
+                result.blksize)
+        return _TimedResult(result, url, time.time() - start_time)
+
+def intercept_app(app, host='localhost', port=80, processes=1):
+    """
+    Send the requests to host:port to the WSGI 'app', in-process (see
+    twill.wsgi_intercept), timing it with each request.  The app is told
+    it may be run by 'processes' processes at once.
+    """
+    wsgi_intercept.multiprocess = processes > 1
+    timed_app = _TimedApp(app)
+    wsgi_intercept.add_wsgi_intercept(host, port, lambda: timed_app)
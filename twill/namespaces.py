@@ -1,7 +1,12 @@
 """
 Global and local dictionaries, + initialization/utility functions.
+
+Each twill context (see twill.context) has its own global dictionary and
+stack of local dictionaries; 'global_dict' is the default context's.
 """
 
+from context import get_context
+
 global_dict = {}
 
 def init_global_dict():
@@ -16,10 +21,8 @@ def init_global_dict():
     command_list = twill.commands.__all__
     
     import twill.parse
-    twill.parse.command_list.extend(command_list)
-
-# local dictionaries.
-_local_dict_stack = []
+    for command in command_list:
+        twill.parse.register_command(command, getattr(twill.commands, command))
 
 ###
 
@@ -30,7 +33,7 @@ def new_local_dict():
     Initialize a new local dictionary & push it onto the stack.
     """
     d = {}
-    _local_dict_stack.append(d)
+    get_context().local_dict_stack.append(d)
 
     return d
 
@@ -38,7 +41,7 @@ def pop_local_dict():
     """
     Get rid of the current local dictionary.
     """
-    _local_dict_stack.pop()
+    get_context().local_dict_stack.pop()
 
 ###
 
@@ -46,12 +49,13 @@ def get_twill_glocals():
     """
     Return global dict & current local dictionary.
     """
-    global global_dict, _local_dict_stack
-    assert global_dict is not None, "must initialize global namespace first!"
+    context = get_context()
+    assert context.global_dict is not None, \
+           "must initialize global namespace first!"
 
-    if len(_local_dict_stack) == 0:
+    if len(context.local_dict_stack) == 0:
         new_local_dict()
 
-    return global_dict, _local_dict_stack[-1]
+    return context.global_dict, context.local_dict_stack[-1]
 
 ###
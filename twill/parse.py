@@ -3,7 +3,12 @@ Code parsing and evaluation for the twill mini-language.
 """
 
 import sys
+import os
+import __builtin__
 from cStringIO import StringIO
+import cPickle
+import hashlib
+import threading
 
 from errors import TwillAssertionError, TwillNameError
 from pyparsing import OneOrMore, Word, printables, quotedString, Optional, \
@@ -12,6 +17,8 @@ from pyparsing import OneOrMore, Word, printables, quotedString, Optional, \
 
 import twill.commands as commands
 import namespaces
+import stats
+from context import set_context
 import re
 
 ### pyparsing stuff
@@ -59,49 +66,176 @@ full_command.setName('full_command')
 ###
 
 command_list = []           # filled in by namespaces.init_global_dict().
+command_table = {}          # command name => function, ditto.
+
+def register_command(name, fn):
+    """
+    Make the function 'fn' available as the twill command 'name'.
+    """
+    if name not in command_table:
+        command_list.append(name)
+    command_table[name] = fn
 
 ### command/argument handling.
 
-def process_args(args, globals_dict, locals_dict):
+variable_expression = re.compile("\${(.*?)}")
+
+_LITERAL, _SPECIAL, _VARIABLE, _SUBSTITUTION = range(4)
+
+def _compile_expression(expr):
+    try:
+        return compile(expr, '<twill argument>', 'eval')
+    except SyntaxError:
+        return expr                     # let eval() raise it when it's used.
+
+def _uses_url(code):
+    return not isinstance(code, str) and '__url__' in code.co_names
+
+class ArgumentTemplate(object):
     """
-    Take a list of string arguments parsed via pyparsing and evaluate
-    the special variables ('__*').
+    A raw script argument, compiled once into either a literal string or
+    code objects for its '__var', '$var' and '${expr}' substitutions.
 
-    Return a new list.
+    Templates pickle as their raw argument and are recompiled on load.
     """
-    newargs = []
-    for arg in args:
-        # __variable substitution.
-        if arg.startswith('__'):
+    __slots__ = ('raw', 'kind', 'value', 'uses_url')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.uses_url = False
+
+        if raw.startswith('__'):
+            self.kind = _SPECIAL
+            self.value = _compile_expression(raw)
+            self.uses_url = _uses_url(self.value)
+        elif raw.startswith('$') and not raw.startswith('${'):
+            self.kind = _VARIABLE
+            self.value = _compile_expression(raw[1:])
+            self.uses_url = _uses_url(self.value)
+        else:
+            parts = []
+            pos = 0
+            for m in variable_expression.finditer(raw):
+                code = _compile_expression(m.group(1))
+                parts.append(raw[pos:m.start()])
+                parts.append((code, m.group()))
+                pos = m.end()
+                self.uses_url = self.uses_url or _uses_url(code)
+
+            if parts:
+                parts.append(raw[pos:])
+                self.kind = _SUBSTITUTION
+                self.value = [ p for p in parts if p ]
+            else:                       # nothing to substitute.
+                self.kind = _LITERAL
+                self.value = raw.replace('\\n', '\n')
+
+    def evaluate(self, globals_dict, locals_dict):
+        """
+        Return the list of values this argument expands to.
+        """
+        kind = self.kind
+        if kind == _LITERAL:
+            return [self.value]
+
+        if self.uses_url:               # look up __url__ only when it's used.
+            locals_dict['__url__'] = commands.get_browser().get_url()
+
+        if kind == _SPECIAL:            # __variable substitution.
             try:
-                val = eval(arg, globals_dict, locals_dict)
+                val = eval(self.value, globals_dict, locals_dict)
             except NameError:           # not in dictionary; don't interpret.
-                val = arg
+                val = self.raw
 
+            print '*** VAL IS', val, 'FOR', self.raw
 
-            print '*** VAL IS', val, 'FOR', arg
-            
             if isinstance(val, str) or isinstance(val, unicode):
-                newargs.append(val)
+                vals = [val]
             else:
-                newargs.extend(val)
-                
-        # $variable substitution
-        elif arg.startswith('$') and not arg.startswith('${'):
+                vals = list(val)
+        elif kind == _VARIABLE:         # $variable substitution
             try:
-                val = eval(arg[1:], globals_dict, locals_dict)
+                val = eval(self.value, globals_dict, locals_dict)
             except NameError:           # not in dictionary; don't interpret.
-                val = arg
-            newargs.append(val)
-        else:
-            newargs.append(variable_substitution(arg, globals_dict, locals_dict))
+                val = self.raw
+            vals = [val]
+        else:                           # ${expression} substitution
+            s = ''
+            for part in self.value:
+                if isinstance(part, tuple):
+                    try:
+                        s = s + eval(part[0], globals_dict, locals_dict)
+                    except NameError:
+                        s = s + part[1]
+                else:
+                    s = s + part
+            vals = [s]
+
+        return [ i.replace('\\n', '\n') for i in vals ]
+
+    def __reduce__(self):
+        return (ArgumentTemplate, (self.raw,))
+
+    def __eq__(self, other):
+        return isinstance(other, ArgumentTemplate) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'ArgumentTemplate(%r)' % (self.raw,)
+
+def compile_args(args):
+    """
+    Compile a list of raw string arguments into ArgumentTemplates.
+    """
+    return [ ArgumentTemplate(arg) for arg in args ]
 
-    newargs = [ i.replace('\\n', '\n') for i in newargs ]
+def evaluate_args(templates, globals_dict, locals_dict):
+    """
+    Evaluate a list of compiled ArgumentTemplates (see 'compile_args')
+    into a new list of string arguments.
+    """
+    newargs = []
+    for template in templates:
+        if template.kind == _LITERAL:   # fast path: nothing to evaluate.
+            newargs.append(template.value)
+        else:
+            newargs.extend(template.evaluate(globals_dict, locals_dict))
 
     return newargs
 
+def process_args(args, globals_dict, locals_dict):
+    """
+    Take a list of string arguments parsed via pyparsing and evaluate
+    the special variables ('__*').
+
+    Return a new list.
+    """
+    return evaluate_args(compile_args(args), globals_dict, locals_dict)
+
 ###
 
+# trampolines by cmdinfo; emptied when it gets this big, so that processes
+# that run many different script files don't grow it forever.
+_trampolines = {}
+_max_trampolines = 10000
+
+def _get_trampoline(cmdinfo):
+    """
+    Return a code object that calls '__fn__(*__args__)', compiled with
+    'cmdinfo' as its filename so that error tracebacks show the script
+    file & line being executed.  Compiled once per 'cmdinfo'.
+    """
+    try:
+        return _trampolines[cmdinfo]
+    except KeyError:
+        if len(_trampolines) >= _max_trampolines:
+            _trampolines.clear()
+        codeobj = compile("__fn__(*__args__)", cmdinfo, 'eval')
+        _trampolines[cmdinfo] = codeobj
+        return codeobj
+
 def execute_command(cmd, args, globals_dict, locals_dict, cmdinfo):
     """
     Actually execute the command.
@@ -109,24 +243,21 @@ def execute_command(cmd, args, globals_dict, locals_dict, cmdinfo):
     Side effects: __args__ is set to the argument tuple, __cmd__ is set to
     the command.
     """
-    global command_list                 # all supported commands:
     # execute command.
     locals_dict['__cmd__'] = cmd
     locals_dict['__args__'] = args
-    if cmd not in command_list:
+    try:
+        fn = command_table[cmd]
+    except KeyError:
         raise TwillNameError("unknown twill command: '%s'" % (cmd,))
 
-    eval_str = "%s(*__args__)" % (cmd,)
+    stats.set_command(cmd)              # for per-command request timing.
 
-    # compile the code object so that we can get 'cmdinfo' into the
+    # call the function through a trampoline, to get 'cmdinfo' into the
     # error tracebacks.
-    codeobj = compile(eval_str, cmdinfo, 'eval')
-
-    # eval the codeobj in the appropriate dictionary.
-    result = eval(codeobj, globals_dict, locals_dict)
-    
-    # set __url__
-    locals_dict['__url__'] = commands.browser.get_url()
+    result = eval(_get_trampoline(cmdinfo), { '__builtins__' : __builtin__,
+                                              '__fn__' : fn,
+                                              '__args__' : args })
 
     return result
 
@@ -134,25 +265,175 @@ def execute_command(cmd, args, globals_dict, locals_dict, cmdinfo):
 
 _print_commands = False
 
-def parse_command(line, globals_dict, locals_dict):
+def parse_line(line):
     """
-    Parse command.
+    Parse a single line into (command, raw argument list), without
+    evaluating any variables in the arguments.
     """
     res = full_command.parseString(line)
     if res:
+        return res.command, res.arguments.asList()
+
+    return None, None                   # e.g. a comment
+
+def parse_command(line, globals_dict, locals_dict):
+    """
+    Parse command.
+    """
+    cmd, args = parse_line(line)
+    if cmd is not None:
         if _print_commands:
             print>>commands.OUT, "twill: executing cmd '%s'" % (line.strip(),)
             
-        args = process_args(res.arguments.asList(), globals_dict, locals_dict)
-        return (res.command, args)
+        args = process_args(args, globals_dict, locals_dict)
+        return (cmd, args)
 
     return None, None                   # e.g. a comment
 
 ###
 
+def compile_script(inp):
+    """
+    Parse the lines from a file-like iterator into a compiled script: a
+    list of (line number, command, argument templates, line) records,
+    skipping empty lines and comments.  (See 'compile_args'.)
+
+    Lines that fail to parse are recorded with a command of None, so that
+    the parse error is raised only when execution reaches them.
+    """
+    return list(_compile_lines(inp))
+
+def _compile_lines(inp):
+    """
+    Generate the compiled records for 'compile_script', one line at a time.
+    """
+    for n, line in enumerate(inp):
+        if not line.strip():            # skip empty lines
+            continue
+
+        try:
+            cmd, args = parse_line(line)
+        except ParseException:
+            yield (n, None, None, line)
+            continue
+
+        if cmd is not None:
+            yield (n, cmd, compile_args(args), line)
+
+# compiled scripts, by absolute path: (mtime, size) => compiled script.
+# compiled scripts are read-only, so they're shared between threads; the
+# lock makes sure that each is only compiled once.
+_script_cache = {}
+_script_cache_lock = threading.Lock()
+
+_cache_on_disk = False
+_disk_cache_dir = os.path.join(os.path.expanduser('~'), '.twill', 'cache')
+_disk_cache_suffix = '.twillc'
+_disk_cache_version = 2
+
+def cache_scripts_on_disk(flag, dirname=None):
+    """
+    Turn on/off keeping compiled scripts in '.twillc' files in 'dirname'
+    (by default ~/.twill/cache).  'flag' is bool.
+
+    Loading a compiled script runs whatever is in it, so the directory
+    is only used if it belongs to the user and no-one else can write to it.
+    """
+    global _cache_on_disk, _disk_cache_dir
+    _cache_on_disk = bool(flag)
+    if dirname is not None:
+        _disk_cache_dir = dirname
+
+def _disk_cache_filename(path):
+    name = hashlib.sha1(path).hexdigest() + _disk_cache_suffix
+    return os.path.join(_disk_cache_dir, name)
+
+def _trusted_cache_dir():
+    st = os.stat(_disk_cache_dir)
+    return st.st_uid == os.getuid() and not st.st_mode & 022
+
+def _load_disk_cache(path, key):
+    try:
+        if not _trusted_cache_dir():
+            return None
+
+        fp = open(_disk_cache_filename(path), 'rb')
+        try:
+            version, cache_path, cache_key, script = cPickle.load(fp)
+        finally:
+            fp.close()
+    except Exception:                   # missing, unreadable, or corrupt.
+        return None
+
+    if version != _disk_cache_version or cache_path != path or \
+           cache_key != key:
+        return None
+    return script
+
+def _save_disk_cache(path, key, script):
+    try:
+        if not os.path.isdir(_disk_cache_dir):
+            os.makedirs(_disk_cache_dir, 0700)
+        if not _trusted_cache_dir():
+            return
+
+        fp = open(_disk_cache_filename(path), 'wb')
+        try:
+            cPickle.dump((_disk_cache_version, path, key, script), fp, 2)
+        finally:
+            fp.close()
+    except (IOError, OSError):          # e.g. a read-only home directory.
+        pass
+
+def compile_file(filename):
+    """
+    Return the compiled script for the given file.  Compiled scripts are
+    cached in memory (and on disk, if turned on with 'cache_scripts_on_disk')
+    until the file's modification time or size changes.
+    """
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+
+    cached = _script_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    _script_cache_lock.acquire()
+    try:
+        cached = _script_cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]            # another thread compiled it.
+
+        script = _compile_file(path, key)
+        _script_cache[path] = (key, script)
+        return script
+    finally:
+        _script_cache_lock.release()
+
+def _compile_file(path, key):
+    script = None
+    if _cache_on_disk:
+        script = _load_disk_cache(path, key)
+
+    if script is None:
+        fp = open(path)
+        try:
+            script = compile_script(fp)
+        finally:
+            fp.close()
+
+        if _cache_on_disk:
+            _save_disk_cache(path, key, script)
+
+    return script
+
+###
+
 def execute_string(buf, **kw):
     """
-    Execute commands from a string buffer.
+    Execute commands from a string buffer.  Pass 'context' to run them in
+    the given twill context (see twill.context).
     """
     fp = StringIO(buf)
     
@@ -160,41 +441,54 @@ def execute_string(buf, **kw):
     if not kw.has_key('no_reset'):
        kw['no_reset'] = True
     
-    _execute_script(fp, **kw)
+    _execute_script(compile_script(fp), **kw)
 
 def execute_file(filename, **kw):
     """
     Execute commands from a file.
+
+    With 'reuse_session', the browser is reset but keeps its HTTP session
+    (and pooled connections) from earlier scripts.  Pass 'context' to run
+    the script in the given twill context (see twill.context) rather than
+    the current one.
     """
     # read the input lines
     if filename == "-":
-        inp = sys.stdin
+        # read (and run) lines as they come in, rather than all at once.
+        script = _compile_lines(sys.stdin)
     else:
-        inp = open(filename)
+        script = compile_file(filename)
 
     kw['source'] = filename
 
-    _execute_script(inp, **kw)
+    _execute_script(script, **kw)
     
-def _execute_script(inp, **kw):
+def _execute_script(script, **kw):
     """
-    Execute lines taken from a file-like iterator.
+    Execute a compiled script (see 'compile_script'), or any iterator
+    over compiled records.
     """
+    context = kw.pop('context', None)
+    if context is not None:
+        old_context = set_context(context)
+        try:
+            return _execute_script(script, **kw)
+        finally:
+            set_context(old_context)
+
     # initialize new local dictionary & get global + current local
     namespaces.new_local_dict()
     globals_dict, locals_dict = namespaces.get_twill_glocals()
-    
-    locals_dict['__url__'] = commands.browser.get_url()
 
     # reset browser
     if not kw.get('no_reset'):
-        commands.reset_browser()
+        commands.reset_browser(reuse_session=kw.get('reuse_session'))
 
     # go to a specific URL?
     init_url = kw.get('initial_url')
     if init_url:
+        stats.set_command('go')
         commands.go(init_url)
-        locals_dict['__url__'] = commands.browser.get_url()
 
     # should we catch exceptions on failure?
     catch_errors = False
@@ -206,16 +500,18 @@ def _execute_script(inp, **kw):
     
     try:
 
-        for n, line in enumerate(inp):
-            if not line.strip():            # skip empty lines
-                continue
-
+        for (n, cmd, args, line) in script:
             cmdinfo = "%s:%d" % (sourceinfo, n,)
             print 'AT LINE:', cmdinfo
 
-            cmd, args = parse_command(line, globals_dict, locals_dict)
             if cmd is None:
-                continue
+                parse_line(line)        # raise the parse error.
+
+            if _print_commands:
+                print>>commands.OUT, "twill: executing cmd '%s'" % \
+                      (line.strip(),)
+
+            args = evaluate_args(args, globals_dict, locals_dict)
 
             try:
                 execute_command(cmd, args, globals_dict, locals_dict, cmdinfo)
@@ -256,22 +552,3 @@ def debug_print_commands(flag):
     """
     global _print_commands
     _print_commands = bool(flag)
-        
-
-variable_expression = re.compile("\${(.*?)}")
-
-def variable_substitution(raw_str, globals_dict, locals_dict):
-    str=''
-    pos = 0
-    for m in variable_expression.finditer(raw_str):
-        str = str+raw_str[pos:m.start()]
-        try:
-            str = str + eval(m.group(1), globals_dict, locals_dict)
-        except NameError:
-            str = str + m.group()
-        pos = m.end()
-
-    str = str+raw_str[pos:]
-
-    return str
-
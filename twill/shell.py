@@ -162,7 +162,7 @@ class TwillCommandLoop(Singleton, cmd.Cmd):
 
     def provide_formname(self, prefix):
         names = []
-        forms = commands.browser._browser.forms()
+        forms = commands.get_browser()._browser.forms()
         for f in forms:
             id = f.attrs.get('id')
             if id and id.startswith(prefix):
@@ -175,7 +175,7 @@ class TwillCommandLoop(Singleton, cmd.Cmd):
 
     def provide_field(self, formname, prefix):
         names = []
-        form = commands.browser.get_form(formname)
+        form = commands.get_browser().get_form(formname)
         if not form:
             return []
         for c in form.controls:
@@ -190,7 +190,7 @@ class TwillCommandLoop(Singleton, cmd.Cmd):
 
     def _set_prompt(self):
         "Set the prompt to the current page."
-        url = commands.browser.get_url()
+        url = commands.get_browser().get_url()
         if url is None:
             url = " *empty page* "
         self.prompt = "current page: %s\n>> " % (url,)
@@ -261,6 +261,192 @@ class TwillCommandLoop(Singleton, cmd.Cmd):
     do_quit = do_exit
     help_quit = help_exit
 
+####
+#
+# parallel execution of script files, for 'twill-sh -j N'.
+#
+
+durations_file = '.twill-durations'    # script run times from earlier runs
+
+def load_durations(filename=durations_file):
+    """
+    Load the dictionary of script durations (absolute path => seconds)
+    saved by an earlier parallel run.  Return {} if there isn't one.
+    """
+    import cPickle
+    try:
+        fp = open(filename, 'rb')
+        try:
+            return dict(cPickle.load(fp))
+        finally:
+            fp.close()
+    except Exception:                   # missing, unreadable, or corrupt.
+        return {}
+
+def save_durations(durations, filename=durations_file):
+    """
+    Save the dictionary of script durations for the next parallel run.
+    """
+    import os, cPickle
+    tmpname = '%s.%d' % (filename, os.getpid(),)
+    try:
+        fp = open(tmpname, 'wb')
+        try:
+            cPickle.dump(durations, fp, 2)
+        finally:
+            fp.close()
+        os.rename(tmpname, filename)
+    except (IOError, OSError):          # e.g. a read-only directory.
+        pass
+
+def schedule_files(filenames, durations):
+    """
+    Order the filenames longest-first by their durations from earlier
+    runs.  Files without a recorded duration go first, in their original
+    order, since they may well be the slowest.
+    """
+    import os
+    def key(item):
+        n, filename = item
+        t = durations.get(os.path.abspath(filename))
+        return (t is not None, -(t or 0), n)
+
+    return [ filename for (n, filename) in sorted(enumerate(filenames),
+                                                  key=key) ]
+
+def _execute_file_captured(job):
+    """
+    Execute a single file in a worker process, capturing its output.
+    Return (filename, error message or None, output, duration).
+    """
+    import sys, time
+    from cStringIO import StringIO
+    from twill import execute_file, get_context
+
+    filename, initial_url, never_fail = job
+
+    out = StringIO()
+    context = get_context()
+    old_stdout, old_err = sys.stdout, context.err
+    sys.stdout = context.err = out
+
+    error = None
+    start_time = time.time()
+    try:
+        print '>> EXECUTING FILE', filename
+        try:
+            execute_file(filename, initial_url=initial_url,
+                         never_fail=never_fail)
+        except Exception, e:
+            error = str(e)
+            print '** UNHANDLED EXCEPTION:', error
+    finally:
+        sys.stdout, context.err = old_stdout, old_err
+
+    return filename, error, out.getvalue(), time.time() - start_time
+
+def execute_files_parallel(filenames, jobs, initial_url=None,
+                           never_fail=False, fail_fast=False,
+                           durations_filename=durations_file):
+    """
+    Execute the given files across 'jobs' worker processes, longest first,
+    each worker with its own browser.  The output of each file is printed
+    in one piece once the file is done.
+
+    With 'fail_fast', stop all of the workers at the first failure.
+
+    Return (succeeded, failed, not run) lists of filenames.
+    """
+    import os, signal, select, cPickle
+    from twill.utils import start_worker
+
+    durations = load_durations(durations_filename)
+    queue = schedule_files(filenames, durations)
+    queue.reverse()                     # pop() from the end.
+
+    success = []
+    failure = []
+    done = set()
+
+    workers = {}                        # result file => (pid, job file, job)
+    for i in range(min(jobs, len(queue))):
+        pid, job_fp, result_fp = start_worker(_execute_file_captured)
+        workers[result_fp] = (pid, job_fp, None)
+
+    def give_job(result_fp):
+        pid, job_fp, _ = workers[result_fp]
+        if queue:
+            job = (queue.pop(), initial_url, never_fail)
+            cPickle.dump(job, job_fp, 2)
+            job_fp.flush()
+            workers[result_fp] = (pid, job_fp, job)
+        else:                           # nothing left; let the worker exit.
+            cPickle.dump(None, job_fp, 2)
+            job_fp.close()
+            del workers[result_fp]
+            result_fp.close()
+            os.waitpid(pid, 0)
+
+    def collect(result_fp):
+        # read & report a worker's result; return True if the file failed.
+        try:
+            filename, error, output, elapsed = cPickle.load(result_fp)
+        except EOFError:                # the worker died.
+            pid, job_fp, job = workers.pop(result_fp)
+            job_fp.close()
+            result_fp.close()
+            os.waitpid(pid, 0)
+            filename, error, output, elapsed = \
+                      job[0], 'worker process died', '', None
+
+        print output,
+        done.add(filename)
+        if elapsed is not None:
+            durations[os.path.abspath(filename)] = elapsed
+
+        if error is None:
+            success.append(filename)
+            return False
+
+        if not output:
+            print '** UNHANDLED EXCEPTION:', error
+        failure.append(filename)
+        return True
+
+    try:
+        for result_fp in workers.keys():
+            give_job(result_fp)
+
+        stop = False
+        while workers and not stop:
+            ready, _, _ = select.select(workers.keys(), [], [])
+            for result_fp in ready:
+                if collect(result_fp) and fail_fast:
+                    stop = True
+                    break
+
+                if result_fp in workers:
+                    give_job(result_fp)
+
+        if stop:
+            # keep the results of files that the other workers have
+            # already finished, before stopping them.
+            ready, _, _ = select.select(workers.keys(), [], [], 0)
+            for result_fp in ready:
+                collect(result_fp)
+    finally:
+        for (pid, job_fp, job) in workers.values():
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            job_fp.close()
+        for result_fp in workers.keys():
+            result_fp.close()
+
+    save_durations(durations, durations_filename)
+
+    not_run = [ filename for filename in filenames if filename not in done ]
+    return success, failure, not_run
+
 ####
 
 twillargs = []                          # contains sys.argv *after* last '--'
@@ -305,6 +491,13 @@ def main():
     parser.add_option('-u', '--url', nargs=1, action="store", dest="url",
                       help="start at the given URL before each script")
 
+    parser.add_option('--cache', action="store_true", dest="cache",
+                      help = 'keep compiled scripts in ~/.twill/cache')
+
+    parser.add_option('-j', '--jobs', nargs=1, action="store", dest="jobs",
+                      default=1, type="int",
+                      help = 'run files in parallel in this many processes')
+
     ####
 
     # parse arguments.
@@ -326,6 +519,9 @@ def main():
         print 'twill version %s.' % (__version__,)
         sys.exit(0)
 
+    if options.cache:
+        parse.cache_scripts_on_disk(True)
+
     if options.quiet:
         assert not options.interact, "interactive mode is incompatible with -q"
         assert args, "interactive mode is incompatible with -q"
@@ -343,6 +539,17 @@ def main():
 
         filenames = gather_filenames(args)
 
+        if options.jobs > 1:
+            interactive = False
+            success, failure, not_run = \
+                     execute_files_parallel(filenames, options.jobs,
+                                            initial_url=options.url,
+                                            never_fail=options.never_fail,
+                                            fail_fast=options.fail)
+            if not_run:
+                print '** %d files NOT RUN after a failure.' % (len(not_run),)
+            filenames = []
+
         for filename in filenames:
             print '>> EXECUTING FILE', filename
 
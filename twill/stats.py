@@ -0,0 +1,298 @@
+"""
+Per-request timing statistics, as collected by twill-fork.
+
+Request latencies go into fixed-size, log-linear histograms (in the style
+of HdrHistogram) that can be merged across processes.  The histograms are
+kept per (command, URL pattern), where the URL pattern is the URL without
+its query string and with numeric path segments replaced by ':n'.
+"""
+
+import re
+import urlparse
+
+from context import get_context, get_default_context
+
+# 2**_precision_bits sub-buckets per power of two: about 1% precision.
+_precision_bits = 7
+_sub_buckets = 1 << _precision_bits
+_half_sub_buckets = _sub_buckets >> 1
+
+# values are recorded in microseconds, and anything above ~1 hour is
+# recorded as the maximum.
+_max_value = (1 << 32) - 1
+_n_buckets = _sub_buckets + (32 - _precision_bits) * _half_sub_buckets
+
+def _bucket_index(value):
+    if value < _sub_buckets:
+        return value
+    shift = value.bit_length() - _precision_bits
+    return _sub_buckets + (shift - 1) * _half_sub_buckets + \
+           (value >> shift) - _half_sub_buckets
+
+def _bucket_value(index):
+    """
+    Return the middle of the range of values that fall into the bucket.
+    """
+    if index < _sub_buckets:
+        return index
+    shift, sub = divmod(index - _sub_buckets, _half_sub_buckets)
+    shift += 1
+    return ((sub + _half_sub_buckets) << shift) + (1 << (shift - 1))
+
+class Histogram(object):
+    """
+    A fixed-memory latency histogram.  Values are in seconds.
+    """
+    def __init__(self):
+        self.counts = [0] * _n_buckets
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        us = min(int(seconds * 1e6), _max_value)
+        self.counts[_bucket_index(us)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Add the values recorded in 'other' to this histogram.
+        """
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        Return the value below which 'p' percent of the values fall.
+        """
+        if not self.count:
+            return 0.
+
+        target = max(1, int(round(self.count * p / 100.)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(_bucket_value(i) / 1e6, self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def __getstate__(self):
+        # only send the non-empty buckets over the pipe.
+        counts = [ (i, n) for (i, n) in enumerate(self.counts) if n ]
+        return (counts, self.count, self.total, self.max)
+
+    def __setstate__(self, state):
+        counts, self.count, self.total, self.max = state
+        self.counts = [0] * _n_buckets
+        for i, n in counts:
+            self.counts[i] = n
+
+_number_segment = re.compile('^\d+$')
+
+def url_pattern(url):
+    """
+    Return the pattern to group statistics for 'url' under.
+    """
+    scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+    path = '/'.join([ _number_segment.sub(':n', s)
+                      for s in path.split('/') ])
+    return urlparse.urlunparse((scheme, netloc.lower(), path or '/',
+                                '', '', ''))
+
+class RequestStats(object):
+    """
+    Latency histograms and error counts, keyed by (command, URL pattern).
+
+    Failed requests -- connection errors, time-outs and 4xx/5xx responses
+    -- count as errors but are timed along with everything else.
+
+    Timings that aren't of HTTP requests, such as whole script iterations,
+    are kept under '<...>' pseudo-commands and left out of the totals.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}
+
+    def record(self, command, pattern, seconds, error=False):
+        key = (command, pattern)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.record(seconds)
+
+        if error:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, h in other.histograms.iteritems():
+            mine = self.histograms.get(key)
+            if mine is None:
+                mine = self.histograms[key] = Histogram()
+            mine.merge(h)
+
+        for key, n in other.errors.iteritems():
+            self.errors[key] = self.errors.get(key, 0) + n
+
+    def total(self):
+        """
+        Return a single histogram over all of the requests.
+        """
+        h = Histogram()
+        for (command, pattern), other in self.histograms.iteritems():
+            if not command.startswith('<'):
+                h.merge(other)
+        return h
+
+    def get_state(self):
+        """
+        Return the statistics as plain lists & numbers (e.g. for JSON).
+        """
+        return [ [command, pattern, h.__getstate__(),
+                  self.errors.get((command, pattern), 0)]
+                 for ((command, pattern), h) in self.histograms.iteritems() ]
+
+    def set_state(self, state):
+        """
+        Replace the statistics with those from 'get_state'.
+        """
+        self.histograms = {}
+        self.errors = {}
+        for (command, pattern, h_state, errors) in state:
+            key = (command, pattern)
+            h = self.histograms[key] = Histogram()
+            h.__setstate__(h_state)
+            if errors:
+                self.errors[key] = errors
+
+    def n_errors(self):
+        return sum([ n for ((command, pattern), n) in self.errors.iteritems()
+                     if not command.startswith('<') ])
+
+    def __len__(self):
+        return self.total().count
+
+###
+
+# the stats that requests are being recorded into, and the twill command
+# (and twill-fork scenario) that is running, are kept in the current twill
+# context, so that each thread can record separately.  'recording' is the
+# default context's.
+
+recording = None
+
+def _set_recording(context, stats):
+    global recording
+    context.recording = stats
+    if context is get_default_context():
+        recording = stats
+
+def start_recording(stats=None):
+    """
+    Record the timing of all subsequent HTTP requests into 'stats' (a new
+    RequestStats object, by default).  Return the stats object.
+    """
+    if stats is None:
+        stats = RequestStats()
+    _set_recording(get_context(), stats)
+    return stats
+
+def stop_recording():
+    """
+    Stop recording requests and return the stats they were recorded into.
+    """
+    context = get_context()
+    stats = context.recording
+    _set_recording(context, None)
+    return stats
+
+def get_recording():
+    """
+    Return the stats that requests are being recorded into, or None.
+    """
+    return get_context().recording
+
+def set_command(command):
+    get_context().current_command = command
+
+def set_scenario(scenario):
+    get_context().current_scenario = scenario
+
+def record_request(url, seconds, error=False):
+    context = get_context()
+    if context.recording is not None:
+        command = context.current_command or '-'
+        if context.current_scenario:
+            command = '%s:%s' % (context.current_scenario, command)
+        context.recording.record(command, url_pattern(url), seconds, error)
+
+def record_app_time(url, seconds):
+    """
+    Record that the app took 'seconds' to respond to 'url'.  (For apps run
+    in-process, with loadgen.intercept_app; these are timings, and not
+    requests.)
+    """
+    context = get_context()
+    if context.recording is not None:
+        context.recording.record('<app>', url_pattern(url), seconds)
+
+def app_time(stats):
+    """
+    Return the total time spent in the app (see 'record_app_time').
+    """
+    return sum([ h.total for ((command, pattern), h)
+                 in stats.histograms.iteritems() if command == '<app>' ])
+
+def format_latency(h):
+    return 'p50 %.1fms  p90 %.1fms  p99 %.1fms  max %.1fms' % \
+           (h.percentile(50) * 1000, h.percentile(90) * 1000,
+            h.percentile(99) * 1000, h.max * 1000)
+
+def format_progress(stats, elapsed):
+    """
+    Return a one-line summary of 'stats' so far.
+    """
+    h = stats.total()
+    rate = 0.
+    if elapsed > 0:
+        rate = h.count / elapsed
+    return '%d requests (%.1f/s), %d errors; %s' % \
+           (h.count, rate, stats.n_errors(), format_latency(h))
+
+def format_stats(stats, elapsed):
+    """
+    Return a per-(command, URL pattern) report of 'stats', as a list of
+    lines; 'elapsed' is the wall-clock time it took to collect them.
+    """
+    lines = []
+    for key in sorted(stats.histograms):
+        command, pattern = key
+        h = stats.histograms[key]
+        what = 'requests'
+        if command.startswith('<'):
+            what = 'timings'
+        lines.append('%s %s' % (command, pattern))
+        lines.append('    %d %s, %d errors, %s' % \
+                     (h.count, what, stats.errors.get(key, 0),
+                      format_latency(h)))
+
+    h = stats.total()
+    rate = 0.
+    if elapsed > 0:
+        rate = h.count / elapsed
+    lines.append('total: %d requests (%.1f/s), %d errors' % \
+                 (h.count, rate, stats.n_errors()))
+    lines.append('    %s' % (format_latency(h),))
+    return lines
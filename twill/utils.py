@@ -7,6 +7,7 @@ code is implemented in the ConfigurableParsingFactory class.
 
 import os
 import base64
+import urlparse
 
 import subprocess
 
@@ -14,26 +15,298 @@ from lxml import etree, html, cssselect
 import re
 
 from errors import TwillException
+from context import get_context
+
+# cheap byte-level checks for an HTTP-EQUIV refresh in the page <head>.
+_head_end = re.compile(r'</head|<body', re.I)
+_refresh_prescan = re.compile(r'http-equiv\s*=\s*["\']?\s*refresh', re.I)
+_refresh_content = re.compile(
+    r'^\s*([\d.]*)\s*[;,]?\s*[\'"]?\s*(?:url\s*=\s*)?[\'"]?([^\'"]*)',
+    re.I)
+
+# set by the 'debug equiv-refresh' command.
+_debug_print_refresh = False
+
+# content types that are handed to the lxml HTML parser; anything else
+# (JSON, PDFs, CSV exports...) is never parsed.
+_html_content_types = ('text/html', 'application/xhtml+xml',
+                       'text/xml', 'application/xml')
+
+def normalize_url(url, base_url=None):
+    """
+    Return 'url' (relative to 'base_url', if given) as an absolute URL
+    with a lower-cased scheme and host, and with any '#fragment' removed.
+    """
+    if base_url:
+        url = urlparse.urljoin(base_url, url)
+
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme in ('http', 'https') and not path:
+        path = '/'
+
+    return urlparse.urlunsplit((scheme.lower(), netloc.lower(), path,
+                                query, ''))
+
+class LinkIndex(object):
+    """
+    All of the links on a page, collected in a single pass over the tree.
+
+    Each link is kept as (text, href, absolute_url), where 'text' includes
+    the text of any child elements.  Links can be looked up by exact href,
+    absolute URL or text; regexp lookups are cached per pattern.
+    """
+    def __init__(self, tree, base_url):
+        self.links = []
+
+        self._by_url = {}
+        self._by_text = {}
+        self._pattern_cache = {}
+
+        if tree is None:
+            return
+
+        base = tree.xpath('//base/@href')
+        if base:
+            base_url = urlparse.urljoin(base_url, base[0].strip())
+
+        for a in tree.iter('a'):
+            text = " ".join(a.text_content().split())
+            href = a.get('href')
+
+            absolute_url = None
+            if href is not None:
+                href = href.strip()
+                absolute_url = normalize_url(href, base_url)
+
+                self._by_url.setdefault(href, absolute_url)
+                self._by_url.setdefault(absolute_url, absolute_url)
+                self._by_text.setdefault(text, absolute_url)
+
+            self.links.append((text, href, absolute_url))
+
+    def __len__(self):
+        return len(self.links)
+
+    def get_by_url(self, url):
+        """
+        Return the absolute URL of the first link whose href or absolute
+        URL is exactly 'url', or None.
+        """
+        return self._by_url.get(url)
+
+    def get_by_text(self, text):
+        """
+        Return the absolute URL of the first link whose text is exactly
+        'text', or None.
+        """
+        return self._by_text.get(" ".join(text.split()))
+
+    def find(self, pattern):
+        """
+        Return the absolute URL of the first link whose text or href
+        matches the regexp 'pattern' (a string or a compiled regexp), or
+        '' if there is no such link.
+        """
+        try:
+            return self._pattern_cache[pattern]
+        except KeyError:
+            pass
+
+        regexp = pattern
+        if isinstance(pattern, basestring):
+            regexp = re.compile(pattern)
+
+        found = ''
+        for (text, href, absolute_url) in self.links:
+            if href is None:
+                continue
+            if regexp.search(text) or regexp.search(href):
+                found = absolute_url
+                break
+
+        self._pattern_cache[pattern] = found
+        return found
+
+def _select_options(control):
+    """
+    Map the option texts and values of a <select> control to the value
+    to set for each.
+    """
+    options = {}
+    names = {}
+    for option in control.iter('option'):
+        name = (option.text or '').strip()
+        value = option.get('value')
+        if value is None:
+            value = name
+        value = value.strip()
+
+        options.setdefault(value, value)
+        names.setdefault(name, value)
+
+    for name, value in names.items():
+        options.setdefault(name, value)
+
+    return options
+
+class FormIndex(object):
+    """
+    Lookup tables for the controls of a form, built once per form:
+    controls by id and by name, checkbox groups, submit buttons, and the
+    option maps of <select> controls.  Regexp lookups on control names are
+    cached per pattern.
+
+    Control *values* change as the form is filled in, so those are not
+    indexed.
+    """
+    def __init__(self, form):
+        self.form = form
+        self.inputs = list(form.inputs)
+
+        self.by_id = {}
+        self.by_name = {}
+        self.checkbox_groups = {}
+        self.submits = []
+
+        self._regexp_cache = {}
+        self._select_options = {}
+
+        checkboxes = {}
+        for c in self.inputs:
+            id = c.get("id")
+            if id is not None:
+                self.by_id.setdefault(id, []).append(c)
+            self.by_name.setdefault(str(c.name), []).append(c)
+
+            if hasattr(c, 'type'):
+                if c.type == 'checkbox' and c.get("name") is not None:
+                    checkboxes.setdefault(c.get("name"), []).append(c)
+                elif c.type == 'submit' or c.type == 'image':
+                    self.submits.append(c)
+
+        for name, controls in checkboxes.items():
+            if len(controls) > 1:
+                self.checkbox_groups[name] = html.CheckboxGroup(controls)
+
+    def find_by_regexp(self, pattern):
+        """
+        Return all controls with a name matching the regexp 'pattern'.
+        """
+        try:
+            return self._regexp_cache[pattern]
+        except KeyError:
+            pass
+
+        regexp = re.compile(pattern)
+        matches = [ c for c in self.inputs if regexp.search(str(c.get("name"))) ]
+
+        self._regexp_cache[pattern] = matches
+        return matches
+
+    def get_select_options(self, control):
+        """
+        Return the option map for the given <select> control (see
+        'set_form_control_value').
+        """
+        try:
+            return self._select_options[control]
+        except KeyError:
+            options = self._select_options[control] = _select_options(control)
+            return options
 
 class ResultWrapper(object):
     """
     Deal with mechanize/urllib2/whatever results, and present them in a
     unified form.  Returned by 'journey'-wrapped functions.
+
+    The page is only parsed the first time something asks for the
+    parsed tree (forms, links, title), and never if it isn't HTML.
     """
     def __init__(self, req):
         self.req = req
-        self.lxml = html.fromstring(self.req.text)
-        gfEntry = html.FormElement
+
+        self._lxml = None
+        self._parsed = False
+        self._forms = None
+        self._links = None
+        self._form_indexes = {}
+
+    def is_html(self):
+        """
+        Decide whether this page should be parsed as HTML, based on the
+        content type; if none is given, sniff the start of the body.
+        """
+        content_type = self.req.headers.get('content-type')
+        if content_type:
+            content_type = content_type.split(';', 1)[0].strip().lower()
+            return content_type in _html_content_types
+
+        return self.req.content.lstrip()[:1] == '<'
+
+    def _get_lxml(self):
+        if not self._parsed:
+            self._parsed = True
+            if self.is_html() and self.req.content.strip():
+                self._lxml = html.fromstring(self.req.text)
+
+        return self._lxml
+
+    lxml = property(_get_lxml)
+
+    def get_meta_refresh(self):
+        """
+        Return (delay, absolute URL) for an HTTP-EQUIV refresh to another
+        page, or (None, None).  The page is only parsed if a byte-level
+        scan of its <head> finds a candidate, and then the parsed tree is
+        the same one used for forms and links.
+        """
+        if not self.is_html():
+            return None, None
+
+        content = self.req.content
+        m = _head_end.search(content)
+        if m:
+            content = content[:m.start()]
+        if not _refresh_prescan.search(content) or self.lxml is None:
+            return None, None
+
+        attr = self.lxml.xpath(
+        "//meta[translate(@http-equiv, 'REFSH', 'refsh') = 'refresh']/@content"
+                )
+        if not attr:
+            return None, None
+
+        m = _refresh_content.match(attr[0])
+        delay, url = m.group(1), m.group(2).strip()
+        if not url:
+            return None, None           # a refresh of this page, not a redirect
+
+        try:
+            delay = float(delay)
+        except ValueError:
+            delay = 0
+
+        return delay, normalize_url(url, self.get_url())
+
+    def _build_forms(self):
+        """
+        Collect the forms on the page, with the global form (inputs outside
+        of any <form>) at index 0 iff present.
+        """
+        if self.lxml is None:
+            return []
+
         orphans = self.lxml.xpath('//input[not(ancestor::form)]')
         if len(orphans) > 0:
             gloFo = "<form>"
             for o in orphans:
                 gloFo += etree.tostring(o)
             gloFo += "</form>"
-            self.forms = html.fromstring(gloFo).forms
-            self.forms.extend(self.lxml.forms)
-        else:
-            self.forms = self.lxml.forms
+            forms = html.fromstring(gloFo).forms
+            forms.extend(self.lxml.forms)
+            return forms
+
+        return self.lxml.forms
 
     def get_url(self):
         return self.req.url
@@ -48,31 +321,35 @@ class ResultWrapper(object):
         return self.req.headers
 
     def get_forms(self):
-        return self.forms
+        if self._forms is None:
+            self._forms = self._build_forms()
+        return self._forms
+
+    def get_form_index(self, form):
+        try:
+            return self._form_indexes[form]
+        except KeyError:
+            index = self._form_indexes[form] = FormIndex(form)
+            return index
 
     def get_title(self):
+        if self.lxml is None:
+            raise TwillException("Error: Getting title on a non-HTML page")
+
         selector = cssselect.CSSSelector("title")
         return selector(self.lxml)[0].text
 
+    def get_link_index(self):
+        if self._links is None:
+            self._links = LinkIndex(self.lxml, self.get_url())
+        return self._links
+
     def get_links(self):
-        selector = cssselect.CSSSelector("a")
-        return [
-                 # (stringify_children(l) or '', l.get("href")) 
-                 (l.text or '', l.get("href"))
-                 for l in selector(self.lxml)
-               ]
+        return [ (text, href) for (text, href, _) in
+                 self.get_link_index().links ]
+
     def find_link(self, pattern):
-        selector = cssselect.CSSSelector("a")
-
-        links = [
-                 # (stringify_children(l) or '', l.get("href")) 
-                 (l.text or '', l.get("href"))
-                 for l in selector(self.lxml)
-                ]
-        for link in links:
-            if re.search(pattern, link[0]) or re.search(pattern, link[1]):
-                return link[1]
-        return ''
+        return self.get_link_index().find(pattern)
 
     def get_form(self, formname):
         forms = self.get_forms()
@@ -97,6 +374,33 @@ class ResultWrapper(object):
         except (ValueError, IndexError):              # int() failed
             return None
 
+class DownloadResult(ResultWrapper):
+    """
+    A page whose body was streamed into a file instead of being kept in
+    memory.  Only its size, SHA-1 digest and download time are recorded;
+    if the file is a temporary one, it is removed along with the result.
+    """
+    def __init__(self, req, filename, size, digest, elapsed, temporary=False):
+        ResultWrapper.__init__(self, req)
+        self.filename = filename
+        self.size = size
+        self.digest = digest
+        self.elapsed = elapsed
+        self.temporary = temporary
+
+    def is_html(self):
+        return False
+
+    def get_page(self):
+        return ''
+
+    def __del__(self):
+        if self.temporary:
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+
 def trunc(s, length):
     """
     Truncate a string s to length length, by cutting off the last 
@@ -192,9 +496,12 @@ def make_boolean(value):
 
     raise TwillException("unable to convert '%s' into true/false" % (value,))
 
-def set_form_control_value(control, val):
+def set_form_control_value(control, val, options=None):
     """
     Helper function to deal with setting form values on checkboxes, lists etc.
+
+    For <select> controls, 'options' may be the option map from the form's
+    FormIndex; otherwise it's rebuilt here.
     """
     if hasattr(control, 'type') and control.type == 'checkbox':
         try:
@@ -241,23 +548,23 @@ def set_form_control_value(control, val):
 
         # now, select the value.
 
-        options = [i.strip() for i in control.value_options]
-        optionNames = [i.text.strip() for i in control.getchildren()]
-        fullOptions = dict(zip(optionNames, options))
-        for k,v in fullOptions.iteritems():
-            if (val == k or val == v) and flag:
-                if hasattr(control, 'checkable') and control.checkable:
-                    control.checked = flag
-                else:
-                    control.value.add(v)
-                return
-            elif (val == k or val == v) and not flag:
-                try:
-                    control.value.remove(v)
-                except ValueError:
-                    pass
-                return
-        raise(TwillException("Attempt to set invalid value"))
+        if options is None:
+            options = _select_options(control)
+
+        v = options.get(val)
+        if v is None:
+            raise(TwillException("Attempt to set invalid value"))
+
+        if flag:
+            if hasattr(control, 'checkable') and control.checkable:
+                control.checked = flag
+            else:
+                control.value.add(v)
+        else:
+            try:
+                control.value.remove(v)
+            except ValueError:
+                pass
         
     else:
         if(hasattr(control, 'type') and control.type != 'submit'):
@@ -326,8 +633,8 @@ def run_tidy(html):
     """
     global _tidy_cmd, _tidy_exists
 
-    from commands import _options
-    require_tidy = _options.get('require_tidy')
+    options = get_context().options
+    require_tidy = options.get('require_tidy')
 
     if not _tidy_exists:
         if require_tidy:
@@ -365,8 +672,30 @@ def _is_valid_filename(f):
 
 # Added so browser can ask whether to follow meta redirects
 def _follow_equiv_refresh():
-    from twill.commands import _options
-    return _options.get('acknowledge_equiv_refresh')
+    return get_context().options.get('acknowledge_equiv_refresh')
+
+def _equiv_refresh_options():
+    """
+    Return the maximum number of refreshes to follow in a row, and whether
+    to wait for the refresh delay before following one.
+    """
+    options = get_context().options
+    return (options.get('equiv_refresh_max_hops'),
+            options.get('equiv_refresh_honor_delay'))
+
+def _history_limits():
+    """
+    Return the maximum number of pages & bytes to keep in browser history.
+    """
+    options = get_context().options
+    return (options.get('history_max_pages'),
+            options.get('history_max_bytes'))
+
+def _download_threshold():
+    """
+    Return the body size above which pages are streamed to disk (0: never).
+    """
+    return get_context().options.get('download_threshold')
 
 def gather_filenames(arglist):
     """
@@ -391,3 +720,41 @@ def gather_filenames(arglist):
             l.append(filename)
 
     return l
+
+def start_worker(run_job):
+    """
+    Fork a worker process with a browser of its own, which calls
+    'run_job(job)' for each job pickled to it, one at a time, and pickles
+    back the result, until it is sent None.
+
+    Return (pid, job file, result file).
+    """
+    import sys, cPickle
+    import commands
+
+    job_r, job_w = os.pipe()
+    result_r, result_w = os.pipe()
+
+    sys.stdout.flush()                  # don't print buffered output twice.
+    pid = os.fork()
+    if pid == 0:
+        os.close(job_w)
+        os.close(result_r)
+        try:
+            # don't share the parent's connections with the other workers.
+            commands.reset_browser()
+
+            jobs = os.fdopen(job_r, 'rb')
+            results = os.fdopen(result_w, 'wb')
+            while 1:
+                job = cPickle.load(jobs)
+                if job is None:         # no more work.
+                    break
+                cPickle.dump(run_job(job), results, 2)
+                results.flush()
+        finally:
+            os._exit(0)
+
+    os.close(job_r)
+    os.close(result_w)
+    return pid, os.fdopen(job_w, 'wb'), os.fdopen(result_r, 'rb')
@@ -3,18 +3,40 @@ wsgi_intercept.WSGI_HTTPConnection is a replacement for
 httplib.HTTPConnection that intercepts certain HTTP connections into a
 WSGI application.
 
-Use 'add_wsgi_intercept' and 'remove_wsgi_intercept' to control this behavior.
+Use 'add_wsgi_intercept' and 'remove_wsgi_intercept' to control this behavior,
+and 'mount' to apply it to a requests Session: intercepted host:ports are
+then handled by a WSGIAdapter mounted just for them, and everything else
+is left to the session's usual adapters.
+
+Intercepted connections speak HTTP/1.1, with keep-alive and chunked
+responses, so that connection pools (e.g. urllib3's) can reuse them.
+
+Any number of threads may make intercepted requests at once, and so the
+apps may be called from several threads at once (see 'multithread').
 """
 import sys
+import weakref
+import threading
 from httplib import HTTPConnection
 import urllib
 from cStringIO import StringIO
 import traceback
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3.exceptions import ClosedPoolError, \
+     EmptyPoolError
+from requests.packages.urllib3.util.connection import \
+     is_connection_dropped as _is_connection_dropped
+
 debuglevel = 0
 # 1 basic
 # 2 verbose
 
+# what the apps are told, as wsgi.multithread and wsgi.multiprocess.
+multithread = True
+multiprocess = False
+
 ####
 
 #
@@ -25,26 +47,157 @@ debuglevel = 0
 # have that information in the HTTPConnection.connect() function that does the
 # redirection.
 #
-# format: key=(host, port), value=(create_app, top_url)
+# format: key=(host, port), value=(create_app, top_url, cache_app)
 #
 # (top_url becomes the SCRIPT_NAME)
 
 _wsgi_intercept = {}
 
-def add_wsgi_intercept(host, port, app_create_fn, script_name=''):
+# app objects created so far: key=(host, port), value=app
+_wsgi_apps = {}
+
+# sessions to intercept for: key=session, value=its WSGIAdapter, or None
+# while there are no intercepts.
+_sessions = weakref.WeakKeyDictionary()
+
+# guards the dicts above.  (reentrant, for apps that add intercepts.)
+_lock = threading.RLock()
+
+def add_wsgi_intercept(host, port, app_create_fn, script_name='',
+                       cache_app=True):
     """
     Add a WSGI intercept call for host:port, using the app returned
     by app_create_fn with a SCRIPT_NAME of 'script_name' (default '').
+
+    app_create_fn is only called once, and the app reused for all the
+    requests to host:port, unless 'cache_app' is False; then each
+    request gets a fresh app, on a fresh (non-persistent) connection.
     """
-    _wsgi_intercept[(host, port)] = (app_create_fn, script_name)
+    key = (host, port)
+    _lock.acquire()
+    try:
+        _wsgi_intercept[key] = (app_create_fn, script_name, cache_app)
+        _wsgi_apps.pop(key, None)
+        for session in _sessions.keys():
+            _mount(session)
+    finally:
+        _lock.release()
 
 def remove_wsgi_intercept(host, port):
     """
     Remove the WSGI intercept call for (host, port).
     """
     key = (host, port)
-    if _wsgi_intercept.has_key(key):
-        del _wsgi_intercept[key]
+    _lock.acquire()
+    try:
+        if _wsgi_intercept.has_key(key):
+            del _wsgi_intercept[key]
+        _wsgi_apps.pop(key, None)
+        for session in _sessions.keys():
+            _unmount(session, _prefixes(*key))
+            if not _wsgi_intercept:
+                _uninstall(session)
+    finally:
+        _lock.release()
+
+def get_intercept(host, port):
+    """
+    Return (intercept, app, script_name) for host:port, where 'intercept'
+    is the registry entry the app was made for; or (None, None, None) if
+    host:port isn't intercepted.
+    """
+    key = (host, int(port))
+    _lock.acquire()
+    try:
+        intercept = _wsgi_intercept.get(key)
+        if intercept is None:
+            return None, None, None
+
+        (app_fn, script_name, cache_app) = intercept
+        if not cache_app:
+            return intercept, app_fn(), script_name
+
+        app = _wsgi_apps.get(key)
+        if app is None:
+            app = _wsgi_apps[key] = app_fn()
+        return intercept, app, script_name
+    finally:
+        _lock.release()
+
+#
+# mount: send a requests Session's intercepted traffic to a WSGIAdapter.
+#
+
+def mount(session, **adapter_kwargs):
+    """
+    Intercept the requests made with 'session', from now on: mount a
+    WSGIAdapter (created with 'adapter_kwargs') on it for each of the
+    intercepted host:ports, now and as they're added.  Other requests go
+    through the session's usual adapters, untouched.
+
+    Safe to call again, e.g. after mounting other adapters on 'session'.
+    """
+    _lock.acquire()
+    try:
+        if _sessions.get(session) is None:
+            _sessions[session] = None
+            session._wsgi_adapter_kwargs = adapter_kwargs
+        _mount(session)
+    finally:
+        _lock.release()
+
+def unmount(session):
+    """
+    Stop intercepting the requests made with 'session'.
+    """
+    _lock.acquire()
+    try:
+        if session in _sessions:
+            _uninstall(session)
+            del _sessions[session]
+    finally:
+        _lock.release()
+
+def _prefixes(host, port):
+    # the URL prefixes for host:port.  (the port is left out of URLs to
+    # port 80, usually.)
+    prefixes = [ 'http://%s:%s/' % (host, port) ]
+    if int(port) == 80:
+        prefixes.append('http://%s/' % (host,))
+    return prefixes
+
+def _mount(session):
+    # (call with _lock held.)
+    if not _wsgi_intercept:
+        return
+
+    adapter = _sessions.get(session)
+    if adapter is None:
+        adapter = WSGIAdapter(**session._wsgi_adapter_kwargs)
+        _sessions[session] = adapter
+
+    for (host, port) in _wsgi_intercept.keys():
+        for prefix in _prefixes(host, port):
+            if session.adapters.get(prefix) is not adapter:
+                session.mount(prefix, adapter)
+
+def _unmount(session, prefixes):
+    # (call with _lock held.)
+    adapter = _sessions.get(session)
+    for prefix in prefixes:
+        if adapter is not None and session.adapters.get(prefix) is adapter:
+            del session.adapters[prefix]
+
+def _uninstall(session):
+    # remove the WSGIAdapter from 'session' altogether.  (call with _lock
+    # held.)
+    adapter = _sessions.get(session)
+    if adapter is not None:
+        for prefix, mounted in session.adapters.items():
+            if mounted is adapter:
+                del session.adapters[prefix]
+        adapter.close()
+        _sessions[session] = None
 
 #
 # make_environ: behave like a Web server.  Take in 'input', and behave
@@ -125,8 +278,7 @@ def make_environ(inp, host, port, script_name):
     if debuglevel:
         print "method: %s; script_name: %s; path_info: %s; query_string: %s" % (method, script_name, path_info, query_string)
 
-    r = inp.read()
-    inp = StringIO(r)
+    # the rest of 'inp' is the request body: the app reads it from there.
 
     #
     # fill out our dictionary.
@@ -136,8 +288,9 @@ def make_environ(inp, host, port, script_name):
                      "wsgi.url_scheme": "http",
                      "wsgi.input" : inp,           # to read for POSTs
                      "wsgi.errors" : StringIO(),
-                     "wsgi.multithread" : 0,
-                     "wsgi.multiprocess" : 0,
+                     "wsgi.file_wrapper" : FileWrapper,
+                     "wsgi.multithread" : multithread,
+                     "wsgi.multiprocess" : multiprocess,
                      "wsgi.run_once" : 0,
     
                      "REQUEST_METHOD" : method,
@@ -180,6 +333,113 @@ def make_environ(inp, host, port, script_name):
 
     return environ
 
+#
+# wsgi.file_wrapper, and the file-like responses read from the fake socket.
+#
+
+class FileWrapper:
+    """
+    The 'wsgi.file_wrapper': wrap a file-like object so that it's sent as
+    the response body.  Responses are read from the file itself, rather
+    than via the iterator, when possible.
+    """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+class wsgi_response_file:
+    """
+    The response to one request, as a read-only file: the status line &
+    headers in 'head', and then the strings from the iterator 'body' --
+    or, for an unchunked file_wrapper response, whatever is read from the
+    'filelike' -- pulled in only as they're read.  'close' is called once
+    when the file is closed.
+    """
+    def __init__(self, head, body, filelike=None, close=None):
+        self.buf = head                 # current piece of the response...
+        self.pos = 0                    # ...and how far it's been read.
+        self.body = body
+        self.filelike = filelike
+        self._close = close
+        self.closed = False
+
+    def _fill(self):
+        # make sure there's something unread in self.buf; False at the end.
+        while self.pos >= len(self.buf):
+            if self.body is None:
+                return False
+            try:
+                self.buf = self.body.next()
+                self.pos = 0
+            except StopIteration:
+                self.body = None
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = [ self.buf[self.pos:] ]
+            self.pos = len(self.buf)
+            while self._fill():
+                pieces.append(self.buf)
+                self.pos = len(self.buf)
+            if self.filelike is not None:
+                pieces.append(self.filelike.read())
+            return ''.join(pieces)
+
+        if not self._fill():
+            if self.filelike is not None:
+                return self.filelike.read(size)
+            return ''
+
+        # hand out whole pieces without copying them, where possible.
+        if self.pos == 0 and len(self.buf) <= size:
+            self.pos = len(self.buf)
+            return self.buf
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        pieces = []
+        while size != 0 and self._fill():
+            end = self.buf.find('\n', self.pos) + 1 or len(self.buf)
+            if size > 0:
+                end = min(end, self.pos + size)
+                size -= end - self.pos
+            pieces.append(self.buf[self.pos:end])
+            self.pos = end
+            if pieces[-1].endswith('\n'):
+                return ''.join(pieces)
+        if size != 0 and self.filelike is not None:
+            pieces.append(self.filelike.readline(size))
+        return ''.join(pieces)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._close is not None:
+                self._close()
+
 #
 # fake socket for WSGI intercept stuff.
 #
@@ -188,27 +448,28 @@ class wsgi_fake_socket:
     """
     Handle HTTP traffic and stuff into a WSGI application object instead.
 
-    Note that this class assumes:
-    
-     1. 'makefile' is called (by the response class) only after all of the
-        data has been sent to the socket by the request class;
-     2. non-persistent (i.e. non-HTTP/1.1) connections.
+    Note that this class assumes that 'makefile' is called (by the
+    response class) only after all of the data has been sent to the socket
+    by the request class.  Each request/response pair on a persistent
+    (HTTP/1.1) connection does the same, in turn.
     """
-    def __init__(self, app, host, port, script_name):
+    def __init__(self, app, host, port, script_name, keep_alive=False):
         self.app = app                  # WSGI app object
         self.host = host
         self.port = port
         self.script_name = script_name  # SCRIPT_NAME (app mount point)
+        self.keep_alive = keep_alive    # allow persistent connections?
+
+        self.inp = []                   # stuff written into this "socket"
+        self.closed = False
 
-        self.inp = StringIO()           # stuff written into this "socket"
-        self.write_results = []          # results from the 'write_fn'
-        self.results = None             # results from running the app
-        self.output = StringIO()        # all output from the app, incl headers
+        self.intercept = None           # the intercept we're connected to.
 
     def makefile(self, *args, **kwargs):
         """
         'makefile' is called by the HTTPResponse class once all of the
-        data has been written.  So, in this interceptor class, we need to:
+        data for a request has been written.  So, in this interceptor
+        class, we need to:
         
           1. build a start_response function that grabs all the headers
              returned by the WSGI app;
@@ -216,73 +477,113 @@ class wsgi_fake_socket:
              traffic;
           3. build an environment dict out of the traffic in inp;
           4. run the WSGI app & grab the result object;
-          5. concatenate & return the result(s) read from the result object.
+          5. return a file that reads the headers, and then the result(s)
+             from the result object as they're needed -- chunked, if the
+             app didn't give a Content-Length.
         """
 
+        # construct the wsgi.input file from everything that's been
+        # written to this "socket" since the last request.  (httplib
+        # sends small bodies along with the headers, and big ones in
+        # pieces; either way, a single string is used as is.)
+        traffic = self.inp
+        self.inp = []
+        if len(traffic) == 1:
+            inp = StringIO(traffic[0])
+        else:
+            inp = StringIO(''.join(traffic))
+
+        # build the environ dictionary.
+        environ = make_environ(inp, self.host, self.port, self.script_name)
+
+        # persistent connection?  (HTTP/1.1 clients assume so by default.)
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        keep_alive = self.keep_alive and \
+                     environ['SERVER_PROTOCOL'].strip() == 'HTTP/1.1' and \
+                     'close' not in connection
+
+        head = []                       # status line & headers.
+        write_results = []              # results from the 'write_fn'.
+        chunked = [False]
+
         # dynamically construct the start_response function for no good reason.
 
         def start_response(status, headers, exc_info=None):
             # construct the HTTP request.
-            self.output.write("HTTP/1.0 " + status + "\n")
-            
+            if keep_alive:
+                head[:] = ["HTTP/1.1 " + status + "\r\n"]
+            else:
+                head[:] = ["HTTP/1.0 " + status + "\r\n"]
+
+            # ...if it's persistent, the body is chunked, unless its
+            # length is known.
+            names = [ k.lower() for (k, v) in headers ]
+            if keep_alive and 'content-length' not in names and \
+               _may_have_body(environ['REQUEST_METHOD'], status):
+                headers = list(headers) + [('Transfer-Encoding', 'chunked')]
+                chunked[0] = True
+
             for k, v in headers:
-                self.output.write('%s: %s\n' % (k, v,))
-            self.output.write('\n')
+                head.append('%s: %s\r\n' % (k, v,))
+            head.append('\r\n')
 
             def write_fn(s):
-                self.write_results.append(s)
+                write_results.append(s)
             return write_fn
 
-        # construct the wsgi.input file from everything that's been
-        # written to this "socket".
-        inp = StringIO(self.inp.getvalue())
-
-        # build the environ dictionary.
-        environ = make_environ(inp, self.host, self.port, self.script_name)
-
         # run the application.
         app_result = self.app(environ, start_response)
-        self.result = iter(app_result)
+        result = iter(app_result)
 
         ###
 
-        # read all of the results.  the trick here is to get the *first*
-        # bit of data from the app via the generator, *then* grab & return
-        # the data passed back from the 'write' function, and then return
-        # the generator data.  this is because the 'write' fn doesn't
-        # necessarily get called until the first result is requested from
-        # the app function.
+        # get the *first* bit of data from the app via the generator
+        # before anything else: apps that are generators don't call
+        # start_response 'til then.  the data passed to the 'write'
+        # function (which also isn't necessarily called until the first
+        # result is requested from the app function) goes out before it.
         #
         # see twill tests, 'test_wrapper_intercept' for a test that breaks
         # if this is done incorrectly.
 
         try:
-            generator_data = None
-            try:
-                generator_data = self.result.next()
-
-            finally:
-                for data in self.write_results:
-                    self.output.write(data)
-
-            if generator_data:
-                self.output.write(generator_data)
-
-                while 1:
-                    data = self.result.next()
-                    self.output.write(data)
-                    
+            first = [ result.next() ]
         except StopIteration:
-            pass
+            first = []
+
+        def body():
+            for data in write_results:
+                yield data
+            if first and first[0]:      # (an empty string ends it, too.)
+                yield first[0]
+                while 1:                # (don't call iter(result) again!)
+                    yield result.next()
+
+        def chunk(data_iter):
+            for data in data_iter:
+                if data:                # (an empty chunk ends the body.)
+                    yield '%x\r\n' % (len(data),)
+                    yield data
+                    yield '\r\n'
+            yield '0\r\n\r\n'
+
+        close = getattr(app_result, 'close', None)
 
-        if hasattr(app_result, 'close'):
-            app_result.close()
-            
         if debuglevel >= 2:
-            print "***", self.output.getvalue(), "***"
+            print "***", ''.join(head), "***"
+
+        # a file_wrapper is read from directly, once the data the app
+        # already gave us has been.
+        if isinstance(app_result, FileWrapper) and not chunked[0]:
+            if first:
+                write_results.append(first[0])
+            return wsgi_response_file(''.join(head), iter(write_results),
+                                      app_result.filelike, close)
 
-        # return the concatenated results.
-        return StringIO(self.output.getvalue())
+        if chunked[0]:
+            return wsgi_response_file(''.join(head), chunk(body()),
+                                      close=close)
+        return wsgi_response_file(''.join(head), body(), close=close)
 
     def sendall(self, str):
         """
@@ -291,12 +592,35 @@ class wsgi_fake_socket:
         if debuglevel >= 2:
             print ">>>", str, ">>>"
 
-        self.inp.write(str)
+        self.inp.append(str)
 
-    def close(self):
-        "Do nothing, for now."
+    def settimeout(self, timeout):
+        "Nothing ever blocks, so there's nothing to time out."
         pass
 
+    def close(self):
+        self.closed = True
+
+def _may_have_body(method, status):
+    """
+    Return True unless responses to 'method' with 'status' have no body.
+    """
+    code = int(status.split(' ', 1)[0])
+    return method != 'HEAD' and code >= 200 and code not in (204, 304)
+
+def is_connection_dropped(conn):
+    """
+    urllib3's check for whether a pooled connection is still usable,
+    extended to intercepted connections: they stay usable 'til they're
+    closed, or the intercept they were made for is removed or replaced.
+    """
+    sock = getattr(conn, 'sock', False)
+    if isinstance(sock, wsgi_fake_socket):
+        key = (sock.host, int(sock.port))
+        return sock.closed or sock.intercept is not _wsgi_intercept.get(key)
+
+    return _is_connection_dropped(conn)
+
 #
 # WSGI_HTTPConnection
 #
@@ -310,14 +634,7 @@ class WSGI_HTTPConnection(HTTPConnection):
         """
         Return the app object for the given (host, port).
         """
-        key = (host, int(port))
-
-        app, script_name = None, None
-        
-        if _wsgi_intercept.has_key(key):
-            (app_fn, script_name) = _wsgi_intercept[key]
-            app = app_fn()
-
+        intercept, app, script_name = get_intercept(host, port)
         return app, script_name        
     
     def connect(self):
@@ -329,13 +646,16 @@ class WSGI_HTTPConnection(HTTPConnection):
             sys.stderr.write('connect: %s, %s\n' % (self.host, self.port,))
                              
         try:
-            (app, script_name) = self.get_app(self.host, self.port)
+            (intercept, app, script_name) = get_intercept(self.host,
+                                                          self.port)
             if app:
                 if debuglevel:
                     sys.stderr.write('INTERCEPTING call to %s:%s\n' % \
                                      (self.host, self.port,))
                 self.sock = wsgi_fake_socket(app, self.host, self.port,
-                                             script_name)
+                                             script_name,
+                                             keep_alive=intercept[2])
+                self.sock.intercept = intercept
             else:
                 HTTPConnection.connect(self)
                 
@@ -344,6 +664,45 @@ class WSGI_HTTPConnection(HTTPConnection):
                 traceback.print_exc()
             raise
 
+#
+# WSGIConnectionPool & WSGIAdapter: urllib3 & requests plumbing for the above.
+#
+
+class WSGIConnectionPool(connectionpool.HTTPConnectionPool):
+    """
+    An HTTPConnectionPool of WSGI_HTTPConnections.
+    """
+    ConnectionCls = WSGI_HTTPConnection
+
+    def _get_conn(self, timeout=None):
+        # as for HTTPConnectionPool, except for checking the pooled
+        # connection with our is_connection_dropped: urllib3's own can't
+        # poll a fake socket.
+        conn = None
+        try:
+            conn = self.pool.get(block=self.block, timeout=timeout)
+        except AttributeError:          # self.pool is None
+            raise ClosedPoolError(self, "Pool is closed.")
+        except connectionpool.queue.Empty:
+            if self.block:
+                raise EmptyPoolError(self, "Pool reached maximum size and "
+                                     "no more connections are allowed.")
+
+        if conn and is_connection_dropped(conn):
+            conn.close()
+
+        return conn or self._new_conn()
+
+class WSGIAdapter(HTTPAdapter):
+    """
+    A requests transport adapter that sends its requests to the intercepted
+    WSGI apps.  See 'mount'.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = \
+            { 'http' : WSGIConnectionPool }
+
 ### DEBUGGING CODE -- to help me figure out communications stuff. ###
 
 # (ignore me, please)